@@ -0,0 +1,187 @@
+import argparse
+import json
+import os
+import sys
+
+# ARK - the steps of the main program one at a time, and quick checks of the archive, from the command line
+# Examples: python ark.py status          (the latest date archived for each fund, and the last run)
+#           python ark.py status --online (also ask the ARK website whether each fund has a new file)
+#           python ark.py report          (print the latest summary)
+#           python ark.py fetch && python ark.py ingest && python ark.py analyze
+# 'cathie' (and pandas) take most of a second to import, so they are only imported by the commands that need them;
+# 'status' and 'report' only read the manifests and summary files, and start in a few tens of milliseconds.  'fetch',
+# 'ingest' and 'analyze' share the checkpoint of the run (see cathie.Pipeline_run), so they can be run one after
+# another, or again after one stopped partway, on the same day; 'analyze' finishes the run.  ark_etf_main.py still
+# runs every step
+
+def fund_list():
+    """the tickers in 'ark_funds.txt' (as 'cathie.tickers_list_urls_dictionary', without importing cathie)"""
+    with open('ark_funds.txt') as file:
+        return [line.split()[0] for line in file if line.strip()]
+
+def read_json(filepath):
+    """the contents of a json file, or None if there is no such file"""
+    if not os.path.isfile(filepath):
+        return None
+    with open(filepath, 'r') as file:
+        return json.load(file)
+
+def summary_files():
+    """every text summary, oldest first: (date, filepath)"""
+    # the main program names the summary 'summary\summary_YYYY_MM_DD.txt', which is a file in the 'summary' folder on
+    # Windows and a file called 'summary\summary_YYYY_MM_DD.txt' elsewhere; both are found
+    files = {}
+    for folder, prefix in [('summary', 'summary_'), ('.', 'summary\\summary_')]:
+        if not os.path.isdir(folder):
+            continue
+        for file_name in os.listdir(folder):
+            if file_name.startswith(prefix) and file_name.endswith('.txt'):
+                date = file_name[len(prefix):-len('.txt')]
+                if len(date) == 10:
+                    files[date] = os.path.join(folder, file_name) if folder != '.' else file_name
+    return sorted(files.items())
+
+def status(args):
+    """STATUS - the latest archive and delta file of each fund, what the last run did, and the latest summary"""
+    funds = args.fund or fund_list()
+    validators = read_json(os.path.join('download_cache', 'validators.json')) or {}
+    checks = {}
+    if args.online:
+        # asking the website needs the downloader (and so cathie)
+        import cathie
+        urls = cathie.tickers_list_urls_dictionary()[1]
+        checks = cathie.Holdings_downloader({fund: urls[fund] for fund in funds}).check()
+
+    lines = ['fund  archived    files  analyzed    published']
+    # True if any fund has a file that was not archived and analyzed yet
+    behind = False
+    for fund in funds:
+        manifest = read_json(os.path.join(fund, 'manifest.json'))
+        archive = sorted(manifest['archive']) if manifest else []
+        delta = sorted(manifest['delta']) if manifest else []
+        # the Last-Modified date the website gave for the file when it was last downloaded (or checked just now)
+        published = validators.get(fund, {}).get('last_modified')
+        line = '{:<5} {:<11} {:>5}  {:<11} {}'.format(fund, archive[-1] if archive else '-', len(archive),
+                                                      delta[-1] if delta else '-', published or '-')
+        if archive and (not delta or delta[-1] < archive[-1]):
+            line += '  (not analyzed yet)'
+            behind = True
+        if os.path.isfile(fund + '.csv'):
+            line += '  (downloaded, not ingested yet)'
+            behind = True
+        if fund in checks:
+            check, last_modified = checks[fund]
+            line += '  online: ' + check + (' ' + last_modified if last_modified else '')
+            behind = behind or check == 'new file'
+        lines.append(line)
+
+    # the last run, and whether it finished
+    runs = sorted(os.listdir('runs')) if os.path.isdir('runs') else []
+    checkpoint = read_json(os.path.join('runs', runs[-1], 'checkpoint.json')) if runs else None
+    if checkpoint:
+        steps = sorted(checkpoint['steps'])
+        lines.append('Last run: ' + checkpoint['run'] + (' finished' if checkpoint['finished'] else ' did not finish') +
+                     ' (' + str(len(steps)) + ' steps done' + (': ' + ', '.join(steps) if not checkpoint['finished']
+                                                               else '') + ')')
+    else:
+        lines.append('Last run: none')
+    summaries = summary_files()
+    lines.append('Latest summary: ' + (summaries[-1][1] if summaries else 'none'))
+    print('\n'.join(lines))
+    # the exit code is 1 if a fund is behind, for cron and monitoring scripts
+    return int(behind)
+
+def report(args):
+    """REPORT - print the summary of a date (YYYY_MM_DD), or the latest summary"""
+    summaries = dict(summary_files())
+    if args.list:
+        print('\n'.join(date + '  ' + filepath for date, filepath in summaries.items()))
+        return 0
+    if not summaries:
+        print('No summary yet')
+        return 1
+    date = args.date or max(summaries)
+    if date not in summaries:
+        print('No summary for ' + date + '; the summaries are from ' + min(summaries) + ' to ' + max(summaries))
+        return 1
+    filepath = summaries[date]
+    # the same summary as JSON lines (see cathie.summary_json_file_name)
+    if args.json:
+        filepath = os.path.splitext(filepath)[0] + '.ndjson'
+    with open(filepath, 'r') as file:
+        sys.stdout.write(file.read())
+    return 0
+
+def fetch(args):
+    """WEB SCRAPE - download the csv file of each fund from the ARK website"""
+    import cathie
+    cathie.import_now()
+    tickers_urls = cathie.tickers_list_urls_dictionary()
+    run = cathie.Pipeline_run(fresh=args.fresh)
+    status = run.download(tickers_urls[1], workers=args.workers)
+    print('Downloaded: ' + ', '.join(fund + ' ' + result for fund, result in sorted(status.items())))
+    return 0
+
+def ingest(args):
+    """INGEST - archive each downloaded file, in the same steps as the main program"""
+    import cathie
+    cathie.import_now()
+    tickers_urls = cathie.tickers_list_urls_dictionary()
+    cathie.store = cathie.Holdings_store(args.format)
+    cathie.Folders_organize(tickers_urls[0]).create_etf_directories()
+    cathie.Folders_organize(tickers_urls[0]).create_etf_sub_directories()
+    today_date_dict = cathie.Pipeline_run().ingest(tickers_urls[0])
+    print('Ingested: ' + ', '.join(fund + ' ' + date for fund, date in today_date_dict.items()))
+    return 0
+
+def analyze(args):
+    """PARALLEL ANALYSIS - compare the latest two files of each fund and write the summary"""
+    import cathie
+    cathie.import_now()
+    ticker = cathie.tickers_list_urls_dictionary()[0]
+    cathie.store = cathie.Holdings_store(args.format)
+    run = cathie.Pipeline_run()
+    # the latest file archived for each fund (the files 'ingest' archived)
+    today_date_dict = {fund: cathie.Archive_manifest(fund).dates['archive'][-1] for fund in ticker}
+    summary_file = cathie.summary_file_name(today_date_dict)
+    today_filepath_list = cathie.Get_working_files(ticker).today_files()
+    yesterday_filepath_list = cathie.Get_working_files(ticker).yesterday_files(today_filepath_list)
+    cathie.parallel_analysis(ticker, today_filepath_list, yesterday_filepath_list, today_date_dict, summary_file,
+                             args.workers, cathie.Analysis_cache(), run)
+    run.finish()
+    print('Summary: ' + summary_file)
+    return 0
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Download, archive and compare the ARK ETF holdings files, one step '
+                                                 'at a time')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    command = commands.add_parser('fetch', help='download the csv files from the ARK website')
+    command.add_argument('--fresh', action='store_true', help='start a new run, even if the last run stopped partway')
+    command.add_argument('--workers', type=int, default=4, help='number of files downloaded at once')
+    command.set_defaults(run=fetch)
+
+    command = commands.add_parser('ingest', help='archive the downloaded files')
+    command.add_argument('--format', default='csv', help='file format of the archive: csv, parquet or feather')
+    command.set_defaults(run=ingest)
+
+    command = commands.add_parser('analyze', help='compare the latest two files of each fund and write the summary')
+    command.add_argument('--format', default='csv', help='file format of the archive: csv, parquet or feather')
+    command.add_argument('--workers', type=int, default=None, help='number of processes (default: every CPU core)')
+    command.set_defaults(run=analyze)
+
+    command = commands.add_parser('status', help='the latest date archived and analyzed for each fund (quick)')
+    command.add_argument('--fund', nargs='+', default=None, help='only these funds (default: every fund)')
+    command.add_argument('--online', action='store_true', help='also ask the ARK website whether each fund has a '
+                                                              'new file (without downloading it)')
+    command.set_defaults(run=status)
+
+    command = commands.add_parser('report', help='print the latest summary, or the summary of a date (quick)')
+    command.add_argument('date', nargs='?', default=None, help='date of the summary, YYYY_MM_DD (default: the latest)')
+    command.add_argument('--json', action='store_true', help='print the summary as JSON lines')
+    command.add_argument('--list', action='store_true', help='list the dates that have a summary')
+    command.set_defaults(run=report)
+
+    args = parser.parse_args()
+    sys.exit(args.run(args))
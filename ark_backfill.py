@@ -0,0 +1,17 @@
+import argparse
+import cathie
+
+# BACKFILL - rebuild the delta files for every date in each fund's archive, i.e. after a bug fix or a new metric
+# Example: python ark_backfill.py --start 2021_01_01 --workers 8
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild the delta files for every date in the archive')
+    parser.add_argument('--start', default='0000_00_00', help='first date to rebuild, YYYY_MM_DD')
+    parser.add_argument('--end', default='9999_99_99', help='last date to rebuild, YYYY_MM_DD')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: every CPU core)')
+    parser.add_argument('--format', default='csv', help="file format of the delta files: csv, parquet or feather")
+    args = parser.parse_args()
+
+    # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of ARK ETF tickers
+    tickers_urls = cathie.tickers_list_urls_dictionary()
+    cathie.store = cathie.Holdings_store(args.format)
+    cathie.backfill_deltas(tickers_urls[0], workers=args.workers, start=args.start, end=args.end)
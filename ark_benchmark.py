@@ -0,0 +1,20 @@
+import argparse
+import cathie
+
+# BENCHMARK - time each stage of the program on made-up ARK files of any size, without the internet
+# Example: python ark_benchmark.py --funds 50 --holdings 1000 --days 30
+# Each run is added to benchmark_results.ndjson and compared with the last run of the same size
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Time each stage of the program on made-up ARK files')
+    parser.add_argument('--funds', type=int, default=7, help='number of funds')
+    parser.add_argument('--holdings', type=int, default=30, help='number of stocks in each fund')
+    parser.add_argument('--days', type=int, default=2, help='number of days of history, including today')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (default: every CPU core)')
+    parser.add_argument('--format', default='csv', help='file format of the archive and delta files: csv, parquet or '
+                                                        'feather')
+    parser.add_argument('--seed', type=int, default=1, help='the same seed makes the same files')
+    parser.add_argument('--results', default='benchmark_results.ndjson', help='file the times are added to')
+    args = parser.parse_args()
+
+    cathie.store = cathie.Holdings_store(args.format)
+    cathie.benchmark_pipeline(args.funds, args.holdings, args.days, args.workers, args.seed, args.results)
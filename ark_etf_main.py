@@ -1,43 +1,117 @@
+import argparse
+import cProfile
+import pstats
 import cathie
 
-# DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of ARK ETF tickers
-tickers_urls = cathie.tickers_list_urls_dictionary()
-# WEB SCRAPE - download the ARK ETF csv files from the ARK website
-cathie.Grab_files_from_internet(tickers_urls[1]).get_csv()
-# GRAB DATE - look into each csv file, grab the date, and rename the file accordingly
-today_date_dict = cathie.Grab_files_from_internet(tickers_urls[1]).get_date_rename_file()
-# Create the summary file object to be used in later modules
-summary_file = cathie.summary_file_name(today_date_dict)
-# TRUNCATE CSV - remove the last three rows of each csv file
-cathie.Edit_downloaded_files().remove_last_three_rows()
-# PRICE AND RANK - add two columns to each csv file - price & rank
-cathie.Edit_downloaded_files().calc_stock_price_and_rank()
-# CREATE FOLDER TREE - create a folder structure if not already created
-cathie.Folders_organize(tickers_urls[0]).create_etf_directories()
-# CREATE SUB FOLDER TREE - create a sub directory folder structure if not already created
-cathie.Folders_organize(tickers_urls[0]).create_etf_sub_directories()
-# MOVE FILES - move each csv file to the appropriate ARK ETF specific folder
-cathie.Folders_organize(tickers_urls[0]).move_today_files(today_date_dict)
-# ARCHIVE - move each csv file to the appropriate archive ARK ETF specific folder
-    # This method is not currently being used
-    #cathie.Folders_organize(tickers_urls[0]).archive_today_files(today_date_dict)
-# TODAY FILE - get the latest file from the archive folder
-today_filepath_list = cathie.Get_working_files(tickers_urls[0]).today_files()
-# YESTERDAY FILE - get the second latest file from the archive folder
-yesterday_filepath_list = cathie.Get_working_files(tickers_urls[0]).yesterday_files(today_filepath_list)
-# Create a data frame for each ARK ETF fund, both TODAY and YESTERDAY files to compare them
-delta_filepath_list = cathie.ark_data_frames(tickers_urls[0], today_filepath_list, yesterday_filepath_list,
-                                           today_date_dict)
-# Calculate the total market value of each fund and the change from yesterday
-fund_mv_list = cathie.fund_sum_market_value(tickers_urls[0], today_filepath_list, yesterday_filepath_list, summary_file)
-# Notify the user if a stock has been added or removed from the etf fund
-cathie.stocks_added_or_removed(tickers_urls[0], today_filepath_list, yesterday_filepath_list, summary_file)
-# Find the median buy or sold % for each fund, and count how many stocks had shares sold at the median and mode
-mode_median_message_list = cathie.median_mode_change_in_shares(delta_filepath_list)
-# Notify the user if a stock has changed by +-5% of shares owned, share price, of change in rank by 5 or more positions
-cathie.changed_x_or_more(tickers_urls[0], fund_mv_list[0], fund_mv_list[1], summary_file, mode_median_message_list)
-# No longer needed, but will keep for future
-#cathie.remove_duplicate_lines()
+# Everything runs inside this check so that the processes started by the PARALLEL ANALYSIS step (which import
+# this file on Windows) do not run the whole program again
+# The steps can also be run one at a time, and the archive checked quickly, with ark.py (i.e. python ark.py status)
+if __name__ == '__main__':
+    # MEASURE - each step and each fund is timed and counted (see cathie.Pipeline_metrics), and added to metrics.ndjson
+    # Example: python ark_etf_main.py --memory --prometheus ark.prom --profile ark.pstats
+    parser = argparse.ArgumentParser(description='Download, archive and compare the ARK ETF holdings files')
+    parser.add_argument('--format', default='csv', help='file format of the archive and delta files: csv, parquet or '
+                                                        'feather')
+    parser.add_argument('--metrics', default='metrics.ndjson', help='file the measurements of each step are added to')
+    parser.add_argument('--prometheus', default=None, help='also write the measurements in the Prometheus text format')
+    parser.add_argument('--memory', action='store_true', help='also measure the peak memory of each step (slower)')
+    parser.add_argument('--profile', default=None, help='save a cProfile of the whole run to this file, and print the '
+                                                        'slowest functions; the funds are analyzed in this process')
+    parser.add_argument('--fresh', action='store_true', help='start from the beginning, even if the last run stopped '
+                                                            'partway')
+    args = parser.parse_args()
+    # pandas is imported now, before the steps are timed, instead of in the first step that uses it
+    cathie.import_now()
+    cathie.metrics = cathie.Pipeline_metrics(memory=args.memory)
+    if args.profile:
+        profile = cProfile.Profile()
+        profile.enable()
 
-print('¡Hecho! ¡La programación esta terminada!')
+    # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of ARK ETF tickers
+    tickers_urls = cathie.tickers_list_urls_dictionary()
+    # STORAGE FORMAT - 'csv', or --format parquet/feather to load the archive and delta files faster (needs pyarrow)
+        # Existing csv files can be converted with: cathie.store.migrate(tickers_urls[0])
+    cathie.store = cathie.Holdings_store(args.format)
+    # CHECKPOINT - each step (and fund) that is finished is recorded in 'runs/', so if the last run stopped partway,
+    # this run only does the steps it didn't finish (see cathie.Pipeline_run)
+    run = cathie.Pipeline_run(fresh=args.fresh)
+    # WEB SCRAPE - download the ARK ETF csv files from the ARK website
+    with cathie.metrics.stage('download'):
+        run.download(tickers_urls[1])
+        # the download without checkpoints was:
+        #cathie.Grab_files_from_internet(tickers_urls[1]).get_csv()
+    # CREATE FOLDER TREE - create a folder structure if not already created
+    cathie.Folders_organize(tickers_urls[0]).create_etf_directories()
+    # CREATE SUB FOLDER TREE - create a sub directory folder structure if not already created
+    cathie.Folders_organize(tickers_urls[0]).create_etf_sub_directories()
+    # INGEST - in one pass per file: grab the date, remove the last three rows, add price & rank, and save the file to
+    # the appropriate ARK ETF archive folder
+    with cathie.metrics.stage('ingest'):
+        today_date_dict = run.ingest(tickers_urls[0])
+        # the ingest without checkpoints was:
+        #today_date_dict = cathie.Ingest_downloaded_files(tickers_urls[0]).ingest_today_files()
+    # Create the summary file object to be used in later modules
+    summary_file = cathie.summary_file_name(today_date_dict)
+    # The steps below were replaced by the INGEST step above
+        # GRAB DATE - look into each csv file, grab the date, and rename the file accordingly
+        #today_date_dict = cathie.Grab_files_from_internet(tickers_urls[1]).get_date_rename_file()
+        # TRUNCATE CSV - remove the last three rows of each csv file
+        #cathie.Edit_downloaded_files().remove_last_three_rows()
+        # PRICE AND RANK - add two columns to each csv file - price & rank
+        #cathie.Edit_downloaded_files().calc_stock_price_and_rank()
+        # MOVE FILES - move each csv file to the appropriate ARK ETF specific folder
+        #cathie.Folders_organize(tickers_urls[0]).move_today_files(today_date_dict)
+    # ARCHIVE - move each csv file to the appropriate archive ARK ETF specific folder
+        # This method is not currently being used
+        #cathie.Folders_organize(tickers_urls[0]).archive_today_files(today_date_dict)
+    # TODAY FILE - get the latest file from the archive folder
+    with cathie.metrics.stage('today_files'):
+        today_filepath_list = cathie.Get_working_files(tickers_urls[0]).today_files()
+    # YESTERDAY FILE - get the second latest file from the archive folder
+    with cathie.metrics.stage('yesterday_files'):
+        yesterday_filepath_list = cathie.Get_working_files(tickers_urls[0]).yesterday_files(today_filepath_list)
+    # PARALLEL ANALYSIS - the funds don't depend on each other, so each fund is compared, summarized and checked for
+    # major changes in its own process; the summary file is put together in fund order at the end
+        # 'workers' is the number of processes: None uses every CPU core, 1 runs the funds one after another
+    workers = None
+        # a profile only sees this process, so the funds are analyzed one after another when profiling
+    if args.profile:
+        workers = 1
+        # funds whose today and yesterday files have not changed since the last run are loaded from this cache
+    analysis_cache = cathie.Analysis_cache()
+    # Returns a list of the delta filepaths and a list of the delta data frames
+    with cathie.metrics.stage('parallel_analysis') as stage:
+        delta_list = cathie.parallel_analysis(tickers_urls[0], today_filepath_list, yesterday_filepath_list,
+                                              today_date_dict, summary_file, workers, analysis_cache, run)
+        stage['rows'] = sum(len(delta_df) for delta_df in delta_list[1])
+    # The steps below were replaced by the PARALLEL ANALYSIS step above
+        # Create a data frame for each ARK ETF fund, both TODAY and YESTERDAY files to compare them
+        #delta_list = cathie.ark_data_frames(tickers_urls[0], today_filepath_list, yesterday_filepath_list,
+        #                                    today_date_dict)
+        # Calculate the total market value of each fund and the change from yesterday
+        #fund_mv_list = cathie.fund_sum_market_value(tickers_urls[0], today_filepath_list, yesterday_filepath_list,
+        #                                            summary_file)
+        # Notify the user if a stock has been added or removed from the etf fund
+        #cathie.stocks_added_or_removed(tickers_urls[0], today_filepath_list, yesterday_filepath_list, summary_file)
+        # Find the median buy or sold % for each fund, and count how many stocks had shares sold at the median and mode
+        #mode_median_message_list = cathie.median_mode_change_in_shares(delta_list[1])
+        # Notify the user if a stock has changed by +-5% of shares owned, share price, of change in rank by 5 or more
+        # positions
+        #cathie.changed_x_or_more(tickers_urls[0], fund_mv_list[0], fund_mv_list[1], summary_file,
+        #                         mode_median_message_list, delta_list[1])
+    # No longer needed, but will keep for future
+    #cathie.remove_duplicate_lines()
 
+    # MEASURE - save the measurements, and the profile if one was asked for
+    if args.profile:
+        profile.disable()
+        profile.dump_stats(args.profile)
+        pstats.Stats(profile).sort_stats('cumulative').print_stats(25)
+    cathie.metrics.write(args.metrics)
+    if args.prometheus:
+        cathie.metrics.write_prometheus(args.prometheus)
+    print(cathie.metrics.report())
+    # CHECKPOINT - the run finished, so the next run starts from the beginning
+    run.finish()
+
+    print('¡Hecho! ¡La programación esta terminada!')
@@ -0,0 +1,33 @@
+import argparse
+import time
+import cathie
+
+# LOOKUP - every day ARK held, bought or sold one stock, in every fund, from the security index of the delta files
+# Example: python ark_lookup.py TSLA --fund ARKK --start 2021_01_01 --changes
+# The index (security_index.db) is kept up to date by the main program; --update indexes any delta files it is missing
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Look up one stock's history in every ARK fund")
+    parser.add_argument('symbol', nargs='?', default=None, help='ticker or CUSIP of the stock')
+    parser.add_argument('--fund', nargs='+', default=None, help='only these funds (default: every fund)')
+    parser.add_argument('--start', default='0000_00_00', help='first date, YYYY_MM_DD')
+    parser.add_argument('--end', default='9999_99_99', help='last date, YYYY_MM_DD')
+    parser.add_argument('--changes', action='store_true', help="only the days the fund's shares changed")
+    parser.add_argument('--update', action='store_true', help='first index the delta files that are new or changed '
+                                                              '(i.e. the first time, or after copying in delta files)')
+    parser.add_argument('--csv', default=None, help='also save the history to this csv file')
+    args = parser.parse_args()
+
+    index = cathie.Security_index()
+    if args.update:
+        # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of tickers
+        tickers_urls = cathie.tickers_list_urls_dictionary()
+        print('Indexed ' + str(index.update(tickers_urls[0])) + ' delta files')
+    if args.symbol:
+        # pandas is imported now, so only the lookup itself is timed (see cathie.lazy_import)
+        cathie.import_now()
+        start = time.perf_counter()
+        history = index.lookup(args.symbol, args.fund, args.start, args.end)
+        print(cathie.security_history_text(args.symbol.upper(), history, args.changes))
+        print('Looked up in {:.1f} ms'.format(1000 * (time.perf_counter() - start)))
+        if args.csv:
+            history.to_csv(args.csv, index=False)
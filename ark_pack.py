@@ -0,0 +1,24 @@
+import argparse
+import cathie
+
+# PACK - keep each fund's archive as a full file every few dates and only the changed rows in between (much smaller)
+# Example: python ark_pack.py --prune
+# Once a fund is packed, each new file is packed as it is archived; --unpack puts pruned archive files back (i.e. to
+# backfill the delta files of those dates)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Pack the archive files of each fund into FUND/packed')
+    parser.add_argument('--keyframe-every', type=int, default=20, help='a full file every this many dates')
+    parser.add_argument('--prune', action='store_true', help='delete the archive files of the packed dates, except '
+                                                             'the latest two')
+    parser.add_argument('--unpack', nargs=2, default=None, metavar=('START', 'END'),
+                        help='instead, save the pruned archive files from START to END (YYYY_MM_DD) again')
+    parser.add_argument('--format', default='csv', help='file format of the packed files: csv, parquet or feather')
+    args = parser.parse_args()
+
+    # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of ARK ETF tickers
+    tickers_urls = cathie.tickers_list_urls_dictionary()
+    cathie.store = cathie.Holdings_store(args.format)
+    if args.unpack:
+        cathie.unpack_archive(tickers_urls[0], args.unpack[0], args.unpack[1])
+    else:
+        cathie.pack_archive(tickers_urls[0], args.keyframe_every, args.prune)
@@ -0,0 +1,48 @@
+import argparse
+import pandas as pd
+import cathie
+
+# SIGNALS - the multi-day signals of each stock in each fund: the change in shares over the window, the days in a row
+# it was bought or sold, the mean and volatility of its daily price change %, and the change in its weight
+# Example: python ark_signals.py --fund ARKK --sort streak --check
+# The signals are kept up to date by the main program; --rebuild works them out again from every delta file
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Show the multi-day signals of each stock in the ARK funds')
+    parser.add_argument('--fund', nargs='+', default=None, help='only these funds (default: every fund)')
+    parser.add_argument('--window', type=int, default=20, help='number of delta files (days) in the window')
+    parser.add_argument('--sort', default=None, help='sort by this column, largest first (e.g. streak, d_shares_20d)')
+    parser.add_argument('--rebuild', action='store_true', help='first work the signals out again from every delta '
+                                                               'file (i.e. the first time, or with a new window)')
+    parser.add_argument('--check', action='store_true', help='compare the saved signals with the signals worked out '
+                                                             'again from every delta file')
+    parser.add_argument('--format', default='csv', help='file format of the delta files: csv, parquet or feather')
+    parser.add_argument('--csv', default=None, help='also save the signals to this csv file')
+    args = parser.parse_args()
+
+    cathie.store = cathie.Holdings_store(args.format)
+    # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of tickers
+    funds = args.fund or cathie.tickers_list_urls_dictionary()[0]
+    signals_list = []
+    for fund in funds:
+        rolling_signals = cathie.Rolling_signals(fund, args.window)
+        if args.rebuild:
+            rolling_signals.rebuild()
+        if rolling_signals.load() is None:
+            print(fund + ': no signals saved with a window of ' + str(args.window) + ', use --rebuild')
+            continue
+        if args.check:
+            mismatches = rolling_signals.check()
+            if mismatches.empty:
+                print(fund + ': the saved signals match the signals worked out from every delta file')
+            else:
+                print(fund + ': ' + str(len(mismatches)) + ' stocks do not match')
+                print(mismatches.to_string(index=False))
+        signals_list.append(rolling_signals.signals())
+
+    if signals_list:
+        signals = pd.concat(signals_list, ignore_index=True)
+        if args.sort:
+            signals = signals.sort_values(args.sort, ascending=False, kind='stable')
+        print(signals.to_string(index=False))
+        if args.csv:
+            signals.to_csv(args.csv, index=False)
@@ -0,0 +1,37 @@
+import argparse
+import cathie
+
+# TRADE FLOW - the estimated $ each fund bought and sold of each stock over a range of dates, netted across the funds
+# and ranked, from the saved delta files; the change in market value that was only a price move is kept apart
+# Example: python ark_trades.py --start 2021_02_01 --end 2021_02_28 --top 20
+# The main program also adds the trade flow of the day to the summary (summary_YYYY_MM_DD_trades.csv)
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Estimate the trades of the ARK funds from their delta files')
+    parser.add_argument('--fund', nargs='+', default=None, help='only these funds (default: every fund)')
+    parser.add_argument('--start', default='0000_00_00', help='first date, YYYY_MM_DD')
+    parser.add_argument('--end', default='9999_99_99', help='last date, YYYY_MM_DD')
+    parser.add_argument('--top', type=int, default=cathie.firm_wide_top, help='number of stocks to print')
+    parser.add_argument('--by-day', action='store_true', help='rank the stocks on each date, instead of the total '
+                                                              'over the whole range')
+    parser.add_argument('--format', default='csv', help='file format of the delta files: csv, parquet or feather')
+    parser.add_argument('--csv', default=None, help='also save the net flow of every stock to this csv file')
+    args = parser.parse_args()
+
+    cathie.store = cathie.Holdings_store(args.format)
+    # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of tickers
+    funds = args.fund or cathie.tickers_list_urls_dictionary()[0]
+    flows = cathie.trade_flow_history(funds, args.start, args.end)
+    if flows.empty:
+        print('No delta files from ' + args.start + ' to ' + args.end)
+    else:
+        first, last = flows['date'].min(), flows['date'].max()
+        if not args.by_day:
+            # every date counts as one, so each stock is netted and ranked over the whole range
+            flows = flows.assign(date=first + ' to ' + last)
+        stocks = cathie.net_trade_flow(flows)
+        print('Estimated trades of ' + ', '.join(funds) + ' from ' + first + ' to ' + last + ': bought $' +
+              f"{stocks['bought'].sum():,.0f}" + ', sold $' + f"{-stocks['sold'].sum():,.0f}" + ', price moves $' +
+              f"{stocks['price_move'].sum():,.0f}")
+        print(stocks[stocks['flow_rank'] <= args.top].to_string(index=False))
+        if args.csv:
+            stocks.to_csv(args.csv, index=False)
@@ -0,0 +1,25 @@
+import argparse
+import asyncio
+import cathie
+
+# DAEMON MODE - check the ARK website for new files on a schedule, and compare each fund as soon as its file is out
+# Example: python ark_watch.py --interval 300
+# The summary of the day (summary/summary_YYYY_MM_DD.txt) is written again each time another fund's file comes in
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Watch the ARK website and process each fund as its file is published')
+    parser.add_argument('--interval', type=float, default=300, help='seconds between checks of each fund')
+    parser.add_argument('--polls', type=int, default=None, help='number of checks of each fund (default: forever)')
+    parser.add_argument('--format', default='csv', help='file format of the archive and delta files: csv, parquet or '
+                                                        'feather')
+    parser.add_argument('--test', nargs='+', default=None, help='test mode: folders of TICKER.csv files to serve in '
+                                                                'turn from a local stand-in for the ARK website')
+    args = parser.parse_args()
+
+    cathie.store = cathie.Holdings_store(args.format)
+    if args.test:
+        cathie.test_watcher(args.test)
+    else:
+        # DICTIONARY/LIST - a dictionary of keys (ARK ETF tickers) and values (ARK ETF url link); list of tickers
+        tickers_urls = cathie.tickers_list_urls_dictionary()
+        watcher = cathie.Holdings_watcher(tickers_urls[0], tickers_urls[1], args.interval, cathie.Analysis_cache())
+        asyncio.run(watcher.run(args.polls))
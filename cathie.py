@@ -1,9 +1,53 @@
 import os
+import sys
 import csv
+import math
 import time
+import contextlib
+import tracemalloc
 import datetime
+import collections
 import shutil
-import pandas as pd
+import io
+import json
+import bisect
+import queue
+import re
+import hashlib
+import sqlite3
+import tempfile
+import threading
+import asyncio
+import http.client
+import http.server
+import email.utils
+import urllib.parse
+import concurrent.futures
+import importlib.util
+
+def lazy_import(name):
+    """import a module the first time one of its names is used, instead of now"""
+    # pandas (and numpy) take most of a second to import, and the quick commands don't use them (i.e. 'ark.py status
+    # --online'); the first 'pd.' or 'np.' that runs imports them as usual.  The main program, the other commands of
+    # ark.py and ark_lookup.py import them with 'import_now' before anything is timed, so the import is not counted as
+    # part of the first step (or the lookup)
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    spec.loader = importlib.util.LazyLoader(spec.loader)
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    spec.loader.exec_module(module)
+    return module
+
+def import_now():
+    """finish the imports put off by 'lazy_import'; called before the steps are timed, and before pandas is used by
+    several threads at once, as two threads importing the same lazy module at the same time could each run its import"""
+    for module in (np, pd):
+        module.__name__
+
+np = lazy_import('numpy')
+pd = lazy_import('pandas')
 
 def tickers_list_urls_dictionary():
     # Call on 'ark_funds.txt' file and create a list of tickers and a dict of keys (ticker) and values (website)
@@ -16,21 +60,798 @@ def tickers_list_urls_dictionary():
             tickers.append(key)
     return tickers, urls
 
+# The type of each column of the archive files (and the same columns in the delta files), used by every loader.
+# 'fund' is the same on every row, so it is stored once as a category; 'date' is stored as a date instead of text.
+# 'company', 'ticker' and 'cusip' are different on almost every row, so a category would not save anything; they are
+# stored as pyarrow text (much smaller than python strings) if pyarrow is installed.  Rank fits in a small whole number;
+# shares, market value, weight and price stay 64 bit, as the % changes are worked out from them and have to come out
+# the same
+holdings_schema = {'date': 'date', 'fund': 'category', 'company': 'text', 'ticker': 'text', 'cusip': 'text',
+                   'shares': 'int64', 'market value($)': 'float64', 'weight(%)': 'float64', 'share price': 'float64',
+                   'rank': 'int16'}
+
+def text_type():
+    """pandas' pyarrow text type (a missing value stays NaN, as with python strings), or None without pyarrow"""
+    try:
+        import pyarrow
+        return pd.StringDtype('pyarrow', na_value=np.nan)
+    except (ImportError, TypeError):
+        return None
+
+def apply_holdings_schema(df):
+    """Change the columns of a loaded file to the 'holdings_schema' types; columns not in the schema are left as is"""
+    for heading, kind in holdings_schema.items():
+        if heading not in df.columns:
+            continue
+        if kind == 'date':
+            if not pd.api.types.is_datetime64_any_dtype(df[heading]):
+                df[heading] = pd.to_datetime(df[heading], format='%m/%d/%Y')
+        elif kind == 'category':
+            if not isinstance(df[heading].dtype, pd.CategoricalDtype):
+                df[heading] = df[heading].astype('category')
+        elif kind == 'text':
+            # newer versions of pandas already load text this way
+            if df[heading].dtype == object and text_type() is not None:
+                df[heading] = df[heading].astype(text_type())
+        # a whole number column is made smaller if every value fits; nothing else is changed, so a number column is
+        # never turned into decimals (or decimals into whole numbers) and the files are written back the same
+        elif pd.api.types.is_integer_dtype(df[heading]) and np.issubdtype(np.dtype(kind), np.integer) and \
+                len(df) and np.iinfo(kind).min <= df[heading].min() and df[heading].max() <= np.iinfo(kind).max:
+            df[heading] = df[heading].astype(kind)
+    return df
+
+@contextlib.contextmanager
+def atomic_file(filepath, append=False):
+    """Write a file in one step: gives the name of a temporary file to write, which is renamed to 'filepath' once it
+    has been written; if the program stops partway, 'filepath' is left as it was instead of half-written"""
+    # 'append' starts the temporary file from a copy of the file, to add to the end of it
+    temp_file = filepath + '.part'
+    if append and os.path.isfile(filepath):
+        shutil.copyfile(filepath, temp_file)
+    try:
+        yield temp_file
+    except BaseException:
+        if os.path.isfile(temp_file):
+            os.unlink(temp_file)
+        raise
+    os.replace(temp_file, filepath)
+
+class Holdings_store():
+    """Save and load the archive and delta files as csv files, or in a columnar format (parquet or feather)"""
+    # Columnar files keep each column's type, are compressed, and can load only the columns a step needs, which makes
+    # them several times faster to load than csv files.  csv files can still be exported with 'export_csv'
+    extensions = {'csv': '.csv', 'parquet': '.parquet', 'feather': '.feather'}
+
+    def __init__(self, file_format='csv', compression='zstd'):
+        if file_format not in self.extensions:
+            raise ValueError('Unknown file format: ' + file_format + '; use csv, parquet or feather')
+        # parquet and feather files need the optional 'pyarrow' package; csv files only need pandas
+        if file_format != 'csv':
+            try:
+                import pyarrow
+            except ImportError:
+                raise ImportError('The ' + file_format + ' file format needs pyarrow: pip install pyarrow')
+        self.file_format = file_format
+        self.extension = self.extensions[file_format]
+        self.compression = compression
+
+    def is_holdings_file(self, file_name):
+        """True for an archive or delta file in any of the formats (and not a half-written '.part' file)"""
+        return file_name.endswith(tuple(self.extensions.values()))
+
+    def exists(self, path):
+        """True if the file 'path' (without an extension) has been saved in any of the formats"""
+        return any(os.path.isfile(path + extension) for extension in self.extensions.values())
+
+    def save(self, df, path):
+        """Save the data frame to 'path' (without an extension); returns the full filepath"""
+        filepath = path + self.extension
+        # write to a temporary file first and then rename it, so there is never a half-written file
+        with atomic_file(filepath) as temp_file:
+            if self.file_format == 'csv':
+                df.to_csv(temp_file, index=False, date_format='%m/%d/%Y')
+            else:
+                # columnar files store the date as a date instead of text
+                if 'date' in df.columns and not pd.api.types.is_datetime64_any_dtype(df['date']):
+                    df = df.assign(date=pd.to_datetime(df['date'], format='%m/%d/%Y'))
+                if self.file_format == 'parquet':
+                    df.to_parquet(temp_file, index=False, compression=self.compression)
+                else:
+                    df.reset_index(drop=True).to_feather(temp_file, compression=self.compression)
+        return filepath
+
+    def read(self, filepath, columns=None):
+        """Read a file of any of the formats with pandas' default types (see 'load')"""
+        if filepath.endswith('.parquet'):
+            return pd.read_parquet(filepath, columns=columns)
+        if filepath.endswith('.feather'):
+            return pd.read_feather(filepath, columns=columns)
+        return pd.read_csv(filepath, usecols=columns)
+
+    def load(self, filepath, columns=None):
+        """Load a file of any of the formats with the 'holdings_schema' types; 'columns' is an optional list of the only
+        columns to load"""
+        if filepath.endswith('.csv'):
+            # the csv reader makes the categories as it reads, instead of making every string first
+            categories = {heading: 'category' for heading, kind in holdings_schema.items() if kind == 'category'}
+            return apply_holdings_schema(pd.read_csv(filepath, usecols=columns, dtype=categories))
+        return apply_holdings_schema(self.read(filepath, columns))
+
+    def memory_comparison(self, filepaths):
+        """Memory (bytes) the files take once loaded: {'default': with 'read', 'schema': with 'load'}"""
+        memory = {'default': 0, 'schema': 0}
+        for filepath in filepaths:
+            memory['default'] += int(self.read(filepath).memory_usage(deep=True).sum())
+            memory['schema'] += int(self.load(filepath).memory_usage(deep=True).sum())
+        return memory
+
+    def export_csv(self, filepath, csv_path=None):
+        """Export an archive or delta file to a csv file next to it (or to 'csv_path')"""
+        csv_path = csv_path or os.path.splitext(filepath)[0] + '.csv'
+        self.load(filepath).to_csv(csv_path, index=False, date_format='%m/%d/%Y')
+        return csv_path
+
+    def migrate(self, ticker, delete_csv=False):
+        """Convert the existing csv files in each fund's archive and delta folders to this store's format"""
+        converted = 0
+        for fund in ticker:
+            for sub_dir in ['archive', 'delta']:
+                directory = os.path.join(os.getcwd(), fund, sub_dir)
+                if not os.path.isdir(directory):
+                    continue
+                for file_name in sorted(os.listdir(directory)):
+                    if not file_name.endswith('.csv'):
+                        continue
+                    path = os.path.join(directory, file_name[:-4])
+                    if not os.path.isfile(path + self.extension):
+                        # 'round_trip' reads every number back exactly as it was written, so nothing is lost
+                        self.save(pd.read_csv(path + '.csv', float_precision='round_trip'), path)
+                        converted += 1
+                    if delete_csv:
+                        os.unlink(path + '.csv')
+            # the fund's manifest has to point at the converted files
+            Archive_manifest(fund).rebuild()
+        print('Converted ' + str(converted) + ' csv files to ' + self.file_format)
+        return converted
+
+# The format used for the archive and delta files; the main program can swap in a different store
+store = Holdings_store('csv')
+
+class Pipeline_metrics():
+    """Wall time, CPU time, peak memory, rows, bytes read/written and file opens of each step of the program, and of
+    each fund within a step"""
+    # Used as 'with metrics.stage('ingest', fund) as stage:', and 'stage['rows']' is set to the rows processed.  A stage
+    # inside another stage (a fund inside a step) is also counted in the outer stage.  Files are counted with an audit
+    # hook on every 'open' (pandas csv files, pickles, the manifest...); files read or written by pyarrow (parquet,
+    # feather) are not seen.  Peak memory uses tracemalloc, which slows the program down, so it is only measured when
+    # 'memory' is True; it is the most python memory in use at once since the outermost stage started
+    open_stages = []
+    hook_installed = False
+
+    def __init__(self, enabled=True, memory=False):
+        self.enabled = enabled
+        self.memory = memory
+        self.records = []
+        if enabled and not Pipeline_metrics.hook_installed:
+            # an audit hook can't be removed, so it is added once and does nothing while no stage is being measured
+            sys.addaudithook(Pipeline_metrics.audit_hook)
+            Pipeline_metrics.hook_installed = True
+
+    @staticmethod
+    def audit_hook(event, args):
+        if not Pipeline_metrics.open_stages:
+            return
+        if event == 'open':
+            Pipeline_metrics.file_opened(*args[:3])
+        elif event == 'os.rename':
+            # a file written as '.part' and then renamed is counted by its new name
+            for record, written in Pipeline_metrics.open_stages:
+                if args[0] in written:
+                    written.discard(args[0])
+                    written.add(args[1])
+
+    @staticmethod
+    def file_opened(path, mode, flags):
+        if not isinstance(path, (str, bytes, os.PathLike)):
+            # a file descriptor of a file that is already open
+            return
+        if isinstance(mode, str):
+            writing = any(letter in mode for letter in 'wax+')
+        else:
+            writing = bool(flags & (os.O_WRONLY | os.O_RDWR))
+        size = 0
+        if not writing:
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                pass
+        for record, written in Pipeline_metrics.open_stages:
+            record['file_opens'] += 1
+            if writing:
+                written.add(path)
+            else:
+                record['bytes_read'] += size
+
+    def note_peak(self):
+        """the peak memory so far counts towards every stage that is being measured"""
+        peak = tracemalloc.get_traced_memory()[1]
+        for record, written in Pipeline_metrics.open_stages:
+            record['peak_memory_bytes'] = max(record['peak_memory_bytes'], peak)
+
+    @contextlib.contextmanager
+    def stage(self, name, fund=None):
+        """measure the code inside the 'with' block as the stage 'name' (of the fund 'fund')"""
+        if not self.enabled:
+            yield {}
+            return
+        record = {'stage': name, 'fund': fund, 'rows': 0, 'wall_seconds': 0.0, 'cpu_seconds': 0.0,
+                  'peak_memory_bytes': 0, 'bytes_read': 0, 'bytes_written': 0, 'file_opens': 0}
+        written = set()
+        if self.memory:
+            if not tracemalloc.is_tracing():
+                tracemalloc.start()
+            # the peak is reset for this stage, so the stages it is inside are given the peak so far first
+            self.note_peak()
+            tracemalloc.reset_peak()
+        Pipeline_metrics.open_stages.append((record, written))
+        wall_start = time.perf_counter()
+        cpu_start = time.process_time()
+        try:
+            yield record
+        finally:
+            record['wall_seconds'] = round(time.perf_counter() - wall_start, 6)
+            record['cpu_seconds'] = round(time.process_time() - cpu_start, 6)
+            if self.memory:
+                self.note_peak()
+            Pipeline_metrics.open_stages.pop()
+            # the rows of a fund also count towards the step it is in
+            for outer_record, outer_written in Pipeline_metrics.open_stages:
+                outer_record['rows'] += record['rows']
+            if self.memory and not Pipeline_metrics.open_stages:
+                tracemalloc.stop()
+            for path in written:
+                try:
+                    record['bytes_written'] += os.path.getsize(path)
+                except OSError:
+                    pass
+            record['time'] = datetime.datetime.now().isoformat(timespec='seconds')
+            self.records.append(record)
+
+    def write(self, metrics_file):
+        """add the records to 'metrics_file', one JSON line per stage"""
+        with open(metrics_file, 'a') as file:
+            file.write(''.join(json.dumps(record) + '\n' for record in self.records))
+
+    def write_prometheus(self, prometheus_file):
+        """write the records in the Prometheus text format, i.e. for the node exporter's textfile collector"""
+        # a stage that ran more than once is added up (the peak memory is the largest)
+        metric_names = {'wall_seconds': 'wall time', 'cpu_seconds': 'CPU time', 'peak_memory_bytes': 'peak memory',
+                        'rows': 'rows processed', 'bytes_read': 'bytes read', 'bytes_written': 'bytes written',
+                        'file_opens': 'files opened'}
+        totals = {}
+        for record in self.records:
+            labels = 'stage="{}",fund="{}"'.format(record['stage'], record['fund'] or '')
+            total = totals.setdefault(labels, dict.fromkeys(metric_names, 0))
+            for metric in metric_names:
+                if metric == 'peak_memory_bytes':
+                    total[metric] = max(total[metric], record[metric])
+                else:
+                    total[metric] += record[metric]
+        lines = []
+        for metric, description in metric_names.items():
+            lines += ['# HELP ark_stage_' + metric + ' ' + description + ' of each step of the program',
+                      '# TYPE ark_stage_' + metric + ' gauge']
+            lines += ['ark_stage_{}{{{}}} {}'.format(metric, labels, round(total[metric], 6))
+                      for labels, total in totals.items()]
+        with atomic_file(prometheus_file) as temp_file:
+            with open(temp_file, 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+
+    def report(self):
+        """a short table of the steps (not the funds) for the screen"""
+        lines = []
+        for record in self.records:
+            if record['fund'] is None:
+                lines.append('\t{:<22}{:>9.3f}s wall{:>9.3f}s cpu{:>10} rows{:>7} files'.format(
+                    record['stage'], record['wall_seconds'], record['cpu_seconds'], record['rows'],
+                    record['file_opens']))
+        return '\n'.join(lines)
+
+# The measurements of this run; the main program swaps in an enabled one
+metrics = Pipeline_metrics(enabled=False)
+
+def file_hash(filepath):
+    """sha256 hash of a file's contents; two files with the same hash have the same contents"""
+    sha256 = hashlib.sha256()
+    with open(filepath, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class Archive_manifest():
+    """A record of each fund's archive and delta files, so files can be looked up without listing the folders"""
+    # The manifest is saved as 'FUND/manifest.json'. For each folder ('archive' and 'delta') it has a dictionary of
+    # 'YYYY_MM_DD':{'file', 'rows', 'sha256'}. The ingest step and 'ark_data_frames' add each new file as it is saved
+    # Each step makes its own 'Archive_manifest(fund)', so the manifests read (or saved) in this process are kept in
+    # 'loaded' by file, with the file's modified time and size; the file is only read and sorted again if it changed
+    # since (i.e. another process saved it).  Each manifest gets its own copy, as a step may keep the dates from
+    # before it adds a file
+    loaded = {}
+
+    def __init__(self, fund):
+        self.fund = fund
+        self.fund_dir = os.path.join(os.getcwd(), fund)
+        self.manifest_file = os.path.join(self.fund_dir, 'manifest.json')
+        cached = self.loaded.get(self.manifest_file)
+        if cached is not None and cached[0] == self.version():
+            self.entries = {kind: dict(entries) for kind, entries in cached[1].items()}
+            self.dates = {kind: list(dates) for kind, dates in cached[2].items()}
+            return
+        if os.path.isfile(self.manifest_file):
+            with open(self.manifest_file, 'r') as file:
+                self.entries = json.load(file)
+        else:
+            # first run with a manifest: record the files that are already in the folders
+            self.rebuild()
+        # a sorted list of the dates in each folder; 'latest' is the last item, and date ranges are found by bisection
+        self.dates = {kind: sorted(entries) for kind, entries in self.entries.items()}
+        self.remember()
+
+    def version(self):
+        """(modified time, size) of the manifest file, or None if there is no file"""
+        try:
+            stat = os.stat(self.manifest_file)
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def remember(self):
+        """keep the manifest in 'loaded', as it is in the file now"""
+        version = self.version()
+        if version is not None:
+            self.loaded[self.manifest_file] = (version, {kind: dict(entries) for kind, entries in self.entries.items()},
+                                               {kind: list(dates) for kind, dates in self.dates.items()})
+
+    def date_of(self, kind, file_name):
+        """the YYYY_MM_DD date of a 'FUND_YYYY_MM_DD.csv' or 'FUND_YYYY_MM_DD_delta.csv' file, None for other files"""
+        return self.date_of_file(self.fund, kind, file_name)
+
+    @staticmethod
+    def date_of_file(fund, kind, file_name):
+        """'date_of' for any fund, without reading its manifest"""
+        name, extension = os.path.splitext(file_name)
+        suffix = '_delta' if kind == 'delta' else ''
+        # the fund must match exactly; 'ARKK_...' is not a file of a fund called 'ARK'
+        if extension not in store.extensions.values() or not name.startswith(fund + '_') or \
+                not name.endswith(suffix):
+            return None
+        date = name[len(fund) + 1:len(name) - len(suffix)]
+        try:
+            datetime.datetime.strptime(date, '%Y_%m_%d')
+        except ValueError:
+            return None
+        return date
+
+    def rebuild(self):
+        """record every file in the archive and delta folders (only needed once, or if files were copied in by hand)"""
+        self.entries = {'archive': {}, 'delta': {}}
+        for kind in self.entries:
+            directory = os.path.join(self.fund_dir, kind)
+            if not os.path.isdir(directory):
+                continue
+            # if a date was saved in more than one format, the file in the store's current format is recorded
+            for file_name in sorted(os.listdir(directory), key=lambda x: x.endswith(store.extension)):
+                date = self.date_of(kind, file_name)
+                if date is not None:
+                    filepath = os.path.join(directory, file_name)
+                    self.record(kind, date, filepath, len(store.load(filepath, columns=['cusip'])))
+        self.dates = {kind: sorted(entries) for kind, entries in self.entries.items()}
+        self.save()
+
+    def record(self, kind, date, filepath, rows):
+        self.entries[kind][date] = {'file': os.path.basename(filepath), 'rows': rows, 'sha256': file_hash(filepath)}
+
+    def add(self, kind, date, filepath, rows):
+        """record a newly saved file, and save the manifest"""
+        self.record(kind, date, filepath, rows)
+        dates = self.dates[kind]
+        position = bisect.bisect_left(dates, date)
+        if position == len(dates) or dates[position] != date:
+            dates.insert(position, date)
+        self.save()
+
+    def add_many(self, kind, files):
+        """record a batch of newly saved files, a list of (date, filepath, rows), and save the manifest once"""
+        for date, filepath, rows in files:
+            self.record(kind, date, filepath, rows)
+        self.dates[kind] = sorted(self.entries[kind])
+        self.save()
+
+    def save(self):
+        if not os.path.isdir(self.fund_dir):
+            return
+        # write to a temporary file first and then rename it, so there is never a half-written manifest
+        with atomic_file(self.manifest_file) as temp_file:
+            with open(temp_file, 'w') as file:
+                json.dump(self.entries, file, indent=1, sort_keys=True)
+        self.remember()
+
+    def path(self, kind, date):
+        return os.path.join(self.fund_dir, kind, self.entries[kind][date]['file'])
+
+    def latest(self, kind='archive'):
+        """filepath of the latest file; IndexError if there are no files"""
+        return self.path(kind, self.dates[kind][-1])
+
+    def previous(self, kind='archive'):
+        """filepath of the second latest file; IndexError if there is only one file"""
+        return self.path(kind, self.dates[kind][-2])
+
+    def date_range(self, kind='archive', start='0000_00_00', end='9999_99_99'):
+        """list of (date, filepath) for every file dated from 'start' to 'end' (YYYY_MM_DD), oldest first"""
+        dates = self.dates[kind]
+        first = bisect.bisect_left(dates, start)
+        last = bisect.bisect_right(dates, end)
+        return [(date, self.path(kind, date)) for date in dates[first:last]]
+
+class Snapshot_repository():
+    """Each fund's archive files loaded once per run and handed to every step that needs them"""
+    # The steps used to load the same today and yesterday files again and again ('ark_data_frames',
+    # 'fund_sum_market_value', 'stocks_added_or_removed').  Frames are kept by (fund, date), and at most
+    # 'max_snapshots' are kept; the one used least recently is dropped first.  The steps share the same frame, so a
+    # step must not change a frame it was given (adding columns to a copy is fine).  A file that changed on disk since
+    # it was loaded is loaded again
+    def __init__(self, max_snapshots=64):
+        self.max_snapshots = max_snapshots
+        self.frames = collections.OrderedDict()
+        self.loads = 0
+        self.hits = 0
+
+    def key(self, filepath):
+        """(fund, date) of an archive file 'FUND/archive/FUND_YYYY_MM_DD.csv', or the filepath for any other file"""
+        fund = os.path.basename(os.path.dirname(os.path.dirname(os.path.abspath(filepath))))
+        date = Archive_manifest.date_of_file(fund, 'archive', os.path.basename(filepath))
+        return filepath if date is None else (fund, date)
+
+    def load(self, filepath, columns=None):
+        """the file's data frame (only 'columns' if given), loaded from disk the first time it is asked for"""
+        key = self.key(filepath)
+        stat = os.stat(filepath)
+        version = (filepath, stat.st_mtime_ns, stat.st_size)
+        if key in self.frames and self.frames[key][0] == version:
+            self.frames.move_to_end(key)
+            self.hits += 1
+        else:
+            self.frames[key] = (version, store.load(filepath))
+            self.loads += 1
+            if len(self.frames) > self.max_snapshots:
+                self.frames.popitem(last=False)
+        df = self.frames[key][1]
+        return df if columns is None else df[columns]
+
+    def snapshot(self, fund, date):
+        """the data frame of a fund's archive file for a date (YYYY_MM_DD)"""
+        manifest = Archive_manifest(fund)
+        if date in manifest.entries['archive']:
+            return self.load(manifest.path('archive', date))
+        # a date whose archive file was pruned after it was packed (see 'pack_archive') is unpacked
+        key = (fund, date)
+        if key in self.frames and self.frames[key][0] is None:
+            self.frames.move_to_end(key)
+            self.hits += 1
+        else:
+            self.frames[key] = (None, Packed_archive(fund).snapshot(date))
+            self.loads += 1
+            if len(self.frames) > self.max_snapshots:
+                self.frames.popitem(last=False)
+        return self.frames[key][1]
+
+# The archive files loaded in this run
+snapshots = Snapshot_repository()
+
+def holding_keys(df):
+    """the label of each stock of an archive or delta file, 'CUSIP#0' (or 'CUSIP#1' for the second row with the same
+    CUSIP), so each row of a file has its own label, and the same label from one date to the next"""
+    cusip = df['cusip'].astype(object).fillna('').astype(str).to_numpy(dtype=object)
+    repeat = df.groupby(cusip, sort=False).cumcount().astype(str).to_numpy(dtype=object)
+    return cusip + '#' + repeat
+
+class Packed_archive():
+    """A fund's archive saved as a full file (a keyframe) every 'keyframe_every' dates, and only the rows that changed
+    from one date to the next in between; much smaller than a full file for every date, and a run of dates is read by
+    updating the date before instead of loading each date's full file"""
+    # The files are in 'FUND/packed': 'FUND_YYYY_MM_DD_key' is a full archive file, and 'FUND_YYYY_MM_DD_diff' has a row
+    # for each stock that was added, removed or changed since the date before.  A stock is found by its CUSIP ('key' is
+    # 'CUSIP#0', or 'CUSIP#1' for the second row with the same CUSIP).  'changed' has a bit for each column that changed
+    # and only those columns have a value; a stock that wasn't in the date before is added, and a row with no bits is
+    # a stock that was removed.  The rows are put back in order by rank.  'date' and 'fund' are the same on every row,
+    # so they are kept once in 'packed.json', with the list of dates.  Each date is unpacked again as it is packed, and
+    # if it doesn't come out exactly the same as the archive file, a keyframe is saved instead
+    constant_columns = ['date', 'fund']
+    derived_columns = ['share price', 'weight(%)', 'rank']
+
+    def __init__(self, fund, keyframe_every=20, packed_dir=None):
+        self.fund = fund
+        self.packed_dir = packed_dir or os.path.join(os.getcwd(), fund, 'packed')
+        self.index_file = os.path.join(self.packed_dir, 'packed.json')
+        if os.path.isfile(self.index_file):
+            with open(self.index_file, 'r') as file:
+                self.index = json.load(file)
+        else:
+            self.index = {'keyframe_every': keyframe_every, 'columns': None, 'dates': {}}
+        self.dates = sorted(self.index['dates'])
+        # the stocks of the last date packed (by key), so the next date is compared to it without unpacking it again
+        self.last = None
+
+    @staticmethod
+    def constants(df):
+        """the 'date' (MM/DD/YYYY) and 'fund' that are the same on every row, or None if they are not"""
+        if len(df) == 0 or df[Packed_archive.constant_columns].nunique(dropna=False).max() != 1 or \
+                df[Packed_archive.constant_columns].iloc[0].isna().any():
+            return None
+        date = df['date'].iloc[0]
+        return {'date': date.strftime('%m/%d/%Y') if hasattr(date, 'strftime') else str(date),
+                'fund': str(df['fund'].iloc[0])}
+
+    @staticmethod
+    def keyed(df):
+        """the stocks of an archive file (without 'date' and 'fund'): a dictionary of each column's values, and 'key',
+        the label of each stock, 'CUSIP#n'"""
+        # numpy arrays instead of a data frame, as pandas takes longer to change a few values than numpy; the text
+        # columns stay as pandas text, as they hardly ever change and turning them into pandas text takes longer
+        state = {heading: df[heading].array if df[heading].dtype == text_type() else df[heading].to_numpy()
+                 for heading in df.columns if heading not in Packed_archive.constant_columns}
+        state['key'] = holding_keys(df)
+        return state
+
+    def unkeyed(self, state, entry):
+        """the archive file of a date, from its stocks (see 'keyed') and its 'date' and 'fund'"""
+        order = np.argsort(state['rank'], kind='stable')
+        columns = {}
+        for heading in self.index['columns']:
+            if heading == 'date':
+                columns[heading] = pd.to_datetime([entry['constants']['date']], format='%m/%d/%Y').repeat(len(order))
+            elif heading == 'fund':
+                columns[heading] = pd.Categorical.from_codes(np.zeros(len(order), dtype='int8'),
+                                                             [entry['constants']['fund']])
+            else:
+                columns[heading] = state[heading][order]
+        return apply_holdings_schema(pd.DataFrame(columns))
+
+    @staticmethod
+    def derived(state):
+        """the share price, weight and rank of each stock worked out from its market value (as in the ingest step)"""
+        market_value = state['market value($)']
+        # 'fsum' adds up the same total whatever order the rows are in
+        total = math.fsum(market_value)
+        # rank is the order by market value; stocks with the same market value are put in order by key, so the rank
+        # comes out the same whatever order the rows are in
+        rank = np.empty(len(market_value), dtype=state['rank'].dtype)
+        order = np.argsort(-market_value, kind='stable')
+        if (market_value[order][1:] == market_value[order][:-1]).any():
+            order = np.lexsort((state['key'], -market_value))
+        rank[order] = np.arange(101, 101 + len(market_value))
+        return {'share price': np.round(market_value / state['shares'], 2),
+                'weight(%)': np.round(100 * market_value / total, 2) if total else np.full(len(market_value), np.nan),
+                'rank': rank}
+
+    def diff(self, state, new):
+        """the rows of a diff file: the stocks of 'new' that were added, removed or changed since 'state' (both from
+        'keyed')"""
+        # The price, weight and rank of almost every stock change every day, but they follow from the market value:
+        # their bit is only set where the value is not the one worked out from the market value (see 'derived')
+        columns = [heading for heading in new if heading != 'key']
+        derived = self.derived(new)
+        position = pd.Index(state['key'], dtype=object).get_indexer(new['key'])
+        held = position >= 0
+        changed = np.where(held, 0, 2 ** len(columns) - 1)
+        for bit, heading in enumerate(columns):
+            if heading in derived:
+                values, old, rows = new[heading], derived[heading], np.ones(len(held), dtype=bool)
+            else:
+                values, old, rows = new[heading][held], state[heading][position[held]], held
+            # a missing value on both sides is not a change
+            changed[rows] |= ((values != old) & ~(pd.isna(values) & pd.isna(old))).astype('int64') << bit
+        rows = changed != 0
+        bits = changed[rows]
+        diff_df = pd.DataFrame({'key': new['key'][rows], 'changed': bits})
+        for bit, heading in enumerate(columns):
+            diff_df[heading] = pd.Series(new[heading][rows]).where((bits >> bit) & 1 == 1)
+        removed = state['key'][pd.Index(new['key'], dtype=object).get_indexer(state['key']) < 0]
+        if len(removed):
+            diff_df = pd.concat([diff_df, pd.DataFrame({'key': removed, 'changed': 0})], ignore_index=True)
+        return diff_df
+
+    def apply(self, state, diff_df):
+        """the stocks of the next date: 'state' (see 'keyed') with the rows of a diff file added, removed and changed"""
+        columns = [heading for heading in state if heading != 'key']
+        diff = {heading: diff_df[heading].to_numpy() for heading in diff_df.columns}
+        changed = diff['changed'].astype('int64')
+        keys = diff['key'].astype(object)
+        # the removed stocks are left out of a copy of every column; the keys are looked up as python strings, which is
+        # quicker than turning them into pandas text first
+        removed = changed == 0
+        if removed.any():
+            kept = pd.Index(keys[removed], dtype=object).get_indexer(state['key']) < 0
+            state = {heading: values[kept] for heading, values in state.items()}
+        else:
+            state = {heading: values.copy() for heading, values in state.items()}
+        position = pd.Index(state['key'], dtype=object).get_indexer(keys)
+        added = (position < 0) & (changed != 0)
+        if added.any():
+            for heading, values in state.items():
+                new = pd.array(diff[heading][added], dtype=values.dtype)
+                if isinstance(values, np.ndarray):
+                    state[heading] = np.concatenate([values, new])
+                else:
+                    state[heading] = type(values)._concat_same_type([values, new])
+            position = pd.Index(state['key'], dtype=object).get_indexer(keys)
+        for bit, heading in enumerate(columns):
+            # the price, weight and rank are worked out once the market values of the date are in place
+            if heading not in self.derived_columns:
+                rows = ~added & ((changed >> bit) & 1 == 1)
+                if rows.any():
+                    state[heading][position[rows]] = pd.array(diff[heading][rows], dtype=state[heading].dtype)
+        derived = self.derived(state)
+        for bit, heading in enumerate(columns):
+            if heading in derived:
+                rows = (changed >> bit) & 1 == 1
+                derived[heading][position[rows]] = diff[heading][rows].astype(state[heading].dtype)
+                state[heading] = derived[heading]
+        return state
+
+    def read_diff(self, filepath):
+        if filepath.endswith('.csv'):
+            # 'round_trip' reads every number back exactly as it was written; the text is read as python strings, which
+            # 'apply' looks up and changes quicker than pandas text
+            text = {heading: object for heading, kind in holdings_schema.items() if kind == 'text'}
+            return pd.read_csv(filepath, dtype=dict(text, key=object), float_precision='round_trip')
+        return store.read(filepath)
+
+    def filepath(self, date):
+        return os.path.join(self.packed_dir, self.index['dates'][date]['file'])
+
+    def states(self, start='0000_00_00', end='9999_99_99'):
+        """(date, stocks, archive file) of each date from 'start' to 'end'; the stocks are None for a keyframe that
+        can't be unpacked into stocks (its 'date' or 'fund' is not the same on every row)"""
+        keyframes = [date for date in self.dates if self.index['dates'][date]['keyframe']]
+        first = keyframes[max(bisect.bisect_right(keyframes, start) - 1, 0)]
+        state = None
+        for date in self.dates[self.dates.index(first):bisect.bisect_right(self.dates, end)]:
+            entry = self.index['dates'][date]
+            if entry['keyframe']:
+                df = store.load(self.filepath(date))
+                state = None if entry['constants'] is None else self.keyed(df)
+            else:
+                state = self.apply(state, self.read_diff(self.filepath(date)))
+                df = None
+            if date >= start:
+                yield date, state, df if df is not None else self.unkeyed(state, entry)
+
+    def replay(self, start='0000_00_00', end='9999_99_99'):
+        """(date, data frame) of each archive file from 'start' to 'end' (YYYY_MM_DD), oldest first; each date is worked
+        out from the date before, starting from the last keyframe before 'start'"""
+        for date, state, df in self.states(start, end):
+            yield date, df
+
+    def snapshot(self, date):
+        """the archive file of a date (YYYY_MM_DD), unpacked; KeyError if the date wasn't packed"""
+        if date not in self.index['dates']:
+            raise KeyError(self.fund + ' ' + date + ' is not in the packed archive')
+        for packed_date, df in self.replay(date, date):
+            return df
+
+    def add(self, date, df):
+        """pack the archive file of a date after the last date packed (to pack an earlier date, see 'pack_archive')"""
+        if self.dates and date <= self.dates[-1]:
+            raise ValueError(self.fund + ' ' + date + ' is not after the last packed date ' + self.dates[-1])
+        if not os.path.isdir(self.packed_dir):
+            os.makedirs(self.packed_dir)
+        if self.index['columns'] is None:
+            self.index['columns'] = list(df.columns)
+        if self.last is None and self.dates:
+            for packed_date, self.last, packed_df in self.states(self.dates[-1]):
+                pass
+        entry = {'keyframe': False, 'constants': self.constants(df), 'rows': len(df)}
+        keyframes = [x for x, packed_date in enumerate(self.dates) if self.index['dates'][packed_date]['keyframe']]
+        since_keyframe = len(self.dates) - 1 - max(keyframes, default=-1)
+        path = os.path.join(self.packed_dir, self.fund + '_' + date)
+        filepath = None
+        if self.last is not None and entry['constants'] is not None and list(df.columns) == self.index['columns'] \
+                and since_keyframe + 1 < self.index['keyframe_every']:
+            # unpack the saved file and check that it is the same as the archive file
+            try:
+                filepath = store.save(self.diff(self.last, self.keyed(df)), path + '_diff')
+                state = self.apply(self.last, self.read_diff(filepath))
+                same = self.unkeyed(state, entry).equals(df)
+            except (ValueError, TypeError, KeyError):
+                same = False
+            if not same:
+                if filepath is not None:
+                    os.unlink(filepath)
+                filepath = None
+        if filepath is None:
+            entry['keyframe'] = True
+            filepath = store.save(df, path + '_key')
+            state = None if entry['constants'] is None else self.keyed(df)
+        entry['file'] = os.path.basename(filepath)
+        self.index['dates'][date] = entry
+        self.dates.append(date)
+        self.last = state
+        self.save()
+
+    def save(self):
+        # write to a temporary file first and then rename it, so there is never a half-written index
+        with atomic_file(self.index_file) as temp_file:
+            with open(temp_file, 'w') as file:
+                json.dump(self.index, file, indent=1, sort_keys=True)
+
+    def size(self):
+        """the number of bytes of the packed files"""
+        return sum(os.path.getsize(self.filepath(date)) for date in self.dates)
+
+def pack_archive(ticker, keyframe_every=20, prune=False, keep=2):
+    """Pack each fund's archive files into 'FUND/packed' (see 'Packed_archive'); only dates not packed yet are added"""
+    # 'prune' deletes the full archive files of the packed dates, except the latest 'keep' (the next run compares today
+    # with them); the pruned dates are still loaded by 'snapshots.snapshot', and 'unpack_archive' puts the files back
+    for fund in ticker:
+        manifest = Archive_manifest(fund)
+        packed = Packed_archive(fund, keyframe_every)
+        archive = dict(manifest.date_range('archive'))
+        new_dates = sorted(set(archive) - set(packed.dates))
+        if new_dates and packed.dates and new_dates[0] < packed.dates[-1]:
+            # a date earlier than the last packed date: every date is packed again into a new folder, with the dates
+            # whose archive file was pruned taken from the old packed files
+            repacked = Packed_archive(fund, keyframe_every, packed.packed_dir + '_new')
+            shutil.rmtree(repacked.packed_dir, ignore_errors=True)
+            old = packed.replay()
+            for date in sorted(set(archive) | set(packed.dates)):
+                if date in packed.index['dates']:
+                    packed_date, df = next(old)
+                if date in archive:
+                    df = store.load(archive[date])
+                repacked.add(date, df)
+            shutil.rmtree(packed.packed_dir)
+            os.replace(repacked.packed_dir, packed.packed_dir)
+            packed = Packed_archive(fund)
+        else:
+            for date in new_dates:
+                packed.add(date, store.load(archive[date]))
+        if prune:
+            for date in list(archive)[:-keep or None]:
+                if date in packed.index['dates']:
+                    os.unlink(archive[date])
+                    del manifest.entries['archive'][date]
+            manifest.dates['archive'] = sorted(manifest.entries['archive'])
+            manifest.save()
+        print('{}: {} dates packed, {} keyframes, {:,.0f} KB'.format(
+            fund, len(packed.dates), sum(entry['keyframe'] for entry in packed.index['dates'].values()),
+            packed.size() / 1024))
+
+def unpack_archive(ticker, start='0000_00_00', end='9999_99_99'):
+    """Save the archive files of the packed dates from 'start' to 'end' whose archive file was pruned"""
+    for fund in ticker:
+        manifest = Archive_manifest(fund)
+        files = []
+        for date, df in Packed_archive(fund).replay(start, end):
+            if date not in manifest.entries['archive']:
+                path = os.path.join(manifest.fund_dir, 'archive', fund + '_' + date)
+                files.append((date, store.save(df, path), len(df)))
+        manifest.add_many('archive', files)
+        print('Unpacked ' + str(len(files)) + ' ' + fund + ' archive files')
+
 class Grab_files_from_internet():
     """Get csv files form ARK website, and do initial formatting of the files"""
     def __init__(self, urls):
         self.urls = urls
 
-    def get_csv(self):
-        # Download ARK ETF files from the Ark-Invest website
-        for ticker, url in self.urls.items():
-            print("PROCESSING {}".format(ticker))
-
-            ticker_filename = ticker + ".csv"
-            dl_folder = os.path.join(os.getcwd(), ticker_filename)
-
-            dl_cmd = 'curl -o {} {}'.format(dl_folder, url)
-            os.system(dl_cmd)
+    def get_csv(self, workers=4):
+        """Download ARK ETF files from the Ark-Invest website, all funds at the same time"""
+        status = Holdings_downloader(self.urls, workers=workers).download_all()
+        failed = [ticker for ticker, result in status.items() if result == 'failed']
+        if failed:
+            raise RuntimeError('Could not download the csv file for: ' + ', '.join(failed))
+        return status
 
     def get_date_rename_file(self):
         """Grab date from within the file for proper date labeling and rename the file"""
@@ -52,6 +873,254 @@ class Grab_files_from_internet():
             shutil.move(ticker + '.csv', new_file_name)
         return self.file_date_dict
 
+class Holdings_downloader():
+    """Download the csv files concurrently over a pool of reusable connections, skipping files that haven't changed"""
+    # ARK's website turns away requests that don't look like they came from a browser or curl
+    user_agent = 'curl/7.68.0'
+
+    def __init__(self, urls, workers=4, timeout=30, retries=3, backoff=1.0, dest_dir=None, cache_dir=None):
+        self.urls = urls
+        # at most 'workers' files are downloaded at once, and at most 'workers' connections are kept open per website
+        self.workers = workers
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.dest_dir = dest_dir or os.getcwd()
+        # the cache keeps the last copy of each file plus its ETag/Last-Modified headers; when ARK answers
+        # '304 Not Modified' the cached copy is used instead of downloading the same file again
+        self.cache_dir = cache_dir or os.path.join(os.getcwd(), 'download_cache')
+        self.validators_file = os.path.join(self.cache_dir, 'validators.json')
+        self.pool = {}
+        self.pool_lock = threading.Lock()
+
+    def download_all(self):
+        """Download every file; returns a dictionary of 'ticker':'downloaded'/'not modified'/'failed'"""
+        validators = self.load_validators()
+        status = {}
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {executor.submit(self.fetch, ticker, url, validators.get(ticker, {})): ticker
+                       for ticker, url in self.urls.items()}
+            for future in concurrent.futures.as_completed(futures):
+                ticker = futures[future]
+                status[ticker], headers = future.result()
+                if headers:
+                    validators[ticker] = headers
+                print("PROCESSING {}: {}".format(ticker, status[ticker]))
+        self.save_validators(validators)
+        self.close_connections()
+        return status
+
+    def load_validators(self):
+        """the ETag/Last-Modified headers of each cached file, by ticker"""
+        if not os.path.exists(self.cache_dir):
+            os.mkdir(self.cache_dir)
+        if os.path.isfile(self.validators_file):
+            with open(self.validators_file, 'r') as file:
+                return json.load(file)
+        return {}
+
+    def save_validators(self, validators):
+        with atomic_file(self.validators_file) as temp_file:
+            with open(temp_file, 'w') as file:
+                json.dump(validators, file, indent=1)
+
+    def close_connections(self):
+        for connections in self.pool.values():
+            while not connections.empty():
+                connections.get().close()
+
+    def fetch(self, ticker, url, validators, copy_not_modified=True):
+        """Download one file, retrying with a growing wait (backoff) if the website or network fails"""
+        # 'copy_not_modified' copies the cached file to TICKER.csv when the file hasn't changed, as if downloaded
+        parts, path = self.split_url(url)
+        cached_file = os.path.join(self.cache_dir, ticker + '.csv')
+        headers = {'User-Agent': self.user_agent, 'Accept-Encoding': 'identity'}
+        # only ask 'has this changed?' when the cached copy from the same url is still around
+        if validators.get('url') == url and os.path.isfile(cached_file):
+            if validators.get('etag'):
+                headers['If-None-Match'] = validators['etag']
+            if validators.get('last_modified'):
+                headers['If-Modified-Since'] = validators['last_modified']
+
+        for attempt in range(self.retries + 1):
+            if attempt:
+                time.sleep(self.backoff * 2 ** (attempt - 1))
+            connection = self.get_connection(parts)
+            try:
+                connection.request('GET', path, headers=headers)
+                response = connection.getresponse()
+                body = response.read()
+            except (OSError, http.client.HTTPException) as error:
+                print("{}: download attempt {} failed ({})".format(ticker, attempt + 1, error))
+                connection.close()
+                continue
+            self.return_connection(parts, connection)
+
+            if response.status == 304:
+                if copy_not_modified:
+                    self.save_file(ticker, cached_file)
+                return 'not modified', validators
+            if response.status == 200:
+                # a half-written copy would be kept as 'not modified' the next time
+                with atomic_file(cached_file) as temp_file:
+                    with open(temp_file, 'wb') as file:
+                        file.write(body)
+                self.save_file(ticker, cached_file)
+                return 'downloaded', {'url': url, 'etag': response.getheader('ETag'),
+                                      'last_modified': response.getheader('Last-Modified')}
+            print("{}: download attempt {} failed (HTTP {})".format(ticker, attempt + 1, response.status))
+            # anything other than a server error or 'too many requests' won't be fixed by trying again
+            if response.status < 500 and response.status != 429:
+                break
+        return 'failed', None
+
+    @staticmethod
+    def split_url(url):
+        """the parts of a url (scheme, website...) and the path to ask the website for"""
+        # the urls in 'ark_funds.txt' were written for the Windows command line, where '&' is escaped as '^&'
+        parts = urllib.parse.urlsplit(url.replace('^&', '&'))
+        return parts, urllib.parse.quote(parts.path) + ('?' + parts.query if parts.query else '')
+
+    def check(self):
+        """Ask the website whether each file has changed since it was last downloaded, without downloading it;
+        returns a dictionary of 'ticker':('new file'/'not modified'/'failed', the file's Last-Modified date)"""
+        validators = self.load_validators()
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.workers) as executor:
+            futures = {ticker: executor.submit(self.check_file, url, validators.get(ticker, {}))
+                       for ticker, url in self.urls.items()}
+        self.close_connections()
+        return {ticker: future.result() for ticker, future in futures.items()}
+
+    def check_file(self, url, validators):
+        """'check' one file with a HEAD request (only the headers of the file); no retries, as nothing is lost"""
+        parts, path = self.split_url(url)
+        connection = self.get_connection(parts)
+        try:
+            connection.request('HEAD', path, headers={'User-Agent': self.user_agent})
+            response = connection.getresponse()
+            response.read()
+        except (OSError, http.client.HTTPException):
+            connection.close()
+            return 'failed', None
+        self.return_connection(parts, connection)
+        if response.status != 200:
+            return 'failed', None
+        # the headers are compared here rather than sent as If-None-Match, as some websites ignore them for HEAD
+        etag, last_modified = response.getheader('ETag'), response.getheader('Last-Modified')
+        if validators.get('url') != url or not (etag or last_modified):
+            return 'new file', last_modified
+        same = etag == validators.get('etag') if etag else last_modified == validators.get('last_modified')
+        return ('not modified' if same else 'new file'), last_modified
+
+    def save_file(self, ticker, cached_file):
+        """Copy the cached file to the working directory as TICKER.csv, in one step so no half-written file is left"""
+        with atomic_file(os.path.join(self.dest_dir, ticker + '.csv')) as temp_file:
+            shutil.copyfile(cached_file, temp_file)
+
+    def get_connection(self, parts):
+        """Take an open connection to the website from the pool, or open a new one"""
+        key = (parts.scheme, parts.netloc)
+        with self.pool_lock:
+            connections = self.pool.setdefault(key, queue.LifoQueue(maxsize=self.workers))
+        try:
+            return connections.get_nowait()
+        except queue.Empty:
+            if parts.scheme == 'https':
+                return http.client.HTTPSConnection(parts.netloc, timeout=self.timeout)
+            return http.client.HTTPConnection(parts.netloc, timeout=self.timeout)
+
+    def return_connection(self, parts, connection):
+        """Put a connection back in the pool so the next file can reuse it"""
+        try:
+            self.pool[(parts.scheme, parts.netloc)].put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+class Local_holdings_server():
+    """A stand-in for the ARK website that serves csv files from a local folder, used to test the downloader offline"""
+    def __init__(self, folder, latency=0.0):
+        self.folder = folder
+        server_folder = folder
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+            # HTTP/1.1 keeps connections open between requests, like the real website
+            protocol_version = 'HTTP/1.1'
+
+            def do_GET(self):
+                self.respond(send_body=True)
+
+            def do_HEAD(self):
+                # the same headers as GET, without the file (see 'Holdings_downloader.check')
+                self.respond(send_body=False)
+
+            def respond(self, send_body):
+                # 'latency' seconds of delay imitates the time it takes to reach the real website
+                time.sleep(latency)
+                file_path = os.path.join(server_folder, os.path.basename(urllib.parse.unquote(self.path)))
+                if not os.path.isfile(file_path):
+                    self.send_response(404)
+                    self.send_header('Content-Length', '0')
+                    self.end_headers()
+                    return
+                with open(file_path, 'rb') as file:
+                    body = file.read()
+                etag = '"' + hashlib.md5(body).hexdigest() + '"'
+                last_modified = email.utils.formatdate(int(os.path.getmtime(file_path)), usegmt=True)
+                if self.headers.get('If-None-Match') == etag or \
+                        (self.headers.get('If-None-Match') is None and
+                         self.headers.get('If-Modified-Since') == last_modified):
+                    self.send_response(304)
+                    self.send_header('ETag', etag)
+                    self.end_headers()
+                    return
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/csv')
+                self.send_header('Content-Length', str(len(body)))
+                self.send_header('ETag', etag)
+                self.send_header('Last-Modified', last_modified)
+                self.end_headers()
+                if send_body:
+                    self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def urls(self, tickers):
+        """A dictionary of 'ticker':'url' that points at this server, in place of the ARK website"""
+        host, port = self.server.server_address
+        return {ticker: 'http://{}:{}/{}.csv'.format(host, port, ticker) for ticker in tickers}
+
+def test_downloader(folder, workers=4, latency=0.05):
+    """Test mode: download every TICKER.csv in 'folder' from a local stand-in server and time it"""
+    # The first pass downloads every file, the second pass should get '304 Not Modified' for all of them
+    tickers = [file[:-4] for file in sorted(os.listdir(folder)) if file.endswith('.csv')]
+    server = Local_holdings_server(folder, latency=latency).start()
+    timings = []
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            downloader = Holdings_downloader(server.urls(tickers), workers=workers, retries=1, backoff=0.1,
+                                             dest_dir=work_dir, cache_dir=os.path.join(work_dir, 'download_cache'))
+            for label in ['first download', 'conditional download']:
+                start = time.perf_counter()
+                status = downloader.download_all()
+                timings.append(time.perf_counter() - start)
+                print('{}: {} files in {:.3f}s {}'.format(label, len(status), timings[-1],
+                                                         sorted(set(status.values()))))
+    finally:
+        server.stop()
+    return timings
+
 def summary_file_name(today_date_dict):
     """Create the summary filename"""
     summary_file = 'summary\\' + 'summary_' + today_date_dict['ARKK'] + '.txt'
@@ -68,12 +1137,17 @@ class Edit_downloaded_files():
                 with open(file, 'r+') as csvFile:
                     # remove the last 3 lines of each .csv file
                     lines = csvFile.readlines()
-                    lines.pop()
-                    lines.pop()
-                    lines.pop()
-                # clear out the file, and copy in the file with 3 rows removed
-                with open(file, 'w+') as csvFile:
-                    csvFile.writelines(lines)
+                # a file that was already truncated (i.e. by a run that stopped partway) ends with a holding, which
+                # starts with the date; truncating it again would remove 3 holdings
+                if lines and re.match(r'\d\d/\d\d/\d{4},', lines[-1]):
+                    continue
+                lines.pop()
+                lines.pop()
+                lines.pop()
+                # copy in the file with 3 rows removed, in one step
+                with atomic_file(file) as temp_file:
+                    with open(temp_file, 'w') as csvFile:
+                        csvFile.writelines(lines)
 
     def calc_stock_price_and_rank(self):
         """add stock price and rank to all files in working directory that end in '.csv' """
@@ -87,7 +1161,57 @@ class Edit_downloaded_files():
                     # Each stock has been given a rank that is 3 digits to allow for easier sorting
                     # This avoids sorting that results in [1,10,11,12....19,2,20,21,22...29,3,30,31]
                     df['rank'] = df.index + 101
-                    df.to_csv(file, index=False)
+                with atomic_file(file) as temp_file:
+                    df.to_csv(temp_file, index=False)
+
+class Ingest_downloaded_files():
+    """Turn each downloaded csv file into its archive file in a single pass: date, truncate, price & rank, save"""
+    def __init__(self, ticker):
+        self.ticker = ticker
+
+    def ingest_today_files(self):
+        """ingest the downloaded file of each fund; returns a dictionary of 'ticker':'date' key, value pairs"""
+        # Only the files named after a fund in 'ark_funds.txt' are read, no other .csv file in the working directory
+        # This replaces 'get_date_rename_file', 'remove_last_three_rows', 'calc_stock_price_and_rank' and
+        # 'move_today_files', which each read and rewrote every file
+        file_date_dict = {}
+        for ticker in self.ticker:
+            with metrics.stage('ingest', ticker) as stage:
+                file_date_dict[ticker] = self.ingest_file(ticker, stage)
+        return file_date_dict
+
+    def ingest_file(self, ticker, stage=None):
+        """read the downloaded file once, and write the finished file to the fund's archive folder once"""
+        # 'stage' is the fund's measurements (see 'Pipeline_metrics'), given the number of rows
+        download = os.path.join(os.getcwd(), ticker + '.csv')
+        with open(download, 'rb') as file:
+            lines = file.read().splitlines(keepends=True)
+        # grabs second row, first item which is the date in a MM/DD/YYYY format
+        date_published = next(csv.reader([lines[1].decode('utf-8', errors='replace')]))[0]
+        date_published = datetime.datetime.strptime(date_published, "%m/%d/%Y")
+        # arrange the date to YYYY_MM_DD format (ensures proper order when sorting)
+        date_published = datetime.datetime.strftime(date_published, "%Y_%m_%d")
+
+        archive_file = os.path.join(os.getcwd(), ticker, 'archive', ticker + '_' + date_published)
+        # if this file is already in the archive (ARK hasn't published a new file yet), the download is deleted
+        if not store.exists(archive_file):
+            # remove the last 3 lines of the file, which is ARK's disclaimer
+            df = pd.read_csv(io.BytesIO(b''.join(lines[:-3])))
+            df["share price"] = df["market value($)"] / df["shares"]
+            df['share price'] = df['share price'].round(decimals=2)
+            # rank is a reflection of the %wt that each stock has in the etf
+            # Each stock has been given a rank that is 3 digits to allow for easier sorting
+            df['rank'] = df.index + 101
+            # the store writes a temporary file first and then renames it, so the archive never has a half-written file
+            filepath = store.save(df, archive_file)
+            Archive_manifest(ticker).add('archive', date_published, filepath, len(df))
+            # a fund whose archive is packed (see 'pack_archive') has the new file packed too
+            if os.path.isdir(os.path.join(os.getcwd(), ticker, 'packed')):
+                pack_archive([ticker])
+            if stage is not None:
+                stage['rows'] = len(df)
+        os.unlink(download)
+        return date_published
 
 class Folders_organize():
     """Move files to created/existing folder tree"""
@@ -150,13 +1274,8 @@ class Get_working_files():
         """ get the filepaths for each files downloaded today"""
         today_filepath_list = []
         for fund in self.ticker:
-            # grab the latest file that is in the archive folder
-            directory = os.path.join(os.getcwd(), fund, 'archive')
-            all_csv_files = [os.path.join(directory, x) for x in os.listdir(directory) if fund in x]
-            all_csv_files = sorted(all_csv_files, reverse=True)
-            # thanks to the date formatting, a reverse sort of the .csv files in the folder means the latest file is
-            # in position [0]
-            tday_file = all_csv_files[0]
+            # the latest file in the archive folder, as recorded in the fund's manifest
+            tday_file = Archive_manifest(fund).latest()
             today_filepath_list.append(tday_file)
         return today_filepath_list
 
@@ -164,167 +1283,612 @@ class Get_working_files():
         yesterday_filepath_list = []
         x=0
         for fund in self.ticker:
-            # grab the latest file that is in the archive folder
-            directory = os.path.join(os.getcwd(), fund, 'archive')
-            all_csv_files = [os.path.join(directory, x) for x in os.listdir(directory) if fund in x]
-            all_csv_files = sorted(all_csv_files, reverse=True)
-            # thanks to the date formatting YYYY_MM_DD, a reverse sort of the .csv files in the folder means the latest
-            # file is in position [1]. if there is no file in position [1], the program will make a copy of the file to
-            # allow the program to continue without error, and label the file with a date 1000 years ago
+            # grab the second latest file that is in the archive folder, as recorded in the fund's manifest
+            manifest = Archive_manifest(fund)
+            # if there is no second file, the program will make a copy of the file to allow the program to continue
+            # without error, and label the file with a date 1000 years ago
             try:
-                yday_file = all_csv_files[1]
+                yday_file = manifest.previous()
             except IndexError:
                 print(fund + " fund is missing a 2nd file to compare today's file.  A copy with year dated 1021 was "
                              "created.")
-                yday_file = today_filepath_list[x]
-                yday_file = list(yday_file)
-                yday_file[-14] = '1'
-                yday_file = ''.join(yday_file)
-                shutil.copy(today_filepath_list[x], os.path.join(os.getcwd(), fund, 'archive', yday_file))
+                yday_file = os.path.basename(today_filepath_list[x])
+                # the first digit of the year follows 'FUND_' in the file name
+                yday_file = yday_file[:len(fund) + 1] + '1' + yday_file[len(fund) + 2:]
+                yday_file = os.path.join(os.getcwd(), fund, 'archive', yday_file)
+                with atomic_file(yday_file) as temp_file:
+                    shutil.copyfile(today_filepath_list[x], temp_file)
+                manifest.add('archive', manifest.date_of('archive', os.path.basename(yday_file)), yday_file,
+                             manifest.entries['archive'][manifest.dates['archive'][-1]]['rows'])
             x += 1
             yesterday_filepath_list.append(yday_file)
         return yesterday_filepath_list
 
-def ark_data_frames(ticker, today_filepath_list, yesterday_filepath_list, today_date_dict):
+# Metrics compared between yesterday and today; 'delta_sums' are a delta by subtraction and 'delta_pcts' are a delta as
+# a percentage of yesterday's value.  Keys: heading in the csv file; values: heading of the new delta column
+delta_sums = {'rank': 'd_rank', 'shares': 'd_shares', 'market value($)': 'd_market_value($)',
+              'weight(%)': 'd_weight(%)'}
+delta_pcts = {'shares': 'd_shares_pct', 'weight(%)': 'd_weight_pct_pct', 'share price': 'd_share_price_pct'}
+# the headings of each archive file, the metrics looked up from yesterday's file, and the headings of each delta file
+holdings_headings = ['date', 'fund', 'company', 'ticker', 'cusip', 'shares', 'market value($)', 'weight(%)',
+                     'share price', 'rank']
+delta_metrics = ['shares', 'rank', 'market value($)', 'weight(%)', 'share price']
+delta_headings = holdings_headings + ['d_rank', 'd_shares', 'd_shares_pct', 'd_market_value($)', 'd_weight(%)',
+                                      'd_weight_pct_pct', 'd_share_price_pct', 'yesterday_share_price',
+                                      'd_market_value($)_pct']
+
+def delta_columns(delta_df, yday):
+    """Add the delta columns to today's holdings; 'yday' has yesterday's value of each metric, lined up with today"""
+    for heading, column in delta_sums.items():
+        delta_df[column] = delta_df[heading] - yday[heading]
+    for heading, column in delta_pcts.items():
+        delta_df[column] = (100 * (delta_df[heading] - yday[heading]) / yday[heading]).round(decimals=2)
+    # add yesterday's share price and the change in market value as a %
+    delta_df['yesterday_share_price'] = delta_df['share price'] / (1 + delta_df['d_share_price_pct'] / 100)
+    delta_df['yesterday_share_price'] = delta_df['yesterday_share_price'].round(decimals = 2)
+
+    delta_df['d_market_value($)_pct'] = delta_df['d_market_value($)'] / \
+                                        (delta_df['market value($)'] - delta_df['d_market_value($)']) * 100
+    delta_df['d_market_value($)_pct'] = delta_df['d_market_value($)_pct'].round(decimals=2)
+    return delta_df[delta_headings]
+
+def delta_engine(t_df, y_df):
+    """Compare today's and yesterday's holdings in a single join on CUSIP and calculate every delta column at once"""
+    # (Ticker may be used instead of CUSIP, however, Morgan Stanley Cash has no ticker value in the csv files)
+    metrics = delta_metrics
+    # A row without a CUSIP can't be matched to yesterday, and a CUSIP listed twice yesterday only matches its first row
+    y_keyed = y_df[y_df['cusip'].notna()].drop_duplicates(subset='cusip')
+    y_keyed = y_keyed[['cusip'] + metrics].add_suffix('_yday').rename(columns={'cusip_yday': 'cusip'})
+    t_keyed = t_df[['cusip']].assign(t_row=range(len(t_df)))
+    # One outer join lines up each stock's metrics from yesterday with its row today.  The 'holding' column flags each
+    # stock: 'left_only' was added today, 'right_only' was removed today, 'both' is held on both days
+    joined = t_keyed.merge(y_keyed, on='cusip', how='outer', indicator='holding')
+
+    # Today's stocks in the same order as today's file; removed stocks are returned separately
+    today = joined[joined['holding'] != 'right_only'].sort_values('t_row')
+    removed = y_df[y_df['cusip'].isin(joined.loc[joined['holding'] == 'right_only', 'cusip'])]
+    yday = {}
+    for heading in metrics:
+        yday[heading] = today[heading + '_yday'].to_numpy()
+        # The join turns whole number columns into decimals to make room for the missing values; when every stock was
+        # also held yesterday, change them back so the delta files keep the shares and rank as whole numbers
+        if not today[heading + '_yday'].isna().any():
+            yday[heading] = yday[heading].astype(y_df[heading].dtype)
+
+    # a data frame for the files downloaded today; new stocks get an empty (null) value in each delta column
+    delta_df = delta_columns(pd.DataFrame(t_df, columns=holdings_headings), yday)
+    return delta_df, removed
+
+def ark_data_frames(ticker, today_filepath_list, yesterday_filepath_list, today_date_dict, add_to_index=True):
     """The meat of the program - turn today's file and yesterday's files to data frames and compare holdings"""
+    # 'add_to_index' adds the new delta files to the security index and the rolling signals afterwards (see
+    # 'add_delta_file'); the benchmark turns it off and times that step on its own
     y=0
-    # Not used until the end of this method, creates a list of filepaths for the delta files
+    # Lists of filepaths and data frames for the delta files; the data frames are handed to the later steps so the
+    # delta files don't have to be read back from disk
     delta_filepath_list = []
+    delta_df_list = []
     for fund in ticker:
-        # create a data frame for both today and yesterdays files
-        t_df = pd.read_csv(today_filepath_list[y])
-        y_df = pd.read_csv(yesterday_filepath_list[y])
-
-        # THIS NEXT PART NEEDS A MORE CONCISE EXPLANATION; I APOLOGIZE IF IT IS CONFUSING
-        # The dictionaries below will match each stock's unique CUSIP identifier to the associated metric
-        # (Ticker may be used instead of CUSIP, however, Morgan Stanley Cash has no ticker value in the csv files)
-
-        # Shares Dictionary; keys: CUSIP; values: change in number of shares of a specific stock in the etf
-        d_shares_dict = {}
-        # Rank Dictionary; keys: CUSIP; values: change in overall position in the etf
-        d_rank_dict = {}
-        # Market Value Dictionary; keys: CUSIP; values: change in market value of a specific stock in the etf
-        d_market_value_usd_dict = {}
-        # Weight % Dictionary; keys: CUSIP; values: change in weight % a specific stock in the etf
-        d_weight_pct_dict = {}
-        # List of dictionaries listed above; the values in each dictionary will be output to a list that will be
-        # added to the csv file. The way of populating the csv is likely not the easiest way to do this.
-        dicts_sums = [d_shares_dict, d_rank_dict, d_market_value_usd_dict, d_weight_pct_dict]
-
-        # empty lists that will eventually contain the values from the dictionaries above
-        shares = []
-        rank = []
-        market_value = []
-        weight_pct = []
-        # List of lists that will be populated with the values from the dictionaries above
-        lists_sums = [shares, rank, market_value, weight_pct]
-
-        # For each new heading to be created in the csv file, a dictionary was created that will contain the stock's
-        # CUSIP identifier and calculate the difference (i.e. delta, or change) from the day before.
-        x = 0
-        # heading_sums are the labels that already exist in the csv file that will be called by the following loop.
-        # 'shares' from yesterday to today will be compared, the delta is entered into a dictionary, and then
-        # formatted to a list to be added to the csv file
-        headings_sums = ['shares', 'rank', 'market value($)', 'weight(%)']
-        # this is where the csv files are compared, the deltas calculated, entered into a dictionary and then to a list
-        for heading in headings_sums:
-            for cusip in t_df['cusip'].unique()[:]:
-                today = t_df[t_df['cusip'] == cusip][heading].values
-                yday = y_df[y_df['cusip'] == cusip][heading].values
-                diff = today - yday
-                dicts_sums[x][cusip] = diff
-            # the values in the dictionary's keys and values are appended to a list
-            for key, value in dicts_sums[x].items():
-                try:
-                    lists_sums[x].append(value[0])
-                except IndexError:
-                    lists_sums[x].append('N/A')
-            x += 1
+        # create a data frame for both today and yesterdays files; loaded once and shared with the later steps
+        t_df = snapshots.load(today_filepath_list[y])
+        y_df = snapshots.load(yesterday_filepath_list[y])
 
-        # The above calculation was a delta by subtraction; the below calculation is delta as a percentage
-        # Shares % Dictionary; keys: CUSIP; values: change in number of shares of a specific stock in the etf as a %
-        d_shares_pct_dict = {}
-        # Weight % Dictionary; keys: CUSIP; values: change in weight % of a specific stock in the etf as a % (% of a %)
-        d_weight_pct_pct_dict = {}
-        # Share Price % Dictionary; keys: CUSIP; values: change in share price of a specific stock in the etf as a %
-        d_share_price_pct_dict = {}
-        # List of dictionaries listed above; the values in each dictionary will be output to a list that will be
-        # added to the csv file. The way of populating the csv is likely not the easiest way to do this.
-        dicts_pcts = [d_shares_pct_dict, d_weight_pct_pct_dict, d_share_price_pct_dict]
-
-        # empty lists that will eventually contain the values from the dictionaries above
-        shares_pct = []
-        weight_pct_pct = []
-        share_price_pct = []
-        # List of lists that will be populated with the values from the dictionaries above
-        lists_pcts = [shares_pct, weight_pct_pct, share_price_pct]
-        # heading_pcts are the labels that already exist in the csv file that will be called by the following loop.
-        # 'shares' from yesterday to today will be compared, the delta is entered into a dictionary and then
-        # formatted to a list to be added to the csv file
-        headings_pcts = ['shares', 'weight(%)', 'share price']
-
-        # this is where the csv files are compared, the deltas calculated, entered into a dictionary and then to a list
-        x = 0
-        for heading in headings_pcts:
-            for cusip in t_df['cusip'].unique()[:]:
-                today = t_df[t_df['cusip'] == cusip][heading].values
-                yday = y_df[y_df['cusip'] == cusip][heading].values
-                diff = (100 * (today - yday) / yday).round(decimals=2)
-                dicts_pcts[x][cusip] = diff
-            # the values in the dictionary's keys and values are appended to a list
-            for key, value in dicts_pcts[x].items():
-                try:
-                    lists_pcts[x].append(value[0])
-                except IndexError:
-                    lists_pcts[x].append('N/A')
-            x += 1
+        # compare today's holdings with yesterday's and calculate the change (delta) for each stock
+        df1 = delta_engine(t_df, y_df)[0]
 
-        # a data frame for the files downloaded today are created; the headings in the csv are listed here
-        headings = ['date', 'fund', 'company', 'ticker', 'cusip', 'shares', 'market value($)', 'weight(%)',
-                    'share price', 'rank']
-        # Create data frame for today's CSV files (df1)
-        with open(today_filepath_list[y], 'r') as f:
-            df1 = pd.read_csv(f)
-            df1 = pd.DataFrame(df1, columns=headings)
-        # define new columns to be added to today's csv files
-        df1['d_rank'] = rank
-        df1['d_shares'] = shares
-        df1['d_shares_pct'] = shares_pct
-        df1['d_market_value($)'] = market_value
-        df1['d_weight(%)'] = weight_pct
-        df1['d_weight_pct_pct'] = weight_pct_pct
-        df1['d_share_price_pct'] = share_price_pct
-
-
-        #rename the csv file to the 'delta' folder in the folder tree
-        title = fund + '_' + today_date_dict[fund] + '_delta.csv'
+        #save the file to the 'delta' folder in the folder tree; each delta file is written once
+        title = fund + '_' + today_date_dict[fund] + '_delta'
         print('Saving ' + fund + ' file...')
-        df1.to_csv(os.path.join(os.getcwd(), fund, "delta", title), index=False)
-
-
-        # A lengthy way of adding a new column called yesterday's share price and change in market value
-        headings = ['date', 'fund', 'company', 'ticker', 'cusip', 'shares', 'market value($)', 'weight(%)',
-                    'share price', 'rank', 'd_rank', 'd_shares', 'd_shares_pct', 'd_market_value($)', 'd_weight(%)',
-                    'd_weight_pct_pct', 'd_share_price_pct']
         # Populate delta_filepath_list with list of filepaths for delta files
-        delta_filepath_list.append(os.path.join(os.getcwd(), fund, "delta", title))
-        z = 0
-        for file in delta_filepath_list:
-            # Create data frame for today's CSV files (df1)
-            with open(file, 'r') as f:
-                df1 = pd.read_csv(f)
-                df1 = pd.DataFrame(df1, columns=headings)
-            df1['yesterday_share_price'] = df1['share price'] / (1 + df1['d_share_price_pct'] / 100)
-            df1['yesterday_share_price'] = df1['yesterday_share_price'].round(decimals = 2)
-
-            df1['d_market_value($)_pct'] = df1['d_market_value($)'] / (df1['market value($)'] - df1['d_market_value($)'])* 100
-            df1['d_market_value($)_pct'] = df1['d_market_value($)_pct'].round(decimals=2)
-
-            df1.to_csv((file), index=False)
-            z += 1
+        delta_filepath_list.append(store.save(df1, os.path.join(os.getcwd(), fund, "delta", title)))
+        Archive_manifest(fund).add('delta', today_date_dict[fund], delta_filepath_list[-1], len(df1))
+        delta_df_list.append(df1)
         y += 1
-    return delta_filepath_list
+    if add_to_index:
+        add_delta_files(ticker, today_date_dict, delta_df_list)
+    return delta_filepath_list, delta_df_list
+
+def add_delta_file(fund, date, delta_df, fund_store=None):
+    """Add a fund's new delta file (already recorded in its manifest) to the security index, for
+    'Security_index.lookup', and to the running totals of the multi-day signals (see 'Rolling_signals')"""
+    Security_index().add_saved(fund, date, delta_df)
+    Rolling_signals(fund, fund_store=fund_store).update(date, delta_df)
+
+def add_delta_files(ticker, today_date_dict, delta_df_list):
+    """'add_delta_file' for each fund, measured as its own stage so the comparison itself is timed the same as
+    before there was an index"""
+    for fund, delta_df in zip(ticker, delta_df_list):
+        with metrics.stage('index_and_signals', fund) as stage:
+            add_delta_file(fund, today_date_dict[fund], delta_df)
+            stage['rows'] = len(delta_df)
+
+
+def backfill_chunk(fund, snapshots, chunk_store):
+    """Calculate and save the delta files for a run of consecutive archive dates of one fund"""
+    # 'snapshots' is a list of (date, filepath); the first date is only used as 'yesterday' for the second date
+    # Every file is stacked into one long data frame of (date, cusip) rows; 'snapshot' numbers the dates 0, 1, 2...
+    panel = pd.concat([chunk_store.load(path) for date, path in snapshots], keys=range(len(snapshots)),
+                      names=['snapshot', 'row'])
+    panel = pd.DataFrame(panel, columns=holdings_headings).reset_index(level='snapshot').reset_index(drop=True)
+
+    # Each stock's metrics from the date before: the same rows with the date number moved forward by one.  The same
+    # matching rules as 'delta_engine': no match without a CUSIP, and only the first row of a repeated CUSIP
+    previous = panel[panel['cusip'].notna()].drop_duplicates(subset=['snapshot', 'cusip'])
+    previous = previous[['snapshot', 'cusip'] + delta_metrics].add_suffix('_yday')
+    previous = previous.rename(columns={'snapshot_yday': 'snapshot', 'cusip_yday': 'cusip'})
+    previous['snapshot'] += 1
+    # a left join keeps the rows in the same order as the panel, so the yesterday columns line up with it
+    joined = panel[['snapshot', 'cusip']].merge(previous, on=['snapshot', 'cusip'], how='left')
+    yday = {heading: joined[heading + '_yday'].to_numpy() for heading in delta_metrics}
+    # every delta column of every date, calculated at once
+    deltas = delta_columns(panel.drop(columns='snapshot'), yday)
+
+    delta_files = []
+    for snapshot, delta_df in deltas.groupby(panel['snapshot']):
+        if snapshot == 0:
+            continue
+        # as in 'delta_engine', the shares and rank deltas stay whole numbers on a date when every stock was also held
+        # the date before
+        for heading in ['rank', 'shares']:
+            column = delta_sums[heading]
+            if pd.api.types.is_integer_dtype(panel[heading]) and not delta_df[column].isna().any():
+                delta_df[column] = delta_df[column].astype('int64')
+        date = snapshots[snapshot][0]
+        filepath = chunk_store.save(delta_df, os.path.join(os.getcwd(), fund, 'delta', fund + '_' + date + '_delta'))
+        delta_files.append((date, filepath, len(delta_df)))
+    return fund, delta_files
+
+def backfill_deltas(ticker, workers=None, start='0000_00_00', end='9999_99_99'):
+    """Rebuild the delta files of every archived date (or the dates from 'start' to 'end') of each fund"""
+    # Useful after a bug fix or after adding a metric.  Each fund's dates are split into runs that are handed to a
+    # pool of processes, so every CPU core is used; each run overlaps the run before it by one date
+    workers = workers or os.cpu_count()
+    runs_per_fund = max(1, workers // len(ticker))
+    jobs = []
+    for fund in ticker:
+        snapshots = Archive_manifest(fund).date_range('archive', end=end)
+        # keep the date before 'start' so 'start' has a 'yesterday' to compare to
+        first = max(bisect.bisect_left([date for date, path in snapshots], start) - 1, 0)
+        snapshots = snapshots[first:]
+        if len(snapshots) < 2:
+            print(fund + ' has fewer than 2 files in the archive, nothing to backfill')
+            continue
+        run_length = -(-(len(snapshots) - 1) // runs_per_fund)
+        for x in range(0, len(snapshots) - 1, run_length):
+            jobs.append((fund, snapshots[x:x + run_length + 1]))
+
+    delta_files = {}
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(backfill_chunk, fund, snapshots, store) for fund, snapshots in jobs]
+        for future in futures:
+            fund, files = future.result()
+            delta_files.setdefault(fund, []).extend(files)
+    # record all of each fund's new delta files in its manifest in one go
+    for fund, files in delta_files.items():
+        Archive_manifest(fund).add_many('delta', files)
+        print('Backfilled ' + str(len(files)) + ' ' + fund + ' delta files')
+    # index the rebuilt delta files (only the ones whose contents changed), and work out the signals again
+    Security_index().update(list(delta_files))
+    for fund in delta_files:
+        Rolling_signals(fund).rebuild()
+    return delta_files
+
+# The columns of each delta file kept in the security index.  Keys: heading in the delta file; values: index column
+index_columns = {'ticker': 'ticker', 'company': 'company', 'cusip': 'cusip', 'shares': 'shares', 'd_shares': 'd_shares',
+                 'd_shares_pct': 'd_shares_pct', 'rank': 'rank', 'd_rank': 'd_rank', 'weight(%)': 'weight',
+                 'market value($)': 'market_value', 'share price': 'share_price'}
+
+class Security_index():
+    """An index of every delta file by ticker and CUSIP, to look up one stock's history in every fund in milliseconds"""
+    # Looking up one stock used to mean opening every delta file of every fund.  The index is a sqlite database
+    # ('security_index.db') with a row for each stock in each delta file: its (fund, date, row) and its shares, rank
+    # and their changes.  sqlite keeps a lookup table by ticker and one by CUSIP, so a lookup only reads that stock's
+    # rows.  'files' has the sha256 of each indexed delta file (the same as the manifest), so 'update' only indexes the
+    # delta files that are new or have changed.  'ark_data_frames' and 'analyze_fund' add each delta file as it is saved
+    def __init__(self, index_file='security_index.db'):
+        self.index_file = os.path.join(os.getcwd(), index_file)
+        with contextlib.closing(self.connect()) as connection, connection:
+            connection.execute('CREATE TABLE IF NOT EXISTS postings (fund TEXT, date TEXT, row INTEGER, ' +
+                               ', '.join(index_columns.values()) + ')')
+            connection.execute('CREATE INDEX IF NOT EXISTS postings_ticker ON postings (ticker)')
+            connection.execute('CREATE INDEX IF NOT EXISTS postings_cusip ON postings (cusip)')
+            connection.execute('CREATE INDEX IF NOT EXISTS postings_file ON postings (fund, date)')
+            connection.execute('CREATE TABLE IF NOT EXISTS files (fund TEXT, date TEXT, sha256 TEXT, '
+                               'PRIMARY KEY (fund, date))')
+
+    def connect(self):
+        # the funds are analyzed in several processes that may add their delta files at the same time; each one waits
+        # (up to a minute) for the one before it to finish
+        return sqlite3.connect(self.index_file, timeout=60)
+
+    def add(self, fund, date, delta_df, sha256=None):
+        """index (or index again) a fund's delta file for a date (YYYY_MM_DD); 'sha256' is the file's hash"""
+        # each column as a list of python values; a missing (NaN) value is saved as NULL by sqlite
+        columns = [[fund] * len(delta_df), [date] * len(delta_df), list(range(len(delta_df)))]
+        columns += [delta_df[heading].tolist() for heading in index_columns]
+        with contextlib.closing(self.connect()) as connection, connection:
+            connection.execute('DELETE FROM postings WHERE fund = ? AND date = ?', (fund, date))
+            connection.executemany('INSERT INTO postings VALUES (' + ', '.join(['?'] * len(columns)) + ')',
+                                   zip(*columns))
+            connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?)', (fund, date, sha256))
+
+    def add_saved(self, fund, date, delta_df):
+        """'add' a delta file that was just recorded in the fund's manifest (unless it is indexed already)"""
+        sha256 = Archive_manifest(fund).entries['delta'][date]['sha256']
+        with contextlib.closing(self.connect()) as connection:
+            indexed = connection.execute('SELECT sha256 FROM files WHERE fund = ? AND date = ?',
+                                         (fund, date)).fetchone()
+        if indexed is None or indexed[0] != sha256:
+            self.add(fund, date, delta_df, sha256)
+
+    def update(self, ticker):
+        """index every delta file in the funds' manifests that is new or has changed, and forget the delta files that
+        are no longer in a manifest; returns the number of files indexed"""
+        with contextlib.closing(self.connect()) as connection:
+            indexed = {(fund, date): sha256 for fund, date, sha256 in connection.execute('SELECT * FROM files')}
+        count = 0
+        for fund in ticker:
+            manifest = Archive_manifest(fund)
+            for date, entry in manifest.entries['delta'].items():
+                if indexed.pop((fund, date), None) != entry['sha256']:
+                    delta_df = store.load(manifest.path('delta', date), columns=list(index_columns))
+                    self.add(fund, date, delta_df, entry['sha256'])
+                    count += 1
+        with contextlib.closing(self.connect()) as connection, connection:
+            for fund, date in indexed:
+                if fund in ticker:
+                    connection.execute('DELETE FROM postings WHERE fund = ? AND date = ?', (fund, date))
+                    connection.execute('DELETE FROM files WHERE fund = ? AND date = ?', (fund, date))
+        return count
+
+    def lookup(self, symbol, funds=None, start='0000_00_00', end='9999_99_99'):
+        """Every day a stock (by ticker or CUSIP) was held by any fund (or only 'funds') from 'start' to 'end'
+        (YYYY_MM_DD): a data frame of the position, its change in shares and its rank on each date, oldest first"""
+        # A stock found by ticker is also found by its CUSIP, so its history is complete even if its ticker changed.
+        # 'action' is added, bought, sold or unchanged; and 'removed' on the first date the fund no longer held it
+        symbol = symbol.strip().upper()
+        query = 'SELECT * FROM postings WHERE (ticker = ? OR cusip = ? OR cusip IN ' \
+                '(SELECT cusip FROM postings WHERE ticker = ? AND cusip IS NOT NULL)) AND date BETWEEN ? AND ?'
+        parameters = [symbol, symbol, symbol, start, end]
+        if funds:
+            query += ' AND fund IN (' + ', '.join(['?'] * len(funds)) + ')'
+            parameters += list(funds)
+        with contextlib.closing(self.connect()) as connection:
+            history = pd.read_sql_query(query, connection, params=parameters)
+            # the dates of each fund's delta files, to find the date a stock was removed
+            file_dates = {}
+            for fund, date in connection.execute('SELECT fund, date FROM files WHERE date BETWEEN ? AND ? '
+                                                 'ORDER BY date', (start, end)):
+                file_dates.setdefault(fund, []).append(date)
+
+        # a new stock has no change in shares in its delta file; its change is all of its shares
+        added = history['d_shares'].isna()
+        history.loc[added, 'd_shares'] = history.loc[added, 'shares']
+        history['action'] = np.select([added, history['d_shares'] > 0, history['d_shares'] < 0],
+                                      ['added', 'bought', 'sold'], 'unchanged')
+        # a stock that is in a fund's delta file, but not in the fund's next delta file, was removed on the next date
+        removed = []
+        for fund, held in history.groupby('fund', sort=False):
+            dates = np.array(file_dates[fund])
+            next_file = np.searchsorted(dates, held['date'].to_numpy(), side='right')
+            next_dates = dates[np.minimum(next_file, len(dates) - 1)]
+            gone = (next_file < len(dates)) & ~is_in(next_dates, held['date'])
+            removed.append(held[gone].assign(date=next_dates[gone], row=None, shares=0, d_shares=-held['shares'][gone],
+                                             d_shares_pct=-100.0, rank=np.nan, d_rank=np.nan, weight=0.0,
+                                             market_value=0.0, share_price=np.nan, action='removed'))
+        history = pd.concat([history] + removed, ignore_index=True)
+        return history.sort_values(['date', 'fund'], kind='stable').reset_index(drop=True)
+
+def security_history_text(symbol, history, changes_only=False):
+    """The lines printed for 'Security_index.lookup'; 'changes_only' leaves out the days the shares didn't change"""
+    if changes_only:
+        history = history[history['action'] != 'unchanged']
+    if history.empty:
+        return symbol + ': not found in the security index'
+    table = history[['date', 'fund', 'action', 'shares', 'd_shares', 'd_shares_pct', 'rank', 'd_rank', 'weight',
+                     'market_value']].copy()
+    # the ranks are numbered from 101 (see 'Ingest_downloaded_files'); printed from 1, as in the summary
+    table['rank'] = table['rank'] - 100
+    # whole numbers print with commas and without '.0'; a missing value (a removed stock's rank) prints as '-'
+    for heading in ['shares', 'd_shares', 'rank', 'd_rank', 'market_value']:
+        table[heading] = [('-' if pd.isna(value) else '{:,.0f}'.format(value)) for value in table[heading]]
+    names = ', '.join(history['ticker'].dropna().unique().tolist() + history['cusip'].dropna().unique().tolist())
+    # a stock held by more than one fund has a row for each fund on the same day
+    lines = [symbol + ' (' + names + '): ' + str(history['date'].nunique()) + ' days in ' +
+             ', '.join(history['fund'].unique()) + ' from ' + history['date'].iloc[0] + ' to ' +
+             history['date'].iloc[-1],
+             table.to_string(index=False, na_rep='-')]
+    return '\n'.join(lines)
+
+class Rolling_signals():
+    """Multi-day signals of each stock a fund holds, kept up to date one delta file at a time: the change in shares over
+    the last 'window' days, the days in a row it was bought or sold, the mean and volatility of its daily price change,
+    and the change in its weight"""
+    # A day is a delta file of the fund, and a stock's days are the ones it has been held without a break, so a stock
+    # that was sold out and bought again starts over.  'streak' is the days in a row (up to today) the shares went up
+    # (+) or down (-), and 0 if they didn't change today; a new stock counts as bought.  The other signals only use the
+    # last 'window' days.  Working them out from every delta file each day gets slower as the archive grows, so a
+    # running total of each signal is saved for each stock ('FUND/FUND_signals_20' for a window of 20 days), and each
+    # day the new delta file is added and the delta file that falls out of the window is taken away; the time taken
+    # only depends on the number of stocks.  'recompute' works the signals out again from every delta file, and
+    # 'check' compares the two
+    state_columns = ['key', 'ticker', 'company', 'cusip', 'start', 'streak', 'shares_sum', 'price_sum', 'price_squares',
+                     'price_days', 'weight_sum']
+    value_columns = ['ticker', 'company', 'cusip', 'shares', 'd_shares', 'd_share_price_pct', 'weight(%)',
+                     'd_weight(%)']
+
+    def __init__(self, fund, window=20, fund_store=None):
+        self.fund = fund
+        self.window = window
+        # the funds are analyzed in their own processes, which start with the default 'store' (see 'analyze_fund')
+        self.store = fund_store or store
+        self.state_path = os.path.join(os.getcwd(), fund, fund + '_signals_' + str(window))
+
+    @staticmethod
+    def values(delta_df):
+        """each stock's label (see 'holding_keys') and its values added up for the signals: the change in shares, the
+        change in share price % (NaN if there isn't one) and the change in weight; a new stock's change is all of its
+        shares and weight"""
+        shares = delta_df['d_shares'].fillna(delta_df['shares']).to_numpy(dtype=float)
+        price = delta_df['d_share_price_pct'].to_numpy(dtype=float)
+        price = np.where(np.isfinite(price), price, np.nan)
+        weight = delta_df['d_weight(%)'].fillna(delta_df['weight(%)']).to_numpy(dtype=float)
+        return holding_keys(delta_df), shares, price, weight
+
+    def load_delta(self, manifest, date):
+        return self.store.load(manifest.path('delta', date), columns=self.value_columns)
+
+    def load(self):
+        """the saved state: a dictionary of the state columns, and the 'date' and 'day' (its place in the fund's delta
+        dates) it is up to; None if there isn't one, or it used a different window"""
+        filepath = self.state_path + self.store.extension
+        if not os.path.isfile(filepath):
+            return None
+        df = self.store.load(filepath)
+        if len(df) == 0 or df['window'].iloc[0] != self.window:
+            return None
+        state = {heading: df[heading].to_numpy() for heading in self.state_columns}
+        state['key'] = state['key'].astype(object)
+        state['date'] = str(df['signal_date'].iloc[0])
+        state['day'] = int(df['signal_day'].iloc[0])
+        return state
+
+    def save(self, state):
+        df = pd.DataFrame({heading: state[heading] for heading in self.state_columns})
+        df['signal_date'] = state['date']
+        df['signal_day'] = state['day']
+        df['window'] = self.window
+        return self.store.save(df, self.state_path)
+
+    def step(self, state, manifest, day, delta_df):
+        """the state after adding the delta file of the fund's 'day'th delta date to 'state' (the day before)"""
+        key, shares, price, weight = self.values(delta_df)
+        position = pd.Index(state['key'], dtype=object).get_indexer(key)
+        held = position >= 0
+
+        # each stock's totals up to the day before; a new stock (or one that was sold out and bought again) starts over
+        def carried(heading, new_value):
+            column = np.full(len(key), new_value, dtype=state[heading].dtype)
+            column[held] = state[heading][position[held]]
+            return column
+        sign = np.sign(shares).astype('int64')
+        streak = carried('streak', 0)
+        priced = ~np.isnan(price)
+        new_state = {'key': key, 'ticker': delta_df['ticker'].to_numpy(), 'company': delta_df['company'].to_numpy(),
+                     'cusip': delta_df['cusip'].to_numpy(), 'start': carried('start', day),
+                     'streak': np.where((sign != 0) & (np.sign(streak) == sign), streak + sign, sign),
+                     'shares_sum': carried('shares_sum', 0) + shares,
+                     'price_sum': carried('price_sum', 0) + np.where(priced, price, 0),
+                     'price_squares': carried('price_squares', 0) + np.where(priced, price ** 2, 0),
+                     'price_days': carried('price_days', 0) + priced,
+                     'weight_sum': carried('weight_sum', 0) + weight,
+                     'date': manifest.dates['delta'][day], 'day': day}
+
+        # the delta file that falls out of the window is taken away, for the stocks that were held on that day
+        leaving = day - self.window
+        out = np.flatnonzero(new_state['start'] <= leaving) if leaving >= 0 else []
+        if len(out):
+            old_key, old_shares, old_price, old_weight = self.values(
+                self.load_delta(manifest, manifest.dates['delta'][leaving]))
+            at = pd.Index(old_key, dtype=object).get_indexer(key[out])
+            out, at = out[at >= 0], at[at >= 0]
+            old_priced = ~np.isnan(old_price[at])
+            new_state['shares_sum'][out] -= old_shares[at]
+            new_state['price_sum'][out] -= np.where(old_priced, old_price[at], 0)
+            new_state['price_squares'][out] -= np.where(old_priced, old_price[at] ** 2, 0)
+            new_state['price_days'][out] -= old_priced
+            new_state['weight_sum'][out] -= old_weight[at]
+        return new_state
+
+    def update(self, date, delta_df=None):
+        """bring the saved state up to a date (YYYY_MM_DD) whose delta file is in the fund's manifest; 'delta_df' is
+        that delta file, if it is already loaded.  Returns the state"""
+        manifest = Archive_manifest(self.fund)
+        dates = manifest.dates['delta']
+        day = dates.index(date)
+        state = self.load()
+        # the days are numbered by the fund's delta dates, so if a delta file was added before the last date of the
+        # state (or removed), the state no longer lines up and is worked out again from every delta file
+        if state is None or state['day'] >= len(dates) or dates[state['day']] != state['date']:
+            state = self.recompute(dates[:day + 1], manifest)
+        elif state['day'] >= day:
+            return state
+        else:
+            # normally only today's delta file; more if a run was missed
+            for next_day in range(state['day'] + 1, day + 1):
+                next_df = delta_df if next_day == day and delta_df is not None else \
+                    self.load_delta(manifest, dates[next_day])
+                state = self.step(state, manifest, next_day, next_df)
+        self.save(state)
+        return state
+
+    def recompute(self, dates=None, manifest=None):
+        """the state worked out from the delta files of 'dates' (default: every delta date), without a saved state"""
+        manifest = manifest or Archive_manifest(self.fund)
+        dates = manifest.dates['delta'] if dates is None else dates
+        days = len(dates)
+        last_df = self.load_delta(manifest, dates[-1])
+        key = holding_keys(last_df)
+        # a table of each value of the stocks held on the last date (a row) on each date (a column)
+        held = np.zeros((len(key), days), dtype=bool)
+        shares, weight = np.zeros((len(key), days)), np.zeros((len(key), days))
+        price = np.full((len(key), days), np.nan)
+        labels = pd.Index(key, dtype=object)
+        for day, date in enumerate(dates):
+            day_key, day_shares, day_price, day_weight = self.values(last_df if day == days - 1 else
+                                                                     self.load_delta(manifest, date))
+            rows = labels.get_indexer(day_key)
+            found = rows >= 0
+            held[rows[found], day] = True
+            shares[rows[found], day] = day_shares[found]
+            price[rows[found], day] = day_price[found]
+            weight[rows[found], day] = day_weight[found]
+
+        # the first day of each stock's run: the day after the last day it wasn't held
+        not_held = ~held[:, ::-1]
+        start = np.where(not_held.any(axis=1), days - np.argmax(not_held, axis=1), 0)
+        columns = np.arange(days)
+        in_run = columns >= start[:, None]
+        in_window = columns >= np.maximum(start, days - self.window)[:, None]
+        priced = in_window & ~np.isnan(price)
+        # the streak: the days in a row, back from the last day, with the same sign of change in shares
+        sign = np.sign(shares).astype('int64')
+        broken = ~((sign == sign[:, -1:]) & in_run)[:, ::-1]
+        streak = sign[:, -1] * np.where(broken.any(axis=1), np.argmax(broken, axis=1), days)
+        return {'key': key, 'ticker': last_df['ticker'].to_numpy(), 'company': last_df['company'].to_numpy(),
+                'cusip': last_df['cusip'].to_numpy(), 'start': start.astype('int64'), 'streak': streak,
+                'shares_sum': np.where(in_window, shares, 0).sum(axis=1),
+                'price_sum': np.where(priced, price, 0).sum(axis=1),
+                'price_squares': np.where(priced, price ** 2, 0).sum(axis=1),
+                'price_days': priced.sum(axis=1).astype('int64'),
+                'weight_sum': np.where(in_window, weight, 0).sum(axis=1), 'date': dates[-1], 'day': days - 1}
+
+    def rebuild(self):
+        """work the saved state out again from every delta file (after the delta files were backfilled)"""
+        if not Archive_manifest(self.fund).dates['delta']:
+            return None
+        state = self.recompute()
+        self.save(state)
+        return state
+
+    def signals(self, state=None):
+        """a data frame of each stock's signals, in the order of its last delta file"""
+        state = state or self.load()
+        days = state['day'] - np.maximum(state['start'], state['day'] - self.window + 1) + 1
+        price_days = state['price_days']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            price_mean = state['price_sum'] / price_days
+            # the sample standard deviation, from the sum and the sum of squares; needs at least 2 days
+            variance = (state['price_squares'] - state['price_sum'] * price_mean) / (price_days - 1)
+        return pd.DataFrame({'fund': self.fund, 'date': state['date'], 'ticker': state['ticker'],
+                             'company': state['company'], 'cusip': state['cusip'], 'days': days,
+                             'streak': state['streak'], 'd_shares_' + str(self.window) + 'd': state['shares_sum'],
+                             'd_share_price_pct_mean': np.where(price_days > 0, price_mean, np.nan).round(4),
+                             'd_share_price_pct_volatility': np.where(price_days > 1, np.sqrt(np.maximum(variance, 0)),
+                                                                      np.nan).round(4),
+                             'd_weight_' + str(self.window) + 'd': state['weight_sum'].round(4)})
+
+    def check(self, tolerance=1e-6):
+        """compare the saved state with the state worked out again from every delta file up to the same date: a data
+        frame of the stocks whose signals don't match (empty if they all do)"""
+        state = self.load()
+        if state is None:
+            raise FileNotFoundError('No saved signals for ' + self.fund + ' (window ' + str(self.window) + ')')
+        manifest = Archive_manifest(self.fund)
+        full = self.recompute(manifest.dates['delta'][:state['day'] + 1], manifest)
+        # the running totals are added and taken away in a different order, so they can be off by a rounding error
+        if len(full['key']) != len(state['key']) or (full['key'] != state['key']).any():
+            differ = np.ones(len(full['key']), dtype=bool)
+        else:
+            differ = (full['start'] != state['start']) | (full['streak'] != state['streak']) | \
+                     (full['price_days'] != state['price_days'])
+            for heading in ['shares_sum', 'price_sum', 'price_squares', 'weight_sum']:
+                differ |= ~np.isclose(state[heading], full[heading], rtol=1e-9, atol=tolerance)
+        saved = self.signals(state) if len(state['key']) == len(full['key']) else None
+        mismatches = self.signals(full)[differ]
+        if saved is not None:
+            mismatches = mismatches.join(saved[differ].iloc[:, 5:], rsuffix='_saved')
+        return mismatches
+
+def json_value(value):
+    """A value from a data frame as a plain python value for JSON; a missing (NaN) or infinite value becomes None"""
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, float) and not math.isfinite(value):
+        return None
+    return value
+
+class Summary_report():
+    """The summary kept in memory as a list of records, then written out once as text and once as JSON lines"""
+    # Each record is a dictionary with a 'type' (i.e. 'added', 'removed', 'stock'), the facts about it, and the 'text'
+    # it adds to the summary text file.  The JSON lines file (.ndjson) has the same records without the text, one per
+    # line, so other programs can use the results without reading the text file
+    def __init__(self, records=None):
+        self.records = records or []
+
+    def add(self, record):
+        self.records.append(record)
+
+    def extend(self, records):
+        self.records.extend(records)
+
+    def text(self):
+        return ''.join(record['text'] for record in self.records)
+
+    def json_lines(self):
+        lines = []
+        for record in self.records:
+            record = {key: json_value(value) for key, value in record.items() if key != 'text'}
+            lines.append(json.dumps(record, default=json_value) + '\n')
+        return ''.join(lines)
+
+    def write(self, summary_file, mode='w', json_file=None):
+        """write the text file (and the JSON lines file if given) with a single write each; mode 'a' adds to the end"""
+        # each file is written whole and then renamed, so a run that stops partway never leaves half a summary
+        with atomic_file(summary_file, append='a' in mode) as temp_file:
+            with open(temp_file, mode) as file:
+                file.write(self.text())
+        if json_file:
+            with atomic_file(json_file, append='a' in mode) as temp_file:
+                with open(temp_file, mode) as file:
+                    file.write(self.json_lines())
+
+def summary_json_file_name(summary_file):
+    """The JSON lines summary is saved next to the text summary, i.e. summary_2021_03_03.ndjson"""
+    return os.path.splitext(summary_file)[0] + '.ndjson'
+
+def fund_market_value(t_df, y_df):
+    """Total market value of one fund today and yesterday, and the % change from yesterday"""
+    fund_sum_today = int(t_df['market value($)'].sum())
+    # This does not use the 'int' function because it messes up the equation below (can't round a float??)
+    fund_sum_yesterday = y_df['market value($)'].sum()
+    # Calculate the change in the market value of the fund
+    d_fund_market_value_pct = ((fund_sum_today-fund_sum_yesterday)/fund_sum_yesterday*100).round(decimals=2)
+    return fund_sum_today, int(fund_sum_yesterday), d_fund_market_value_pct
+
+def market_value_record(fund_sum_today_list, fund_sum_yesterday_list):
+    """First message to be written in the summary file: overall ARK status"""
+    # Tally up the total market value of all ARK ETFs for Today files
+    total_assets_today = 0
+    for value in fund_sum_today_list:
+        total_assets_today += value
+    # Tally up the total market value of all ARK ETFs for Yesterday files
+    total_assets_yesterday = 0
+    for value in fund_sum_yesterday_list:
+        total_assets_yesterday += value
 
+    # Find the difference (subtraction) of the overall market value for all funds
+    total_change_mv_all_funds = total_assets_today - total_assets_yesterday
+    # Find the % change of the overall market value for all funds
+    total_change_mv_all_funds_pct = ((total_assets_today - total_assets_yesterday) / total_assets_yesterday * 100)
+
+    text = "Cathie's ARK: \n\t$" + \
+           str(f'{total_assets_yesterday:,}') + ' --> $' + str(f'{total_assets_today:,}') + \
+           ' \n\tChange: $' + str(f'{total_change_mv_all_funds:,}') + ' (' + \
+           str(total_change_mv_all_funds_pct)[:5] + '%)\n\n'
+    return {'type': 'market_value', 'market_value_yesterday': total_assets_yesterday,
+            'market_value_today': total_assets_today, 'd_market_value': total_change_mv_all_funds,
+            'd_market_value_pct': total_change_mv_all_funds_pct, 'text': text}
 
 def fund_sum_market_value(ticker, today_filepath_list, yesterday_filepath_list, summary_file):
     """Go into each file and summarize the overall market value, the % change from yesterday"""
@@ -336,246 +1900,1108 @@ def fund_sum_market_value(ticker, today_filepath_list, yesterday_filepath_list,
     d_fund_market_value_pct_list = []
     # Create data frames for today's and yesterday's ARK CSV files
     for fund in ticker:
-        with open(today_filepath_list[x], 'r') as f:
-            df1 = pd.read_csv(f)
-            df1 = pd.DataFrame(df1)
-        with open(yesterday_filepath_list[x], 'r') as f:
-            df2 = pd.read_csv(f)
-            df2 = pd.DataFrame(df2)
-        #print(df1['ticker'][0])
-        fund_sum_today = int(df1['market value($)'].sum())
-        # This does not use the 'int' function because it messes up the equation below (can't round a float??)
-        fund_sum_yesterday = df2['market value($)'].sum()
-        # Calculate the change in the market value of each fund
-        d_fund_market_value_pct = ((fund_sum_today-fund_sum_yesterday)/fund_sum_yesterday*100).round(decimals=2)
+        # only the market value column is needed
+        df1 = snapshots.load(today_filepath_list[x], columns=['market value($)'])
+        df2 = snapshots.load(yesterday_filepath_list[x], columns=['market value($)'])
+        fund_sum_today, fund_sum_yesterday, d_fund_market_value_pct = fund_market_value(df1, df2)
         # Populate the empty lists created above with the % change in market value, today and yesterdays market value
-
         fund_sum_today_list.append(fund_sum_today)
-
-        fund_sum_yesterday = int(fund_sum_yesterday)
         fund_sum_yesterday_list.append(fund_sum_yesterday)
-
         d_fund_market_value_pct_list.append(d_fund_market_value_pct)
 
         x+=1
 
-    # Tally up the total market value of all ARK ETFs for Today files
-    total_assets_today = 0
-    for value in fund_sum_today_list:
-        total_assets_today += value
-    # Tally up the total market value of all ARK ETFs for Yesterday files
-    total_assets_yesterday = 0
-    for value in fund_sum_yesterday_list:
-        total_assets_yesterday += value
-
-    # Find the difference (subtraction) of the overall market value for all funds
-    total_change_mv_all_funds = total_assets_today - total_assets_yesterday
-    # Find the % change of the overall market value for all funds
-    total_change_mv_all_funds_pct = str(((total_assets_today - total_assets_yesterday) /
-        total_assets_yesterday * 100))
-
-
-    # First message to be written in the summary file: overall ARK status
-    #summary_file_name = 'summary\\' + 'summary_' + today_date_dict['ARKK'] + '.txt'
-
-    with open(summary_file, 'w+') as file:
-        file.write("Cathie's ARK: \n\t$" + \
-                   str(f'{total_assets_yesterday:,}') + ' --> $' + str(f'{total_assets_today:,}') + \
-                   ' \n\tChange: $' + str(f'{total_change_mv_all_funds:,}') + ' (' + \
-                   total_change_mv_all_funds_pct[:5] + '%)\n\n')
+    Summary_report([market_value_record(fund_sum_today_list, fund_sum_yesterday_list)]).write(summary_file)
     #The returns below will be used for the ONE LINE summary of each stock that is is triggered by a condition in the
     # method 'def changed_x_or_more'
     return fund_sum_today_list, d_fund_market_value_pct_list
 
+# Heading of the added/removed section of the summary file
+added_or_removed_heading = {'type': 'heading', 'section': 'added_or_removed',
+                            'text': 'Did ARK add or remove any stocks from their funds?\n\n'}
+
+def is_in(values, other_values):
+    """True for each of 'values' that is one of 'other_values' (a missing value never is)"""
+    # a hash table lookup of every value at once; pandas' 'isin' goes through pyarrow text one value at a time
+    return pd.Index(other_values.dropna().unique()).get_indexer(values) >= 0
+
+def held_in(df, other_df):
+    """True for each row of 'df' whose stock is also held in 'other_df': matched on cusip, or on company name if either
+    side of the match has no cusip (cash, swaps, ...)"""
+    # company names of the rows with no cusip in the other file, and every company name in the other file
+    other_companies_no_cusip = other_df['company'][other_df['cusip'].isna()].astype(str)
+    other_companies = other_df['company'].astype(str)
+    company = df['company'].astype(str)
+    return is_in(df['cusip'], other_df['cusip']) | is_in(company, other_companies_no_cusip) | \
+        (df['cusip'].isna().to_numpy() & is_in(company, other_companies))
+
+def added_or_removed(t_df, y_df):
+    """The stocks added to and removed from a fund between two files; returns (added data frame, removed data frame)
+    with the ticker, company, cusip, weight, rank, and position (row number) of each"""
+    # an anti-join both ways: the rows of one file that are not held in the other file.  A company keeps its cusip
+    # when ARK renames it, so a renamed stock is not seen as removed and added again
+    def stocks(df, rows):
+        stocks_df = df[['ticker', 'company', 'cusip', 'weight(%)', 'rank']].iloc[rows]
+        stocks_df = stocks_df.rename(columns={'weight(%)': 'weight'})
+        stocks_df['position'] = rows + 1
+        return stocks_df
+    added = stocks(t_df, np.flatnonzero(~held_in(t_df, y_df)))
+    removed = stocks(y_df, np.flatnonzero(~held_in(y_df, t_df)))
+    return added, removed
+
+def added_or_removed_records(fund, t_df, y_df):
+    """The summary records for one fund, one for each stock that was added or removed"""
+    # Print the ticker for the fund in the text file
+    records = [{'type': 'fund', 'section': 'added_or_removed', 'fund': fund, 'text': fund + ':\n'}]
+    added, removed = added_or_removed(t_df, y_df)
+    holdings = len(t_df['rank'])
+    # A company in YESTERDAY's file that is not in TODAY's file was removed from the ARK etf
+    for stock in removed.itertuples(index=False):
+        removed_msg = '{}{}{}{}{}{}'.format('\t', stock.ticker, ': ', stock.company, ': removed from ', fund)
+        records.append({'type': 'removed', 'fund': fund, 'ticker': stock.ticker, 'company': stock.company,
+                        'cusip': stock.cusip, 'weight': stock.weight, 'rank': stock.rank - 100,
+                        'text': removed_msg + '\n'})
+    # A company in TODAY's file that is not in YESTERDAY's file was added to the ARK etf
+    for stock in added.itertuples(index=False):
+        added_msg = '{}{}{}{}{}{}{}'.format('\t', stock.ticker, ': ', stock.company, ': added to ', fund, '; ')
+        position = '{}{}{}{}'.format('the stock is position ', stock.position, ' out of ', holdings)
+        records.append({'type': 'added', 'fund': fund, 'ticker': stock.ticker, 'company': stock.company,
+                        'cusip': stock.cusip, 'weight': stock.weight, 'rank': stock.rank - 100,
+                        'position': stock.position, 'holdings': holdings, 'text': added_msg + position + '\n'})
+    return records
+
 def stocks_added_or_removed(ticker, today_filepath_list, yesterday_filepath_list, summary_file):
     """Add to summary text file for any tickers that were added or removed from any ARK etf"""
     y=0
-    with open(summary_file, 'a+') as file:
-        file.write('Did ARK add or remove any stocks from their funds?\n\n')
+    report = Summary_report([added_or_removed_heading])
     # Loop through each ticker and compare the TODAY and YESTERDAY files
     for fund in ticker:
         # create a data frame for the today file and the yesterday file
-        t_df = pd.read_csv(today_filepath_list[y])
-        y_df = pd.read_csv(yesterday_filepath_list[y])
-
-        # Print the ticker for the fund in the text file
-        with open(summary_file, 'a+') as file:
-            file.write(fund + ':\n')
-        # Loop through a list of companies in each ARK etf from YESTERDAY.  If it is not in TODAY's list of
-        # companies, then that means the company was removed from the ARK etf
-        x=0
-        for company in y_df['company']:
-            if str(company) not in list(t_df['company']):
-                removed = '{}{}{}{}{}{}'.format('\t',y_df['ticker'][x],': ', company,': removed from ',fund)
-                with open(summary_file, 'a+') as file:
-                    file.write(removed)
-                    file.write('\n')
-            x+=1
-        # Loop through a list of companies in each ARK etf from TODAY.  If it is not in YESTERDAY's list of
-        # companies, then that means the company was added from the ARK etf
-        x=0
-        for company in t_df['company']:
-            if str(company) not in list(y_df['company']):
-                added = '{}{}{}{}{}{}{}'.format('\t',t_df['ticker'][x],': ', company,': added to ',fund, '; ')
-                position = '{}{}{}{}'.format('the stock is position ', x+1,' out of ',len(t_df['rank']))
-                total = added + position
-                with open(summary_file, 'a+') as file:
-                    file.write(total)
-                    file.write('\n')
-            x+=1
+        t_df = snapshots.load(today_filepath_list[y], columns=['company', 'ticker', 'cusip', 'weight(%)', 'rank'])
+        y_df = snapshots.load(yesterday_filepath_list[y], columns=['company', 'ticker', 'cusip', 'weight(%)', 'rank'])
+        report.extend(added_or_removed_records(fund, t_df, y_df))
         y+=1
-
-def median_mode_change_in_shares(delta_filepath_list):
+    report.write(summary_file, mode='a+')
+
+# The levels of the change % of shares that are counted by 'share_change_stats'; each one is worked out from the
+# sorted values (no missing values), and the unique values and how many times each appears.  Add a level here and it is
+# counted in the same pass as the others
+share_change_levels = {
+    'MODE': lambda values, unique, counts: unique[np.argmax(counts)],
+    'Q1': lambda values, unique, counts: np.quantile(values, 0.25),
+    'Q2': lambda values, unique, counts: np.quantile(values, 0.5),
+    'Q3': lambda values, unique, counts: np.quantile(values, 0.75),
+}
+
+def share_change_stats(delta_df):
+    """The distribution of the change % of shares of one fund: each level in 'share_change_levels' and how many stocks
+    match it, plus the rebalance signal"""
+    # 'N/A' or a blank (a stock that is new today) is not counted, but is still one of the fund's holdings
+    shares_pct = pd.to_numeric(delta_df['d_shares_pct'], errors='coerce').to_numpy(dtype=float)
+    values = np.sort(shares_pct[~np.isnan(shares_pct)])
+    stats = {'holdings': len(shares_pct), 'levels': {}}
+    if len(values) == 0:
+        stats['rebalance'] = False
+        return stats
+    unique, counts = np.unique(values, return_counts=True)
+    levels = np.array([level(values, unique, counts) for level in share_change_levels.values()])
+    # the values are sorted, so the number of stocks at each level is the width of its slot in the sorted values
+    level_counts = np.searchsorted(values, levels, side='right') - np.searchsorted(values, levels, side='left')
+    for name, level, count in zip(share_change_levels, levels, level_counts):
+        stats['levels'][name] = {'value': level, 'count': int(count)}
+    # Indicator: sometimes more than half the stocks in a fund will be sold (or bought) by the same %, ie -1.58% shares
+    # sold, which looks like ARK rebalancing the whole fund rather than trading single stocks
+    mode = stats['levels']['MODE'] if 'MODE' in stats['levels'] else None
+    stats['rebalance'] = bool(mode is not None and mode['value'] != 0 and mode['count'] > stats['holdings'] / 2)
+    return stats
+
+def mode_median_message(delta_df, stats=None):
+    """The mode and quartiles of the change % of shares of one fund, and how many stocks match each of them"""
+    stats = stats or share_change_stats(delta_df)
+    message = ''
+    for name, level in stats['levels'].items():
+        message += name + ': ' + str(level['count']) + 'oo' + str(stats['holdings']) + '(' + \
+                   str(level['value']) + '% shares). '
+    if stats['rebalance']:
+        mode = stats['levels']['MODE']
+        message += 'REBALANCE: ' + str(mode['count']) + 'oo' + str(stats['holdings']) + ' stocks changed by ' + \
+                   str(mode['value']) + '% shares. '
+    # Output message for the median and mode trend
+    return '\n\t' + message
+
+def median_mode_change_in_shares(delta_df_list):
     """The purpose is to note a fringe indicator"""
     # Indicator: sometimes more than half the stocks in a fund will be sold off by the same %, ie -1.58% shares sold
     # This information may not be critical, but it may paint a unique picture of the ARK fund
     mode_median_message_list = []
-    for fund in delta_filepath_list:
-        # create a data frame for the today file and the yesterday file
-        delta_df = pd.read_csv(fund)
-
-        # in the change % of shares of each company in each fund, find the mode, and how many times the mode appears
-        mode_count=0
-        mode = delta_df['d_shares_pct'].mode()[0]
-        for line in delta_df['d_shares_pct']:
-            if line == mode:
-                mode_count += 1
-        mode_msg = 'MODE: ' + str(mode_count) + 'oo' + str(len(delta_df['d_shares_pct'])) + '(' + \
-                   str(mode) + '% shares). '
-
-        quartile_1_count=0
-        quartile_1 = delta_df['d_shares_pct'].quantile(q=0.25, interpolation='linear')
-        for line in delta_df['d_shares_pct']:
-            if line == quartile_1:
-                quartile_1_count += 1
-        quartile_1_msg = 'Q1: ' + str(quartile_1_count) + 'oo' + str(len(delta_df['d_shares_pct'])) + \
-                         '(' + str(quartile_1) + '% shares). '
-
-        # Count the median repetition
-        quartile_2_count = 0
-        quartile_2 = delta_df['d_shares_pct'].quantile(q=0.5, interpolation='linear')
-        for line in delta_df['d_shares_pct']:
-            if line == quartile_2:
-                quartile_2_count += 1
-        quartile_2_msg = 'Q2: ' + str(quartile_2_count) + 'oo' + str(len(delta_df['d_shares_pct'])) + \
-                         '(' + str(quartile_2) + '% shares). '
-
-        quartile_3_count=0
-        quartile_3 = delta_df['d_shares_pct'].quantile(q=0.75, interpolation='linear')
-        for line in delta_df['d_shares_pct']:
-            if line == quartile_3:
-                quartile_3_count += 1
-        quartile_3_msg = 'Q3: ' + str(quartile_3_count) + 'oo' + str(len(delta_df['d_shares_pct'])) + \
-                         '(' + str(quartile_3) + '% shares). '
-
-        # Output message for the median and mode trend
-        mode_median_output = '\n\t' + mode_msg + quartile_1_msg + quartile_2_msg + quartile_3_msg
-
-        mode_median_message_list.append(mode_median_output)
+    # the delta data frames come straight from 'ark_data_frames', one for each fund
+    for delta_df in delta_df_list:
+        mode_median_message_list.append(mode_median_message(delta_df))
 
     return mode_median_message_list
 
+# Trigger rules for 'changed_x_or_more', used when there is no 'ark_triggers.json' file.  For a single stock, a change
+# beyond a rule's 'threshold' (+/-) in the delta column 'column' will output a message detailing the change.
+# 'heading' describes the rule at the top of the section; 'above' and 'below' are the lines written when the change is
+# above +threshold or below -threshold ({value} is the change, {negated} is the change as a whole number with the sign
+# flipped, which is how rank is shown: moving from rank 9 to rank 3 is a change of -6, shown as +6; {amount} is the
+# change as a number, so it can be formatted, i.e. {amount:,.0f})
+default_trigger_config = {
+    'rules': [
+        {'name': 'shares', 'column': 'd_shares_pct', 'threshold': 10, 'heading': 'Change in shares: +/- {threshold}%',
+         'above': '(+) % of shares: {value}%', 'below': '(-) % of shares: {value}%'},
+        {'name': 'rank', 'column': 'd_rank', 'threshold': 5, 'heading': 'Change in rank: +/- {threshold} positions',
+         'above': '(-) rank: {negated}', 'below': '(+) rank: {negated}'},
+        {'name': 'share price', 'column': 'd_share_price_pct', 'threshold': 10,
+         'heading': 'Change in share price: +/- {threshold}%',
+         'above': '(+) share price %: {value}%', 'below': '(-) share price %: {value}%'},
+        {'name': 'market value', 'column': 'd_market_value($)_pct', 'threshold': 10,
+         'heading': 'Change in market value (MV): +/-{threshold}%',
+         'above': '(+) % of MV: {value}%', 'below': '(-) % of MV {value}%'},
+    ],
+    # Rules can be added on any delta column, i.e. a move of $50 million or more in a single stock:
+    # {'name': 'market value $', 'column': 'd_market_value($)', 'threshold': 50000000,
+    #  'heading': 'Change in market value (MV): +/- ${threshold:,}',
+    #  'above': '(+) MV: ${amount:,.0f}', 'below': '(-) MV: ${amount:,.0f}'}
+    # thresholds for a single fund, i.e. {'ARKG': {'shares': 5}}
+    'funds': {},
+}
+
+def trigger_rules(fund=None, config_file='ark_triggers.json'):
+    """The trigger rules for a fund: the rules in the config file, with the fund's own thresholds where it has any"""
+    config = default_trigger_config
+    if os.path.isfile(config_file):
+        with open(config_file, 'r') as file:
+            config = json.load(file)
+    # a file with only a list of rules is the same as {"rules": [...]}; '[]' turns every trigger off
+    if isinstance(config, list):
+        config = {'rules': config}
+    rules = [dict(rule) for rule in config['rules']]
+    fund_thresholds = config.get('funds', {}).get(fund, {})
+    for rule in rules:
+        if rule['name'] in fund_thresholds:
+            rule['threshold'] = fund_thresholds[rule['name']]
+    return rules
+
+def evaluate_triggers(d_df, rules):
+    """Check every rule against every stock at once; returns the triggered rows and the (rule, direction) of each hit"""
+    # an empty list of rules ('[]' in ark_triggers.json) turns every trigger off
+    if not rules:
+        return np.array([], dtype=int), []
+    checks = []
+    masks = []
+    for rule in rules:
+        column = d_df[rule['column']].to_numpy(dtype=float)
+        # a missing value (a stock that is new today) is never above or below a threshold
+        checks += [(rule, 'above'), (rule, 'below')]
+        masks += [column > rule['threshold'], column < -rule['threshold']]
+    masks = np.column_stack(masks)
+    rows = np.flatnonzero(masks.any(axis=1))
+    return rows, [[checks[hit] for hit in np.flatnonzero(masks[row])] for row in rows]
+
+def changes_heading_record(rules=None):
+    """Heading of the major changes section of the summary file, listing the thresholds"""
+    if rules is None:
+        rules = trigger_rules()
+    text = '\n\nWhat were the major changes to the stocks in each fund?\n\tTriggers:' + \
+           ''.join('\n\t\t' + rule['heading'].format(threshold=rule['threshold']) for rule in rules)
+    return {'type': 'heading', 'section': 'changes',
+            'thresholds': {rule['name']: rule['threshold'] for rule in rules}, 'text': text}
+
+def fund_changes_records(fund, fund_sum_today, d_fund_market_value_pct, mode_median_message, d_df, rules=None,
+                         share_stats=None):
+    """The summary records for one fund: the fund's overall move, and each stock that changed beyond a threshold"""
+    if rules is None:
+        rules = trigger_rules(fund)
+    # Give a summary of the overall move of each individual fund; ie total market value and % change
+    records = [{'type': 'fund', 'section': 'changes', 'fund': fund, 'market_value': fund_sum_today,
+                'd_market_value_pct': d_fund_market_value_pct, 'mode_median': mode_median_message.strip(),
+                'share_stats': share_stats or share_change_stats(d_df),
+                'thresholds': {rule['name']: rule['threshold'] for rule in rules},
+                'text': '\n\n' + fund + ': $' + str(f'{fund_sum_today:,}') + ' (' + \
+                        str(d_fund_market_value_pct) + ' %MV):' + mode_median_message}]
+
+    # Only the stocks that triggered a rule are formatted; a line follows the ticker for each rule it triggered
+    rows, hits = evaluate_triggers(d_df, rules)
+    # each column is taken out of the data frame once, and the triggered rows are looked up by position
+    column = {heading: d_df[heading].to_numpy() for heading in d_df.columns}
+    for x, triggers in zip(rows, hits):
+        formatting = '\n\n\t' + \
+                    str(column['ticker'][x]) + ': ' + column['company'][x] + ': ' + \
+                    str(column['rank'][x]-100) + 'oo' + str(len(d_df)) + '(' + \
+                    str(-column['d_rank'][x].astype(int)) + '): $' + \
+                    str(column['yesterday_share_price'][x]) + ' --> $' + str(column['share price'][x]) + '(' + \
+                    str(column['d_share_price_pct'][x]) + '%): ' + \
+                    str(f"{column['d_shares'][x].astype(int):,}") + ' shares(' + \
+                    str(column['d_shares_pct'][x]) + '%): ' + \
+                    str(column['weight(%)'][x]) + ' wt%(' + \
+                    str(column['d_weight(%)'][x].round(decimals=2)) + '%)(' + \
+                    str(column['d_weight_pct_pct'][x]) + '%%): $' + \
+                    str(f"{column['market value($)'][x].astype(int):,}") + ' MV(' + \
+                    str(column['d_market_value($)_pct'][x].round(decimals=2)) + ' %MV)'
+        for rule, direction in triggers:
+            value = column[rule['column']][x]
+            # a change % is +-inf when yesterday's value was 0 (i.e. a price or market value of 0), and prints as 'inf'
+            negated = str(-int(value)) if np.isfinite(value) else str(-value)
+            formatting += '\n\t\t' + rule[direction].format(value=str(value), negated=negated, amount=float(value))
+        records.append({'type': 'stock', 'fund': fund, 'ticker': column['ticker'][x], 'company': column['company'][x],
+                        'cusip': column['cusip'][x], 'rank': column['rank'][x] - 100, 'holdings': len(d_df),
+                        'd_rank': column['d_rank'][x], 'yesterday_share_price': column['yesterday_share_price'][x],
+                        'share_price': column['share price'][x], 'd_share_price_pct': column['d_share_price_pct'][x],
+                        'd_shares': column['d_shares'][x], 'd_shares_pct': column['d_shares_pct'][x],
+                        'weight': column['weight(%)'][x], 'd_weight': column['d_weight(%)'][x],
+                        'd_weight_pct_pct': column['d_weight_pct_pct'][x], 'market_value': column['market value($)'][x],
+                        'd_market_value_pct': column['d_market_value($)_pct'][x],
+                        'triggers': [{'rule': rule['name'], 'direction': direction,
+                                      'value': json_value(column[rule['column']][x])} for rule, direction in triggers],
+                        'text': formatting})
+    return records
+
 def changed_x_or_more(ticker, fund_sum_today_list, d_fund_market_value_pct_list, summary_file,
-                      mode_median_message_list):
+                      mode_median_message_list, delta_df_list):
     """Highlight the major moves/changes in the ARK etfs"""
-    # For a single stock, a change in share % beyond this threshold (+/-) will output a message detailing the change
-    share_pct_threshold = 10
-    # For a single stock, a change in rank beyond this threshold (+/-) will output a message detailing the change
-    rank_change_threshold = 5
-    # For a single stock, a change in share price % beyond this threshold (+/-) will output a msg detailing the change
-    share_price_pct_change_threshold = 10
-    # For a single stock, a change in market value % beyond this threshold (+/-) will output a msg detailing the change
-    market_value_pct_change_threshold = 10
-
-
-    with open(summary_file, 'a+') as file:
-        file.write('\n\nWhat were the major changes to the stocks in each fund?\n\tTriggers:\n\t\tChange in shares: '
-                   '+/- ' + str(share_pct_threshold) + '%\n\t\tChange in rank: +/- ' + str(rank_change_threshold) +
-                   ' positions\n\t\tChange in share price: +/- ' + str(share_price_pct_change_threshold) + \
-                   '%\n\t\tChange in market value (MV): +/-' + str(market_value_pct_change_threshold) + '%')
-
-    # Loop through each company in each fund, and output changes that are beyond the thresholds defined above
+    report = Summary_report([changes_heading_record()])
+
+    # Output the changes in each fund that are beyond the thresholds of the trigger rules (see 'trigger_rules')
     z=0
     for fund in ticker:
-        # Give a summary of the overall move of each individual fund; ie total market value and % change
-        with open(summary_file, 'a+') as file:
-            file.write('\n\n' + fund + ': $' + str(f'{fund_sum_today_list[z]:,}') + ' (' + \
-                       str(d_fund_market_value_pct_list[z]) + ' %MV):' + mode_median_message_list[z])
+        # The delta data frame for this fund, as calculated today by 'ark_data_frames'
+        report.extend(fund_changes_records(fund, fund_sum_today_list[z], d_fund_market_value_pct_list[z],
+                                           mode_median_message_list[z], delta_df_list[z]))
         z+=1
-
-        # Get the latest file in the delta folder
-        directory = os.path.join(os.getcwd(), fund, 'delta')
-        delta_files = [os.path.join(directory, x) for x in os.listdir(directory) if fund in x]
-        delta_files = sorted(delta_files, reverse=True)
-        # Create a data frame for the latest file in the delta folder
-        d_df = pd.read_csv(delta_files[0])
-
-        # Loop through each company in the ARK fund data frame created above, and output messages if the share price,
-        # number of shares, or rank is beyond the threshold values defined above
-        x=0
-        for company in d_df['company']:
-            # For a company that is triggered by a threshold metric, this formatting will follow the ticker
-
-            formatting = '\n\n\t' + \
-                        str(d_df['ticker'][x]) + ': ' + company + ': ' + \
-                        str(d_df['rank'][x]-100) + 'oo' + str(len(d_df['rank'])) + '(' + \
-                        str(-d_df['d_rank'][x].astype(int)) + '): $' + \
-                        str(d_df['yesterday_share_price'][x]) + ' --> $' + str(d_df['share price'][x]) + '(' + \
-                        str(d_df['d_share_price_pct'][x]) + '%): ' + \
-                        str(f"{d_df['d_shares'][x].astype(int):,}") + ' shares(' + \
-                        str(d_df['d_shares_pct'][x]) + '%): ' + \
-                        str(d_df['weight(%)'][x]) + ' wt%(' + \
-                        str(d_df['d_weight(%)'][x].round(decimals=2)) + '%)(' + \
-                        str(d_df['d_weight_pct_pct'][x]) + '%%): $' + \
-                        str(f"{d_df['market value($)'][x].astype(int):,}") + ' MV(' + \
-                        str(d_df['d_market_value($)_pct'][x].round(decimals=2)) + ' %MV)'
-
-            # If statements will result in an output to the summary file if a company metric is greater than the
-            # threshold metrics limits defined above
-            if d_df['d_shares_pct'][x] > share_pct_threshold or \
-                    d_df['d_shares_pct'][x] < -share_pct_threshold or \
-                    d_df['d_rank'][x] > rank_change_threshold or \
-                    d_df['d_rank'][x] < -rank_change_threshold or \
-                    d_df['d_share_price_pct'][x] > share_price_pct_change_threshold or \
-                    d_df['d_share_price_pct'][x] < -share_price_pct_change_threshold or \
-                    d_df['d_market_value($)_pct'][x] > market_value_pct_change_threshold or \
-                    d_df['d_market_value($)_pct'][x] < -market_value_pct_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write(formatting)
-
-            if d_df['d_shares_pct'][x] > share_pct_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(+) % of shares: ' + str(d_df['d_shares_pct'][x]) + '%')
-
-            if d_df['d_shares_pct'][x] < -share_pct_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(-) % of shares: ' + str(d_df['d_shares_pct'][x]) + '%')
-
-            if d_df['d_rank'][x] > rank_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(-) rank: ' + str(-d_df['d_rank'][x].astype(int)))
-
-            if d_df['d_rank'][x] < -rank_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(+) rank: ' + str(-d_df['d_rank'][x].astype(int)))
-
-            if d_df['d_share_price_pct'][x] > share_price_pct_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(+) share price %: ' + str(d_df['d_share_price_pct'][x]) + '%')
-
-            if d_df['d_share_price_pct'][x] < -share_price_pct_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(-) share price %: ' + str(d_df['d_share_price_pct'][x]) + '%')
-
-            if d_df['d_market_value($)_pct'][x] > market_value_pct_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(+) % of MV: ' + str(d_df['d_market_value($)_pct'][x]) + '%')
-
-            if d_df['d_market_value($)_pct'][x] < -market_value_pct_change_threshold:
-                with open(summary_file, 'a+') as file:
-                    file.write('\n\t\t(-) % of MV ' + str(d_df['d_market_value($)_pct'][x]) + '%')
-
-            x+=1
+    report.write(summary_file, mode='a+')
+
+# The number of stocks listed in each part of the firm-wide section of the summary
+firm_wide_top = 10
+
+def consolidated_file_name(summary_file):
+    """The firm-wide csv file is saved next to the text summary, i.e. summary_2021_03_03_consolidated.csv"""
+    return os.path.splitext(summary_file)[0] + '_consolidated.csv'
+
+def firm_wide_frame(ticker, delta_df_list, removed_df_list):
+    """Every fund's stocks in one data frame: the shares and market value of each (fund, stock) today and yesterday"""
+    # Made from the delta data frames (today's stocks, and how much each changed) and the stocks removed today, so no
+    # file is read again.  A stock new today had 0 shares yesterday; a stock removed today has 0 shares today
+    frames = []
+    for fund, delta_df, removed in zip(ticker, delta_df_list, removed_df_list):
+        frames.append(pd.DataFrame({
+            'fund': fund, 'cusip': delta_df['cusip'].to_numpy(), 'ticker': delta_df['ticker'].to_numpy(),
+            'company': delta_df['company'].to_numpy(), 'shares': delta_df['shares'].to_numpy(),
+            'market value($)': delta_df['market value($)'].to_numpy(),
+            'yesterday_shares': (delta_df['shares'] - delta_df['d_shares'].fillna(delta_df['shares'])).to_numpy(),
+            'yesterday_market_value($)': (delta_df['market value($)'] - delta_df['d_market_value($)'].fillna(
+                delta_df['market value($)'])).to_numpy()}))
+        frames.append(pd.DataFrame({
+            'fund': fund, 'cusip': removed['cusip'].to_numpy(), 'ticker': removed['ticker'].to_numpy(),
+            'company': removed['company'].to_numpy(), 'shares': 0, 'market value($)': 0.0,
+            'yesterday_shares': removed['shares'].to_numpy(),
+            'yesterday_market_value($)': removed['market value($)'].to_numpy()}))
+    return pd.concat(frames, ignore_index=True)
+
+def firm_wide_view(holdings):
+    """One row per stock (cusip) across every fund, and the overlap of the funds; returns (stocks, overlap)"""
+    # 'holdings' is from 'firm_wide_frame'; a row without a cusip (cash) is not a stock and is left out
+    holdings = holdings[holdings['cusip'].notna()]
+    held_today = holdings['shares'] > 0
+    stocks = holdings.assign(funds=held_today).groupby('cusip', sort=False).agg(
+        ticker=('ticker', 'first'), company=('company', 'first'), funds=('funds', 'sum'), shares=('shares', 'sum'),
+        market_value=('market value($)', 'sum'), yesterday_shares=('yesterday_shares', 'sum'),
+        yesterday_market_value=('yesterday_market_value($)', 'sum'))
+    # net buying (+) or selling (-) across all funds, in shares and in $ at today's price (yesterday's price for a
+    # stock that every fund sold out of)
+    # the shares are whole numbers; yesterday's shares only became decimals to make room for new stocks
+    stocks['yesterday_shares'] = stocks['yesterday_shares'].round().astype('int64')
+    stocks['net_shares'] = stocks['shares'] - stocks['yesterday_shares']
+    price = (stocks['market_value'] / stocks['shares']).where(stocks['shares'] > 0,
+                                                             stocks['yesterday_market_value'] /
+                                                             stocks['yesterday_shares'])
+    stocks['net_value'] = (stocks['net_shares'] * price).round(decimals=2)
+    stocks = stocks.reset_index().sort_values('market_value', ascending=False, kind='stable')
+
+    # overlap: the number of stocks held today by both funds (the diagonal is the number each fund holds)
+    held = pd.crosstab(holdings['cusip'][held_today], holdings['fund'][held_today]).clip(upper=1)
+    funds = list(pd.unique(holdings['fund']))
+    overlap = (held.T @ held).reindex(index=funds, columns=funds, fill_value=0)
+    overlap.index.name = overlap.columns.name = None
+    return stocks.reset_index(drop=True), overlap
+
+def firm_wide_record(stocks, overlap, consolidated_file):
+    """The firm-wide section of the summary: the stocks held by the most funds, the largest net buys and sells, and
+    the overlap of the funds"""
+    def stock_lines(rows, amount):
+        return ''.join('\n\t\t' + str(row.ticker) + ': ' + str(row.company) + ': ' + amount(row) for row in rows)
+
+    held = stocks[stocks['shares'] > 0]
+    # cash and the money market fund have no ticker, so they are not listed as stocks (but are in the csv file)
+    listed = stocks[stocks['ticker'].notna()]
+    most_held = listed[listed['shares'] > 0].sort_values('funds', ascending=False, kind='stable').head(firm_wide_top)
+    net_buys = listed[listed['net_value'] > 0].sort_values('net_value', ascending=False,
+                                                           kind='stable').head(firm_wide_top)
+    net_sells = listed[listed['net_value'] < 0].sort_values('net_value', kind='stable').head(firm_wide_top)
+    net_amount = lambda row: f'{int(row.net_shares):+,}' + ' shares ($' + f'{row.net_value:+,.0f}' + ')'
+
+    text = '\n\nWhat does ARK hold across all of its funds?\n\t' + str(len(held)) + ' stocks in ' + \
+           str(len(overlap)) + ' funds: $' + f"{int(held['market_value'].sum()):,}" + ' MV (' + consolidated_file + ')'
+    held_amount = lambda row: str(row.funds) + ' funds: ' + f'{int(row.shares):,}' + ' shares: $' + \
+                              f'{int(row.market_value):,}' + ' MV'
+    text += '\n\tHeld by the most funds:' + stock_lines(most_held.itertuples(), held_amount)
+    text += '\n\tLargest net buys:' + stock_lines(net_buys.itertuples(), net_amount)
+    text += '\n\tLargest net sells:' + stock_lines(net_sells.itertuples(), net_amount)
+    # the overlap matrix, one line per fund
+    width = max([len(fund) for fund in overlap.columns] + [len(str(overlap.to_numpy().max(initial=0)))]) + 2
+    text += '\n\tStocks held by both funds:\n\t\t' + ' ' * width + \
+            ''.join(fund.rjust(width) for fund in overlap.columns)
+    for fund, row in overlap.iterrows():
+        text += '\n\t\t' + fund.ljust(width) + ''.join(str(count).rjust(width) for count in row)
+    text += '\n'
+
+    def stock_records(rows):
+        return [{key: json_value(value) for key, value in
+                 {'ticker': row.ticker, 'company': row.company, 'cusip': row.cusip, 'funds': row.funds,
+                  'shares': row.shares, 'market_value': row.market_value, 'net_shares': row.net_shares,
+                  'net_value': row.net_value}.items()} for row in rows.itertuples()]
+    return {'type': 'firm_wide', 'stocks': len(held), 'market_value': held['market_value'].sum(),
+            'consolidated_file': consolidated_file, 'most_held': stock_records(most_held),
+            'net_buys': stock_records(net_buys), 'net_sells': stock_records(net_sells),
+            'overlap': {fund: {other: int(count) for other, count in row.items()} for fund, row in overlap.iterrows()},
+            'text': text}
+
+def firm_wide_summary(ticker, delta_df_list, removed_df_list, summary_file):
+    """The firm-wide view of every fund at once: saves the consolidated csv file and returns the summary record"""
+    stocks, overlap = firm_wide_view(firm_wide_frame(ticker, delta_df_list, removed_df_list))
+    consolidated_file = consolidated_file_name(summary_file)
+    with atomic_file(consolidated_file) as temp_file:
+        stocks.to_csv(temp_file, index=False)
+    return firm_wide_record(stocks, overlap, consolidated_file)
+
+def trade_flow(holdings):
+    """The estimated trades of each (fund, stock) in 'holdings' (see 'firm_wide_frame', or 'trade_flow_history'): the
+    change in market value split into the shares bought or sold, and the change in the share price"""
+    # ARK doesn't publish its trades, only its holdings each day, so a trade is the change in shares valued at today's
+    # closing price (yesterday's for a stock that was sold out of, as it has no price today).  What is left of the
+    # change in market value is the price move of yesterday's shares:
+    #   market value - yesterday's market value = (shares - yesterday's shares) x price + price move
+    # A stock whose shares didn't change had no trade, only a price move.  Worked out for every row at once
+    shares = holdings['shares'].to_numpy(dtype=float)
+    yesterday_shares = holdings['yesterday_shares'].to_numpy(dtype=float)
+    market_value = holdings['market value($)'].to_numpy(dtype=float)
+    yesterday_market_value = holdings['yesterday_market_value($)'].to_numpy(dtype=float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        price = np.where(shares > 0, market_value / shares, yesterday_market_value / yesterday_shares)
+    traded_shares = shares - yesterday_shares
+    trade_value = np.where(traded_shares != 0, traded_shares * price, 0.0)
+    flows = holdings.assign(price=price.round(4), traded_shares=traded_shares.round().astype('int64'),
+                            trade_value=trade_value.round(2),
+                            price_move=(market_value - yesterday_market_value - trade_value).round(2))
+    flows['action'] = np.select([(yesterday_shares == 0) & (shares > 0), (shares == 0) & (yesterday_shares > 0),
+                                 traded_shares > 0, traded_shares < 0], ['added', 'removed', 'bought', 'sold'], 'held')
+    return flows
+
+def net_trade_flow(flows):
+    """One row per stock (cusip) and date across every fund: the $ bought and sold by all funds, the net, and the
+    price move; ranked by the size of the net flow on each date (1 is the largest buy or sell)"""
+    # a row without a cusip (cash) is not a stock and is left out.  'crossed' is the $ that one fund sold and another
+    # fund bought on the same day: it netted out, so the firm as a whole didn't trade it.  When 'date' covers more than
+    # one day (see 'ark_trades.py'), 'funds_buying' and 'funds_selling' count each day a fund bought or sold
+    flows = flows[flows['cusip'].notna()]
+    trade_value = flows['trade_value']
+    stocks = flows.assign(bought=trade_value.clip(lower=0), sold=trade_value.clip(upper=0),
+                          funds_buying=trade_value > 0, funds_selling=trade_value < 0).groupby(
+        ['date', 'cusip'], sort=False).agg(ticker=('ticker', 'first'), company=('company', 'first'),
+                                           bought=('bought', 'sum'), sold=('sold', 'sum'),
+                                           funds_buying=('funds_buying', 'sum'), funds_selling=('funds_selling', 'sum'),
+                                           net_shares=('traded_shares', 'sum'), price_move=('price_move', 'sum'))
+    stocks['net_value'] = (stocks['bought'] + stocks['sold']).round(2)
+    stocks['crossed'] = np.minimum(stocks['bought'], stocks['sold'].abs()).round(2)
+    stocks = stocks.reset_index()
+    stocks['flow_rank'] = stocks.groupby('date', sort=False)['net_value'].transform(
+        lambda net_value: net_value.abs().rank(ascending=False, method='first')).astype('int64')
+    return stocks.sort_values(['date', 'flow_rank'], kind='stable').reset_index(drop=True)
+
+def delta_file_date(delta_df):
+    """the YYYY_MM_DD date of a delta data frame, from its 'date' column; None if it has no rows"""
+    if len(delta_df) == 0:
+        return None
+    date = delta_df['date'].iloc[0]
+    return date.strftime('%Y_%m_%d') if hasattr(date, 'strftime') else str(date)
+
+def trade_flow_history(ticker, start='0000_00_00', end='9999_99_99'):
+    """'trade_flow' of every fund on every date from 'start' to 'end' (YYYY_MM_DD), from the saved delta files"""
+    # Every delta file is stacked into one long data frame, as in 'backfill_chunk'.  A delta file only has today's
+    # stocks, so the stocks removed on a date are the ones in the delta file of the date before that aren't in the
+    # date's delta file; the date before 'start' is loaded for that, and then left out.  (The stocks removed on a
+    # fund's first delta date are not known, as there is no delta file before it)
+    columns = ['date', 'company', 'ticker', 'cusip', 'shares', 'market value($)', 'd_shares', 'd_market_value($)']
+    frames, keys = [], []
+    for fund in ticker:
+        delta_files = Archive_manifest(fund).date_range('delta', end=end)
+        first = max(bisect.bisect_left([date for date, path in delta_files], start) - 1, 0)
+        for date, path in delta_files[first:]:
+            frames.append(store.load(path, columns=columns))
+            keys.append((fund, date))
+    if not frames:
+        return trade_flow(pd.DataFrame(columns=['fund', 'date', 'cusip', 'ticker', 'company', 'shares',
+                                                'market value($)', 'yesterday_shares', 'yesterday_market_value($)']))
+    panel = pd.concat(frames, keys=keys, names=['fund', 'file_date', 'row']).reset_index(level=['fund', 'file_date'])
+    panel = panel.reset_index(drop=True)
+    # the number of each fund's delta file, to find the file after each one
+    panel['file'] = panel.groupby('fund', sort=False)['file_date'].rank(method='dense').astype('int64')
+    held = pd.DataFrame({
+        'fund': panel['fund'], 'date': panel['file_date'], 'file': panel['file'], 'cusip': panel['cusip'],
+        'ticker': panel['ticker'], 'company': panel['company'], 'shares': panel['shares'],
+        'market value($)': panel['market value($)'],
+        'yesterday_shares': panel['shares'] - panel['d_shares'].fillna(panel['shares']),
+        'yesterday_market_value($)': panel['market value($)'] - panel['d_market_value($)'].fillna(
+            panel['market value($)'])})
+
+    # removed: a stock (with a cusip) in a fund's file that is not in the fund's next file
+    stocks = held[held['cusip'].notna()].drop_duplicates(subset=['fund', 'file', 'cusip'])
+    # each fund's next file (and its date), and the stocks in it, moved back by one file to line up with this file
+    next_file = held[['fund', 'file', 'date']].drop_duplicates(subset=['fund', 'file'])
+    next_file = next_file.assign(file=next_file['file'] - 1).rename(columns={'date': 'next_date'})
+    next_stocks = stocks[['fund', 'file', 'cusip']].assign(file=stocks['file'] - 1)
+    stocks = stocks.merge(next_file, on=['fund', 'file'])
+    stocks = stocks.merge(next_stocks, on=['fund', 'file', 'cusip'], how='left', indicator='kept')
+    gone = stocks[stocks['kept'] == 'left_only']
+    removed = pd.DataFrame({
+        'fund': gone['fund'], 'date': gone['next_date'], 'file': gone['file'] + 1, 'cusip': gone['cusip'],
+        'ticker': gone['ticker'], 'company': gone['company'], 'shares': 0, 'market value($)': 0.0,
+        'yesterday_shares': gone['shares'], 'yesterday_market_value($)': gone['market value($)']})
+
+    holdings = pd.concat([held, removed], ignore_index=True)
+    holdings = holdings[holdings['date'].between(start, end)]
+    return trade_flow(holdings.drop(columns='file').sort_values(['date', 'fund'], kind='stable'))
+
+def trade_flow_file_name(summary_file):
+    """The trade flow csv file is saved next to the text summary, i.e. summary_2021_03_03_trades.csv"""
+    return os.path.splitext(summary_file)[0] + '_trades.csv'
+
+def trade_flow_record(flows, stocks, trades_file):
+    """The trade flow section of the summary: the $ each fund bought and sold, the price moves, and the stocks one
+    fund sold while another fund bought them"""
+    def money(value):
+        return ('-$' if value < 0 else '$') + f'{abs(value):,.0f}'
+
+    traded = flows.assign(bought=flows['trade_value'].clip(lower=0), sold=flows['trade_value'].clip(upper=0),
+                          stocks_bought=flows['trade_value'] > 0, stocks_sold=flows['trade_value'] < 0)
+    sums = ['bought', 'sold', 'price_move', 'stocks_bought', 'stocks_sold']
+    funds = traded.groupby('fund', sort=False)[sums].sum()
+    funds.loc['All funds'] = funds.sum()
+    funds = funds.astype({'stocks_bought': 'int64', 'stocks_sold': 'int64'})
+    funds['net'] = funds['bought'] + funds['sold']
+    funds[['bought', 'sold', 'price_move', 'net']] = funds[['bought', 'sold', 'price_move', 'net']].round(2)
+    crossed = stocks[(stocks['crossed'] > 0) & stocks['ticker'].notna()].sort_values('crossed', ascending=False,
+                                                                                     kind='stable').head(firm_wide_top)
+
+    text = '\n\nWhat did ARK buy and sell? (estimated at the closing prices: ' + trades_file + ')'
+    # 'itertuples' keeps the counts whole numbers ('iterrows' makes each row one series, all floats)
+    for row in funds.itertuples():
+        text += '\n\t' + row.Index + ': bought ' + money(row.bought) + ' (' + str(row.stocks_bought) + \
+                ' stocks), sold ' + money(-row.sold) + ' (' + str(row.stocks_sold) + ' stocks), net ' + \
+                money(row.net) + '; price moves ' + money(row.price_move)
+    text += '\n\tSold by one fund and bought by another (netted out across the funds):'
+    text += ''.join('\n\t\t' + str(row.ticker) + ': ' + str(row.company) + ': ' + money(row.crossed) + ' (' +
+                    str(row.funds_selling) + ' selling, ' + str(row.funds_buying) + ' buying)'
+                    for row in crossed.itertuples()) or '\n\t\tnone'
+    text += '\n'
+
+    fund_records = {row.Index: {heading: json_value(getattr(row, heading)) for heading in funds.columns}
+                    for row in funds.itertuples()}
+    crossed_records = [{key: json_value(value) for key, value in
+                        {'ticker': row.ticker, 'company': row.company, 'cusip': row.cusip, 'crossed': row.crossed,
+                         'funds_buying': row.funds_buying, 'funds_selling': row.funds_selling}.items()}
+                       for row in crossed.itertuples()]
+    return {'type': 'trade_flow', 'trades_file': trades_file, 'funds': fund_records, 'crossed': crossed_records,
+            'text': text}
+
+def trade_flow_summary(ticker, delta_df_list, removed_df_list, summary_file):
+    """TRADE FLOW - the estimated trades of every fund today (see 'trade_flow'), made from the same data frames as the
+    firm-wide view: saves each stock's net flow, ranked, to the trades csv file and returns the summary record"""
+    holdings = firm_wide_frame(ticker, delta_df_list, removed_df_list)
+    dates = {fund: delta_file_date(delta_df) for fund, delta_df in zip(ticker, delta_df_list)}
+    flows = trade_flow(holdings.assign(date=holdings['fund'].map(dates)))
+    stocks = net_trade_flow(flows)
+    trades_file = trade_flow_file_name(summary_file)
+    with atomic_file(trades_file) as temp_file:
+        stocks.to_csv(temp_file, index=False)
+    return trade_flow_record(flows, stocks, trades_file)
+
+# Bump this number whenever a change to the analysis code changes its results (the delta formulas, the stats, or the
+# summary text); every result saved in the analysis cache by an older version is then ignored
+analysis_version = 2
+
+class Analysis_cache():
+    """The results of 'analyze_fund' saved by the content of the fund's (today, yesterday) files, so a fund whose files
+    have not changed (weekends, holidays, running the program twice) is loaded instead of worked out again"""
+    # Each result is a pickle file named by its key: a hash of the version above, the fund, the sha256 of both files,
+    # and the fund's trigger rules.  When the folder is bigger than 'max_bytes' the least recently used results are
+    # deleted
+    def __init__(self, cache_dir='analysis_cache', max_bytes=200 * 1024 * 1024):
+        self.cache_dir = os.path.join(os.getcwd(), cache_dir)
+        self.max_bytes = max_bytes
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def snapshot_hash(self, fund, filepath):
+        """sha256 of an archive file, from the fund's manifest if it is recorded there"""
+        manifest = Archive_manifest(fund)
+        file_name = os.path.basename(filepath)
+        entry = manifest.entries['archive'].get(manifest.date_of('archive', file_name))
+        if entry is not None and entry['file'] == file_name:
+            return entry['sha256']
+        return file_hash(filepath)
+
+    def key(self, fund, today_filepath, yesterday_filepath, rules):
+        parts = [str(analysis_version), fund, self.snapshot_hash(fund, today_filepath),
+                 self.snapshot_hash(fund, yesterday_filepath), json.dumps(rules, sort_keys=True)]
+        return hashlib.sha256('\n'.join(parts).encode()).hexdigest()
+
+    def get(self, key):
+        """the saved result for the key, or None"""
+        cache_file = os.path.join(self.cache_dir, key + '.pkl')
+        try:
+            result = pd.read_pickle(cache_file)
+        except (FileNotFoundError, EOFError):
+            return None
+        # the file's modified time is when it was last used, for the eviction in 'evict'
+        os.utime(cache_file)
+        return result
+
+    def put(self, key, result):
+        cache_file = os.path.join(self.cache_dir, key + '.pkl')
+        # write to a temporary file first and then rename it, so there is never a half-written file
+        with atomic_file(cache_file) as temp_file:
+            pd.to_pickle(result, temp_file)
+
+    def evict(self):
+        """delete the least recently used results until the cache is no bigger than 'max_bytes'"""
+        cache_files = []
+        for file_name in os.listdir(self.cache_dir):
+            if file_name.endswith('.pkl'):
+                stat = os.stat(os.path.join(self.cache_dir, file_name))
+                cache_files.append((stat.st_mtime, stat.st_size, file_name))
+        cache_files.sort()
+        total = sum(size for used, size, file_name in cache_files)
+        for used, size, file_name in cache_files:
+            if total <= self.max_bytes:
+                break
+            os.unlink(os.path.join(self.cache_dir, file_name))
+            total -= size
+
+class Pipeline_run():
+    """A checkpoint of each step (and each fund) a run of the main program has finished, so a run that stopped partway
+    can be started again and only does the steps that were not finished"""
+    # Each run has a folder 'runs/YYYY_MM_DD_HHMMSS' with 'checkpoint.json': for each 'step FUND' that was finished, its
+    # value (i.e. the date of the ingested file) and the files it made; the analysis result of each fund is saved in
+    # the folder as well.  A step is only skipped if the files it made are still there.  A new run resumes the last
+    # run if that run did not finish, but only on the day it was started and for up to 'max_age' hours: the next day
+    # ARK has published new files, and the old run's steps (its downloads and the dates it ingested) are out of date.
+    # The last 'keep' runs are kept
+    def __init__(self, run_dir='runs', fresh=False, keep=10, max_age=12):
+        self.run_dir = os.path.join(os.getcwd(), run_dir)
+        self.keep = keep
+        runs = sorted(os.listdir(self.run_dir)) if os.path.isdir(self.run_dir) else []
+        now = datetime.datetime.now()
+        self.checkpoint = None
+        if runs and not fresh:
+            checkpoint_file = os.path.join(self.run_dir, runs[-1], 'checkpoint.json')
+            if os.path.isfile(checkpoint_file):
+                with open(checkpoint_file, 'r') as file:
+                    checkpoint = json.load(file)
+                started = datetime.datetime.strptime(checkpoint['started'], '%Y_%m_%d_%H%M%S')
+                if checkpoint['finished']:
+                    pass
+                elif started.date() == now.date() and now - started < datetime.timedelta(hours=max_age):
+                    self.checkpoint = checkpoint
+                    print('Resuming the run started ' + checkpoint['run'] + ': ' + str(len(checkpoint['steps'])) +
+                          ' steps were already finished (' + ', '.join(sorted(checkpoint['steps'])) + ')')
+                else:
+                    print('The run started ' + checkpoint['run'] + ' did not finish, but it is from an earlier day '
+                          'or more than ' + str(max_age) + ' hours old; starting a new run')
+        if self.checkpoint is None:
+            run = now.strftime('%Y_%m_%d_%H%M%S')
+            # two runs started in the same second each get their own folder
+            if run in runs:
+                run += '_' + str(len(runs))
+            self.checkpoint = {'run': run, 'started': now.strftime('%Y_%m_%d_%H%M%S'), 'finished': False, 'steps': {}}
+        self.folder = os.path.join(self.run_dir, self.checkpoint['run'])
+        os.makedirs(self.folder, exist_ok=True)
+        self.save()
+
+    @staticmethod
+    def step_name(step, fund=None):
+        return step if fund is None else step + ' ' + fund
+
+    def done(self, step, fund=None):
+        """True if the step was finished (for the fund), and the files it made are still there"""
+        record = self.checkpoint['steps'].get(self.step_name(step, fund))
+        return record is not None and all(os.path.isfile(filepath) for filepath in record['files'])
+
+    def value(self, step, fund=None):
+        return self.checkpoint['steps'][self.step_name(step, fund)]['value']
+
+    def pending(self, step, ticker):
+        """the funds the step has not been finished for"""
+        return [fund for fund in ticker if not self.done(step, fund)]
+
+    def complete(self, step, fund=None, value=None, files=()):
+        """record a finished step; 'files' are the files it made (a file that is gone makes the step run again)"""
+        self.checkpoint['steps'][self.step_name(step, fund)] = {'value': value,
+                                                                'files': [os.path.abspath(path) for path in files]}
+        self.save()
+
+    def save_result(self, step, fund, result):
+        """save a fund's result (i.e. of 'analyze_fund') and record the step as finished"""
+        result_file = os.path.join(self.folder, step + '_' + fund + '.pkl')
+        with atomic_file(result_file) as temp_file:
+            pd.to_pickle(result, temp_file)
+        self.complete(step, fund, files=[result_file] + [result[key] for key in ['delta_filepath'] if key in result])
+
+    def load_result(self, step, fund):
+        print(fund + ': already analyzed in this run, loaded from the checkpoint')
+        return pd.read_pickle(os.path.join(self.folder, step + '_' + fund + '.pkl'))
+
+    def save(self):
+        with atomic_file(os.path.join(self.folder, 'checkpoint.json')) as temp_file:
+            with open(temp_file, 'w') as file:
+                json.dump(self.checkpoint, file, indent=1)
+
+    def finish(self):
+        """record that the run finished (the next run starts from the beginning), and delete the oldest runs"""
+        self.checkpoint['finished'] = True
+        self.save()
+        for run in sorted(os.listdir(self.run_dir))[:-self.keep]:
+            shutil.rmtree(os.path.join(self.run_dir, run), ignore_errors=True)
+
+    def download(self, urls, workers=4):
+        """WEB SCRAPE - download the files of the funds that were not downloaded (or ingested) yet"""
+        pending = [fund for fund in urls if not self.done('ingest', fund) and not self.done('download', fund)]
+        status = Holdings_downloader({fund: urls[fund] for fund in pending}, workers=workers).download_all()
+        for fund, result in status.items():
+            if result != 'failed':
+                self.complete('download', fund, result, [os.path.join(os.getcwd(), fund + '.csv')])
+        failed = [fund for fund, result in status.items() if result == 'failed']
+        if failed:
+            raise RuntimeError('Could not download the csv file for: ' + ', '.join(failed))
+        return status
+
+    def ingest(self, ticker):
+        """INGEST - ingest the downloaded file of each fund that was not ingested yet; returns 'ticker':'date'"""
+        for fund in self.pending('ingest', ticker):
+            with metrics.stage('ingest', fund) as stage:
+                date = Ingest_downloaded_files([fund]).ingest_file(fund, stage)
+            self.complete('ingest', fund, date, [Archive_manifest(fund).path('archive', date)])
+        return {fund: self.value('ingest', fund) for fund in ticker}
+
+def analyze_fund(fund, today_filepath, yesterday_filepath, today_date, fund_store, cache=None, run_metrics=None):
+    """Every analysis step for one fund: load -> delta -> stats -> triggers; returns the fund's part of the summary"""
+    # The funds don't depend on each other, so this runs in its own process for each fund (see 'parallel_analysis')
+    # 'fund_store' is passed in because a new process starts with the default 'store'; for the same reason the fund is
+    # measured with its own 'Pipeline_metrics' (set up like 'run_metrics'), and its records are returned in the result
+    fund_metrics = Pipeline_metrics(run_metrics.enabled, run_metrics.memory) if run_metrics else \
+        Pipeline_metrics(enabled=False)
+    with fund_metrics.stage('analyze_fund', fund) as stage:
+        result = analyze_fund_steps(fund, today_filepath, yesterday_filepath, today_date, fund_store, cache)
+        stage['rows'] = len(result['delta_df'])
+    # add the delta file to the security index and the multi-day signals, measured on its own (see 'add_delta_files');
+    # for a fund loaded from the cache both are usually up to date already, and nothing is added again
+    with fund_metrics.stage('index_and_signals', fund) as stage:
+        add_delta_file(fund, today_date, result['delta_df'], fund_store)
+        stage['rows'] = len(result['delta_df'])
+    result['metrics'] = fund_metrics.records
+    return result
+
+def analyze_fund_steps(fund, today_filepath, yesterday_filepath, today_date, fund_store, cache=None):
+    """The steps of 'analyze_fund', loaded from the analysis cache if the fund's files have not changed"""
+    delta_path = os.path.join(os.getcwd(), fund, 'delta', fund + '_' + today_date + '_delta')
+    if cache is not None:
+        key = cache.key(fund, today_filepath, yesterday_filepath, trigger_rules(fund))
+        result = cache.get(key)
+        if result is not None:
+            print(fund + ': no new files, loaded from the analysis cache')
+            # the delta file is only saved again if it is missing (or the store's format has changed)
+            result['delta_filepath'] = delta_path + fund_store.extension
+            if not os.path.isfile(result['delta_filepath']):
+                fund_store.save(result['delta_df'], delta_path)
+                Archive_manifest(fund).add('delta', today_date, result['delta_filepath'], len(result['delta_df']))
+            return result
+
+    t_df = fund_store.load(today_filepath)
+    y_df = fund_store.load(yesterday_filepath)
+
+    # compare today's holdings with yesterday's and save the delta file (same as 'ark_data_frames')
+    delta_df, removed = delta_engine(t_df, y_df)
+    print('Saving ' + fund + ' file...')
+    delta_filepath = fund_store.save(delta_df, delta_path)
+    Archive_manifest(fund).add('delta', today_date, delta_filepath, len(delta_df))
+
+    fund_sum_today, fund_sum_yesterday, d_fund_market_value_pct = fund_market_value(t_df, y_df)
+    # the distribution of the change % of shares is worked out once, for both the message and the fund's record
+    share_stats = share_change_stats(delta_df)
+    mode_median = mode_median_message(delta_df, share_stats)
+    result = {'fund': fund, 'delta_filepath': delta_filepath, 'delta_df': delta_df, 'removed': removed,
+              'fund_sum_today': fund_sum_today, 'fund_sum_yesterday': fund_sum_yesterday,
+              'd_fund_market_value_pct': d_fund_market_value_pct,
+              'added_or_removed': added_or_removed_records(fund, t_df, y_df),
+              'changes': fund_changes_records(fund, fund_sum_today, d_fund_market_value_pct, mode_median, delta_df,
+                                              share_stats=share_stats)}
+    if cache is not None:
+        cache.put(key, result)
+    return result
+
+def parallel_analysis(ticker, today_filepath_list, yesterday_filepath_list, today_date_dict, summary_file,
+                      workers=None, cache=None, checkpoint=None):
+    """Run 'analyze_fund' for every fund in a pool of processes, then put the summary file together in fund order"""
+    # Does the same as 'ark_data_frames', 'fund_sum_market_value', 'stocks_added_or_removed',
+    # 'median_mode_change_in_shares' and 'changed_x_or_more'.  workers=1 runs the funds one after another
+    # 'cache' is an optional 'Analysis_cache', so funds whose files have not changed are not worked out again
+    # 'checkpoint' is an optional 'Pipeline_run': each fund's result is saved to it as soon as the fund is done, and
+    # the funds done before a run stopped partway are loaded from it instead of being analyzed again
+    workers = workers or os.cpu_count()
+    results = {}
+    if checkpoint is not None:
+        results = {fund: checkpoint.load_result('analyze', fund) for fund in ticker if checkpoint.done('analyze', fund)}
+    pending = [x for x, fund in enumerate(ticker) if fund not in results]
+    jobs = [[ticker[x] for x in pending], [today_filepath_list[x] for x in pending],
+            [yesterday_filepath_list[x] for x in pending], [today_date_dict[ticker[x]] for x in pending],
+            [store] * len(pending), [cache] * len(pending), [metrics] * len(pending)]
+
+    def finished(result):
+        # the measurements of each fund, made in its own process
+        metrics.records.extend(result.pop('metrics'))
+        results[result['fund']] = result
+        if checkpoint is not None:
+            checkpoint.save_result('analyze', result['fund'], result)
+
+    if workers == 1 or len(pending) <= 1:
+        for result in map(analyze_fund, *jobs):
+            finished(result)
+    elif pending:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+            # each fund is saved as soon as it is done; the summary is still put together in fund order below.  If a
+            # fund fails, the other funds are still saved before the error is raised
+            errors = []
+            for future in concurrent.futures.as_completed([executor.submit(analyze_fund, *job) for job in zip(*jobs)]):
+                try:
+                    finished(future.result())
+                except Exception as error:
+                    errors.append(error)
+        if errors:
+            raise errors[0]
+    if cache is not None:
+        cache.evict()
+    results = [results[fund] for fund in ticker]
+
+    merge_summary(results, summary_file)
+    return [result['delta_filepath'] for result in results], [result['delta_df'] for result in results]
+
+def merge_summary(results, summary_file):
+    """MERGE - the summary is put together from each fund's 'analyze_fund' result (in fund order), then the text file
+    and the JSON lines file are each written once"""
+    report = Summary_report([market_value_record([result['fund_sum_today'] for result in results],
+                                                 [result['fund_sum_yesterday'] for result in results])])
+    report.add(added_or_removed_heading)
+    for result in results:
+        report.extend(result['added_or_removed'])
+    report.add(changes_heading_record())
+    for result in results:
+        report.extend(result['changes'])
+    # FIRM-WIDE - every fund at once, by stock
+    report.add(firm_wide_summary([result['fund'] for result in results], [result['delta_df'] for result in results],
+                                 [result['removed'] for result in results], summary_file))
+    # TRADE FLOW - the $ bought and sold by each fund, and the price moves
+    report.add(trade_flow_summary([result['fund'] for result in results], [result['delta_df'] for result in results],
+                                  [result['removed'] for result in results], summary_file))
+    report.write(summary_file, json_file=summary_json_file_name(summary_file))
+    return report
+
+class Holdings_watcher():
+    """Daemon mode: check ARK's website for new files on a schedule, and process each fund as soon as its new file is
+    published, without waiting for the other funds"""
+    # Each fund is watched by its own asyncio task: ask the website 'has this changed?' (a conditional request, so an
+    # unchanged file is not downloaded), and when a new file lands: ingest it, compare it with the fund's previous file,
+    # and write the summary of that date again with every fund that has published that date so far.  The downloads
+    # and the pandas work run in threads, so one slow fund doesn't hold up the others
+    def __init__(self, ticker, urls, interval=300, cache=None):
+        self.ticker = ticker
+        self.urls = urls
+        self.interval = interval
+        # the same cache the main program uses, so a fund that was already analyzed is loaded instead
+        self.cache = cache
+        self.downloader = Holdings_downloader(urls, workers=len(ticker))
+        self.validators = self.downloader.load_validators()
+        # the 'analyze_fund' result of each fund, by date; and (fund, date) of each new file, in the order processed
+        self.results = {}
+        self.processed = []
+        # a fund is ingested and analyzed by one thread at a time: the summary of another fund's new file may need this
+        # fund's result while its own thread is still working on it, and then waits for it instead of analyzing it too
+        self.fund_locks = {fund: threading.Lock() for fund in ticker}
+
+    def process_fund(self, fund):
+        """ingest the fund's downloaded file, and compare it with the previous file; returns the date, or None if the
+        file was already in the archive"""
+        with self.fund_locks[fund]:
+            archived_dates = Archive_manifest(fund).dates['archive']
+            date = Ingest_downloaded_files([fund]).ingest_file(fund)
+            # the file is only new if it wasn't archived before and is now the latest file (an older file that was
+            # published late is just archived)
+            if date in archived_dates or Archive_manifest(fund).dates['archive'][-1] != date:
+                return None
+            today_filepath = Get_working_files([fund]).today_files()
+            yesterday_filepath = Get_working_files([fund]).yesterday_files(today_filepath)
+            result = analyze_fund(fund, today_filepath[0], yesterday_filepath[0], date, store, self.cache)
+            metrics.records.extend(result.pop('metrics'))
+            self.results.setdefault(date, {})[fund] = result
+            return date
+
+    def update_summary(self, date):
+        """write the summary of 'date' with every fund whose latest file is from that date"""
+        results = []
+        for fund in self.ticker:
+            # wait for the fund's own thread if it is processing the fund right now (its result is used then)
+            with self.fund_locks[fund]:
+                manifest = Archive_manifest(fund)
+                if not manifest.dates['archive'] or manifest.dates['archive'][-1] != date:
+                    continue
+                if fund not in self.results.get(date, {}):
+                    # a fund processed before the watcher started (i.e. by the main program): from the analysis cache
+                    today_filepath = manifest.latest()
+                    yesterday_filepath = Get_working_files([fund]).yesterday_files([today_filepath])[0]
+                    result = analyze_fund(fund, today_filepath, yesterday_filepath, date, store, self.cache)
+                    metrics.records.extend(result.pop('metrics'))
+                    self.results.setdefault(date, {})[fund] = result
+                results.append(self.results[date][fund])
+        # same name as 'summary_file_name', with the folder separator of this system
+        summary_file = os.path.join('summary', 'summary_' + date + '.txt')
+        merge_summary(results, summary_file)
+        print('Summary ' + date + ' updated: ' + ', '.join(result['fund'] for result in results))
+        return summary_file
+
+    async def watch_fund(self, fund, polls=None):
+        """check one fund every 'interval' seconds ('polls' times, or forever)"""
+        poll = 0
+        while polls is None or poll < polls:
+            poll += 1
+            status, headers = await asyncio.to_thread(self.downloader.fetch, fund, self.urls[fund],
+                                                      self.validators.get(fund, {}), False)
+            if status == 'downloaded':
+                # the validators are saved here, in the event loop, so two funds never write the file at once
+                self.validators[fund] = headers
+                self.downloader.save_validators(self.validators)
+                date = await asyncio.to_thread(self.process_fund, fund)
+                if date is not None:
+                    self.processed.append((fund, date))
+                    print(fund + ': new file for ' + date)
+                    # one summary is written at a time
+                    async with self.summary_lock:
+                        await asyncio.to_thread(self.update_summary, date)
+            elif status == 'failed':
+                print(fund + ': could not check for a new file, trying again in ' + str(self.interval) + 's')
+            await asyncio.sleep(self.interval)
+
+    async def run(self, polls=None):
+        """watch every fund at the same time; 'polls' is the number of checks of each fund (None: forever)"""
+        Folders_organize(self.ticker).create_etf_directories()
+        Folders_organize(self.ticker).create_etf_sub_directories()
+        self.summary_lock = asyncio.Lock()
+        # each fund is processed in its own thread
+        import_now()
+        try:
+            await asyncio.gather(*(self.watch_fund(fund, polls) for fund in self.ticker))
+        finally:
+            self.downloader.close_connections()
+        return self.processed
+
+def test_watcher(staged_folders, interval=0.2):
+    """Test mode: serve each folder of TICKER.csv files in turn from a local stand-in server, one fund at a time, and
+    check that the watcher processes each fund's new file"""
+    # The first folder is served from the start; each file of the next folders is put on the server one at a time
+    server_dir = tempfile.mkdtemp()
+    for file_name in os.listdir(staged_folders[0]):
+        shutil.copy(os.path.join(staged_folders[0], file_name), server_dir)
+    tickers = sorted(file[:-4] for file in os.listdir(server_dir) if file.endswith('.csv'))
+    server = Local_holdings_server(server_dir).start()
+    home_dir = os.getcwd()
+    try:
+        with tempfile.TemporaryDirectory() as work_dir:
+            os.chdir(work_dir)
+            watcher = Holdings_watcher(tickers, server.urls(tickers), interval=interval)
+
+            async def publish():
+                # give the watcher time to pick up the first folder, then publish one fund's new file at a time
+                for folder in staged_folders[1:]:
+                    for file_name in sorted(os.listdir(folder)):
+                        await asyncio.sleep(interval * 5)
+                        shutil.copy(os.path.join(folder, file_name), os.path.join(server_dir, file_name))
+                        print('published ' + file_name)
+
+            async def test():
+                polls = 5 * (1 + len(tickers) * (len(staged_folders) - 1)) + 5
+                await asyncio.gather(watcher.run(polls), publish())
+
+            asyncio.run(test())
+            os.chdir(home_dir)
+    finally:
+        os.chdir(home_dir)
+        server.stop()
+        shutil.rmtree(server_dir)
+    print('processed: ' + ', '.join(fund + ' ' + date for fund, date in watcher.processed))
+    return watcher.processed
+
+class Synthetic_holdings():
+    """Made-up holdings files in ARK's csv format (date row, cusip, shares, market value, weight, 3 line disclaimer),
+    for the benchmark; the same seed always makes the same files"""
+    # The funds hold stocks from one shared list of stocks, so a stock can be in more than one fund like the real funds.
+    # Every day each stock's price moves (about 3% a day), about 10% of the holdings buy or sell up to 30% of their
+    # shares, and about 2% of the holdings are replaced
+    fund_names = ['ARKK', 'ARKQ', 'ARKW', 'ARKG', 'ARKF', 'PRNT', 'IZRL']
+
+    def __init__(self, funds=7, holdings=30, seed=1):
+        self.random = np.random.default_rng(seed)
+        self.ticker = (self.fund_names + ['BM' + str(n).zfill(3) for n in range(funds)])[:funds]
+        self.stocks = max(3 * holdings, 100)
+        self.price = self.random.uniform(5, 900, self.stocks)
+        self.holdings = {}
+        for fund in self.ticker:
+            stock_ids = self.random.choice(self.stocks, holdings, replace=False)
+            self.holdings[fund] = {'id': stock_ids, 'shares': self.random.integers(1000, 10**7, holdings)}
+        self.day = 0
+
+    def next_day(self):
+        """move the prices and change the holdings of each fund to the next day"""
+        self.day += 1
+        self.price = self.price * self.random.lognormal(0, 0.03, self.stocks)
+        for fund in self.ticker:
+            holding = self.holdings[fund]
+            count = len(holding['id'])
+            trades = self.random.random(count) < 0.1
+            holding['shares'] = np.where(trades, (holding['shares'] * self.random.uniform(0.7, 1.3, count)).astype(int),
+                                         holding['shares'])
+            replaced = np.flatnonzero(self.random.random(count) < 0.02)
+            if len(replaced):
+                not_held = np.setdiff1d(np.arange(self.stocks), holding['id'])
+                holding['id'][replaced] = self.random.choice(not_held, len(replaced), replace=False)
+                holding['shares'][replaced] = self.random.integers(1000, 10**6, len(replaced))
+
+    def write_day(self, date, folder):
+        """write 'FUND.csv' for each fund into 'folder', as downloaded from the ARK website; 'date' is MM/DD/YYYY"""
+        for fund in self.ticker:
+            holding = self.holdings[fund]
+            market_value = np.round(holding['shares'] * self.price[holding['id']], 2)
+            # the money market fund ARK keeps its cash in, with no ticker
+            stock_ids = np.append(holding['id'], -1)
+            shares = np.append(holding['shares'], 5000000 + self.day)
+            market_value = np.append(market_value, 5000000.0 + self.day)
+            order = np.argsort(-market_value, kind='stable')
+            weight = 100 * market_value / market_value.sum()
+            lines = ['date,fund,company,ticker,cusip,shares,"market value($)","weight(%)"']
+            for x in order:
+                if stock_ids[x] < 0:
+                    company, ticker, cusip = 'MORGAN STANLEY GOVT INSTL 8035', '', 'X9USDMORS'
+                else:
+                    company, ticker, cusip = 'COMPANY ' + str(stock_ids[x]), 'T' + str(stock_ids[x]), \
+                                             'C' + str(stock_ids[x]).zfill(8)
+                lines.append('%s,%s,"%s",%s,%s,%d,%.2f,%.2f' % (date, fund, company, ticker, cusip, shares[x],
+                                                                market_value[x], weight[x]))
+            lines += ['', '"The principal risks of investing in the Fund are..."', '"Holdings are subject to change."']
+            with open(os.path.join(folder, fund + '.csv'), 'w') as file:
+                file.write('\n'.join(lines) + '\n')
+
+def benchmark_pipeline(funds=7, holdings=30, days=2, workers=None, seed=1, results_file='benchmark_results.ndjson'):
+    """Benchmark: time each stage of 'ark_etf_main.py' on made-up files, offline, and record the times"""
+    # Runs in a temporary folder: the first days-1 days are downloaded into the archive first (timed as 'history'),
+    # then every stage is timed on the last day.  Each run is added to 'results_file' as one JSON line, and compared
+    # with the last run of the same size so a slower stage stands out
+    results_file = os.path.abspath(results_file)
+    home_dir = os.getcwd()
+    synthetic = Synthetic_holdings(funds, holdings, seed)
+    ticker = synthetic.ticker
+    dates = [date.strftime('%m/%d/%Y') for date in pd.bdate_range('2021-01-04', periods=days)]
+    timings = {}
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        value = function(*args, **kwargs)
+        timings[stage] = timings.get(stage, 0) + time.perf_counter() - start
+        return value
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        os.chdir(work_dir)
+        try:
+            Folders_organize(ticker).create_etf_directories()
+            Folders_organize(ticker).create_etf_sub_directories()
+            # HISTORY - every day before the last one goes into the archive
+            for day, date in enumerate(dates[:-1]):
+                if day:
+                    synthetic.next_day()
+                synthetic.write_day(date, work_dir)
+                timed('history ingest', Ingest_downloaded_files(ticker).ingest_today_files)
+            if len(dates) > 1:
+                synthetic.next_day()
+
+            # WEB SCRAPE - from a stand-in for the ARK website on this computer
+            server_dir = os.path.join(work_dir, 'server')
+            os.mkdir(server_dir)
+            synthetic.write_day(dates[-1], server_dir)
+            server = Local_holdings_server(server_dir).start()
+            try:
+                timed('download', Grab_files_from_internet(server.urls(ticker)).get_csv)
+            finally:
+                server.stop()
+            # INGEST - replaces 'get_date_rename_file', 'remove_last_three_rows', 'calc_stock_price_and_rank' and
+            # 'move_today_files'
+            today_date_dict = timed('ingest', Ingest_downloaded_files(ticker).ingest_today_files)
+            summary_file = os.path.join('summary', 'summary_' + today_date_dict[ticker[0]] + '.txt')
+            today_filepath_list = timed('today_files', Get_working_files(ticker).today_files)
+            yesterday_filepath_list = timed('yesterday_files', Get_working_files(ticker).yesterday_files,
+                                            today_filepath_list)
+            # the stages one after another, as they were run before 'parallel_analysis'
+            delta_list = timed('ark_data_frames', ark_data_frames, ticker, today_filepath_list,
+                               yesterday_filepath_list, today_date_dict, add_to_index=False)
+            # the security index and the rolling signals, which 'ark_data_frames' updates afterwards
+            timed('index_and_signals', add_delta_files, ticker, today_date_dict, delta_list[1])
+            fund_mv_list = timed('fund_sum_market_value', fund_sum_market_value, ticker, today_filepath_list,
+                                 yesterday_filepath_list, summary_file)
+            timed('stocks_added_or_removed', stocks_added_or_removed, ticker, today_filepath_list,
+                  yesterday_filepath_list, summary_file)
+            mode_median_message_list = timed('median_mode_change_in_shares', median_mode_change_in_shares,
+                                             delta_list[1])
+            timed('changed_x_or_more', changed_x_or_more, ticker, fund_mv_list[0], fund_mv_list[1], summary_file,
+                  mode_median_message_list, delta_list[1])
+            # the same stages as one step, the way the main program runs them now
+            timed('parallel_analysis', parallel_analysis, ticker, today_filepath_list, yesterday_filepath_list,
+                  today_date_dict, summary_file, workers)
+            if len(dates) > 1:
+                timed('backfill_deltas', backfill_deltas, ticker, workers=workers)
+            # MEMORY - the whole archive in memory, with pandas' default types and with the holdings schema
+            memory = store.memory_comparison([filepath for fund in ticker
+                                              for date, filepath in Archive_manifest(fund).date_range()])
+        finally:
+            os.chdir(home_dir)
+
+    result = {'time': datetime.datetime.now().isoformat(timespec='seconds'), 'funds': funds, 'holdings': holdings,
+              'days': days, 'workers': workers, 'format': store.file_format, 'seed': seed,
+              'stages': {stage: round(seconds, 4) for stage, seconds in timings.items()}, 'memory': memory}
+    # the last run of the same size, to compare with
+    previous = None
+    if os.path.isfile(results_file):
+        with open(results_file, 'r') as file:
+            for line in file:
+                run = json.loads(line)
+                if all(run.get(setting) == result[setting] for setting in ['funds', 'holdings', 'days', 'workers',
+                                                                          'format']):
+                    previous = run
+    with open(results_file, 'a') as file:
+        file.write(json.dumps(result) + '\n')
+
+    print('{} funds x {} holdings x {} days ({})'.format(funds, holdings, days, store.file_format))
+    for stage, seconds in result['stages'].items():
+        line = '\t{:<30}{:>10.4f}s'.format(stage, seconds)
+        if previous is not None and previous['stages'].get(stage):
+            line += '{:>+10.1f}%'.format(100 * (seconds / previous['stages'][stage] - 1))
+        print(line)
+    print('\tarchive in memory: {:.1f} MB with default types, {:.1f} MB with the holdings schema ({:.0f}%)'.format(
+        memory['default'] / 2**20, memory['schema'] / 2**20, 100 * memory['schema'] / memory['default']))
+    return result
 
 def remove_duplicate_lines():
     """to remove repeat line"""